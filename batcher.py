@@ -0,0 +1,404 @@
+"""
+Queue of remote metadata operations: deletes, moves, new folders and
+uploads of the permissions file. Operations are applied to the local
+metadata straight away, recorded in a journal on disk, and sent to Dropbox
+in order in the background once no new operation has been queued for a
+short while, so a recursive rm or mv returns at local speed. Deleting a
+folder drops the queued deletes of everything inside it, so removing a
+tree costs a single remote call. Operations failing for want of a network
+are retried until they go through, on the next mount if need be.
+"""
+
+import errno
+import socket
+from threading import Condition, Thread
+from time import time
+
+from engine import Engine
+from logs import get_logger
+from scheduler import priority
+
+log = get_logger('batch')
+
+# operations hiding their path from listings until they're done
+REMOVING = ('delete', 'move')
+
+# the permissions file, uploaded whole by a 'perm' operation
+PERM_PATH = '/.f_perm.txt'
+
+# errors of a connection which can't be made or was lost
+try:
+    from urllib3.exceptions import HTTPError
+    NETWORK_ERRORS = (socket.error, HTTPError)
+except ImportError:
+    NETWORK_ERRORS = (socket.error,)
+
+class PendingOp(object):
+
+    __slots__ = ('kind', 'path', 'new', 'entry', 'queued', 'seq', 'order')
+
+    def __init__(self, kind, path, new=None, entry=None, seq=None):
+        self.kind = kind
+        self.path = path
+        # path added and its (is_dir, size, ctime, mtime), moves and mkdirs
+        self.new = new
+        self.entry = entry
+        self.queued = time()
+        # number of the operation in the journal
+        self.seq = seq
+        # position in the queue, later operations on a path win
+        self.order = None
+
+def transient(error):
+
+    # whether an operation failing with error may go through later:
+    # dropbox couldn't be reached, there's no client as it couldn't be
+    # reached at mount time, or it's a rate limit or server error. any
+    # other answer, or a bug of ours, stays the same however often the
+    # operation is retried
+    if isinstance(error, NETWORK_ERRORS):
+        return True
+    if isinstance(error, EnvironmentError) and error.errno == errno.EIO:
+        return True
+    status = getattr(error, 'status', None)
+    return status is not None and (status == 429 or status >= 500)
+
+def parent(path):
+
+    return path.rsplit('/', 1)[0] or '/'
+
+class OperationBatcher(object):
+
+    def __init__(self, api, delay=1, workers=4, journal=None):
+        # api provides the dropbox client and the metadata store
+        self.api = api
+        # seconds without new operations before the queue is submitted,
+        # nothing waits longer than max_delay
+        self.delay = delay
+        self.max_delay = delay * 10
+        # deletes submitted concurrently
+        self.workers = workers
+        self.engine = Engine(workers)
+        self.cond = Condition()
+        self.queue = []
+        self.last = 0
+        self.running = 0
+        self.urgent = False
+        self.thread = None
+        # write-ahead journal of the queue, None keeps it in memory only
+        self.journal = journal
+        # operations failing for want of dropbox are retried after
+        # retry_delay, doubled on every failure up to max_retry_delay
+        self.offline = False
+        self.retry_at = 0
+        self.retry_delay = 1
+        self.max_retry_delay = 60
+        # path -> orders of the pending operations that removed it
+        self.hidden = {}
+        # path -> pending moves to it and mkdirs of it, in queue order
+        self.added = {}
+        self.ops = 0
+
+    # Helper functions
+    # ================
+
+    def _start(self):
+
+        if self.thread is None:
+            self.thread = Thread(target=self._worker)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _unhide(self, op):
+
+        orders = self.hidden.get(op.path)
+        if orders is not None and op.order in orders:
+            orders.remove(op.order)
+            if not orders:
+                del self.hidden[op.path]
+
+    def _release(self, op):
+
+        # the operation reached dropbox, listings show it from now on
+        if op.kind in REMOVING:
+            self._unhide(op)
+        if op.new is not None:
+            added = self.added.get(op.new)
+            if added is not None and op in added:
+                added.remove(op)
+                if not added:
+                    del self.added[op.new]
+
+    def _hides(self, path):
+
+        """
+        Whether path is gone once the pending operations are applied in
+        order: a delete or move of path or of one of its parents hides
+        it, unless a later mkdir or move recreates path, or a later move
+        brings back a parent with its contents.
+        """
+        restored = -1
+        current = path
+        while True:
+            added = self.added.get(current)
+            if added and (current == path or added[-1].kind == 'move'):
+                restored = max(restored, added[-1].order)
+            removed = self.hidden.get(current)
+            if removed and removed[-1] > restored:
+                return True
+            if current == '/':
+                return False
+            current = parent(current)
+
+    def _touches(self, path):
+
+        # whether a pending operation removes or adds path or a parent
+        current = path
+        while True:
+            if current in self.hidden or current in self.added:
+                return True
+            if current == '/':
+                return False
+            current = parent(current)
+
+    def _queue(self, op):
+
+        with self.cond:
+            if op.seq is None and self.journal is not None:
+                op.seq = self.journal.append(op.kind, op.path, op.new, op.entry)
+            self.queue.append(op)
+            self.last = time()
+            self.ops += 1
+            op.order = self.ops
+            if op.kind in REMOVING:
+                self.hidden.setdefault(op.path, []).append(op.order)
+            if op.new is not None:
+                self.added.setdefault(op.new, []).append(op)
+            self._start()
+            self.cond.notify_all()
+
+    def _done(self, op):
+
+        if self.journal is not None and op.seq is not None:
+            self.journal.done(op.seq)
+
+    def _worker(self):
+
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                now = time()
+                if self.retry_at > now:
+                    self.cond.wait(self.retry_at - now)
+                    continue
+                wait = self.last + self.delay - now
+                if wait > 0 and not self.urgent and \
+                        self.queue[0].queued + self.max_delay > now:
+                    self.cond.wait(wait)
+                    continue
+
+                # a run of deletes can go out in any order, moves one by one
+                if self.queue[0].kind == 'delete':
+                    count = 1
+                    while count < len(self.queue) and self.queue[count].kind == 'delete':
+                        count += 1
+                else:
+                    count = 1
+                batch = self.queue[:count]
+                del self.queue[:count]
+                self.running += count
+
+            failed = self._submit(batch)
+
+            with self.cond:
+                for op in batch:
+                    if op not in failed:
+                        self._release(op)
+                        self._done(op)
+                self.running -= len(batch)
+                if failed:
+                    # back at the head of the queue, nothing overtakes them
+                    self.queue[:0] = [op for op in batch if op in failed]
+                    self.offline = True
+                    self.retry_at = time() + self.retry_delay
+                    log.warning("Dropbox unreachable, %d operations waiting, retrying in %ds",
+                                len(self.queue), self.retry_delay)
+                    self.retry_delay = min(self.retry_delay * 2, self.max_retry_delay)
+                else:
+                    self.offline = False
+                    self.retry_delay = 1
+                if not self.queue and not self.running:
+                    self.urgent = False
+                    if self.journal is not None:
+                        self.journal.reset()
+                self.cond.notify_all()
+
+    def _submit(self, batch):
+
+        # the operations which have to be tried again
+        if len(batch) == 1 or self.workers < 2:
+            return self._execute_all(batch)
+
+        futures = [self.engine.submit(self._execute_all, batch[i::self.workers])
+                   for i in range(min(self.workers, len(batch)))]
+        failed = set()
+        for future in futures:
+            failed.update(future.result())
+        return failed
+
+    def _execute_all(self, ops):
+
+        return set(op for op in ops if not self._execute(op))
+
+    def _execute(self, op):
+
+        # False if the operation should be tried again later
+        try:
+            # behind anything a user is waiting for
+            with priority('sync'):
+                if op.kind == 'delete':
+                    self.api.client.file_delete(op.path)
+                elif op.kind == 'move':
+                    self.api.client.file_move(op.path, op.new)
+                elif op.kind == 'mkdir':
+                    self.api.client.file_create_folder(op.path)
+                else:
+                    self.api.upload_f_perm()
+        except Exception, e:
+            if transient(e):
+                log.debug("%s of %s failed, will retry: %s", op.kind, op.path, e)
+                return False
+            if op.kind == 'delete' and getattr(e, 'status', None) == 404:
+                return True # already gone
+            if op.kind == 'mkdir' and getattr(e, 'status', None) == 403:
+                return True # already there
+            # conflicts with what dropbox has, which wins
+            log.error("Error in %s of %s: %s", op.kind, op.path, e)
+            # the local view is wrong now, list again from dropbox
+            self.api.store.invalidate(parent(op.path))
+            if op.new is not None:
+                self.api.store.invalidate(parent(op.new))
+        return True
+
+    # Public interface
+    # ================
+
+    def delete(self, path):
+
+        with self.cond:
+            # deletes queued just before, inside the deleted folder,
+            # are covered by this one
+            i = len(self.queue) - 1
+            prefix = path.rstrip('/') + '/'
+            while i >= 0 and self.queue[i].kind == 'delete':
+                if self.queue[i].path.startswith(prefix):
+                    self._unhide(self.queue[i])
+                    self._done(self.queue[i])
+                    del self.queue[i]
+                i -= 1
+            self._queue(PendingOp('delete', path))
+
+    def move(self, old, new, entry):
+
+        self._queue(PendingOp('move', old, new, entry))
+
+    def mkdir(self, path, entry):
+
+        self._queue(PendingOp('mkdir', path, path, entry))
+
+    def upload_perms(self):
+
+        # one upload of the permissions file covers every change made
+        # before it starts
+        with self.cond:
+            if any(op.kind == 'perm' for op in self.queue):
+                return
+            self._queue(PendingOp('perm', PERM_PATH))
+
+    def replay(self):
+
+        # queue again what the journal holds from before the last unmount
+        if self.journal is None:
+            return 0
+        ops = self.journal.load()
+        for seq, kind, path, new, entry in ops:
+            self._queue(PendingOp(kind, path, new, entry, seq))
+        if ops:
+            log.info("Replaying %d operations from %s", len(ops), self.journal.path)
+        return len(ops)
+
+    def hides(self, path):
+
+        # whether path is removed by the pending operations
+        with self.cond:
+            if not self.hidden:
+                return False
+            return self._hides(path)
+
+    def pending_entry(self, path):
+
+        # entry of a pending move destination or new folder, None if
+        # there's none
+        with self.cond:
+            added = self.added.get(path)
+            if not added or self._hides(path):
+                return None
+            return added[-1].entry
+
+    def overlay(self, path, entries):
+
+        """
+        Apply the pending operations to entries, a listing of path just
+        fetched from dropbox, as (name, is_dir, size, ctime, mtime) tuples.
+        """
+        with self.cond:
+            if not self.hidden and not self.added:
+                return entries
+            if self._hides(path):
+                return []
+
+            prefix = path.rstrip('/') + '/'
+            entries = [e for e in entries if not self._hides(prefix + e[0])]
+            # pending entries replace what dropbox still has under their name
+            pending = {}
+            for new, added in self.added.items():
+                name = new[len(prefix):]
+                if new.startswith(prefix) and name and '/' not in name and \
+                        not self._hides(new):
+                    pending[name] = (name,) + tuple(added[-1].entry)
+            if pending:
+                entries = [e for e in entries if e[0] not in pending]
+                entries.extend(pending.values())
+            return entries
+
+    def flush(self):
+
+        """
+        Submit everything queued and wait for it. Returns False if dropbox
+        can't be reached, the operations left are kept in the journal.
+        """
+        with self.cond:
+            if not self.queue and not self.running:
+                return True
+            self.urgent = True
+            self.cond.notify_all()
+            while (self.queue or self.running) and not self.offline:
+                self.cond.wait()
+            return not self.queue and not self.running
+
+    def flush_path(self, path):
+
+        """
+        Wait for the pending operations on path and on its parents to reach
+        dropbox, before anything new is done there. Returns False if they
+        can't be sent right now, whatever comes next has to wait for them.
+        """
+        with self.cond:
+            if not self._touches(path):
+                return True
+            self.urgent = True
+            self.cond.notify_all()
+            while self._touches(path) and not self.offline:
+                self.cond.wait()
+            return not self._touches(path)
@@ -14,24 +14,195 @@ try:
     import argparse
     import errno
     import tempfile
+    import mmap
+    import logging
     import socket
     import urllib3
     import dropbox
     from dropbox.rest import ErrorResponse
     from config import AppCredentials
-    from time import time
-    from datetime import datetime
+    from time import time, sleep
+    from threading import Condition, Event, Lock, Thread
+    from collections import deque
+    from metadata_store import MetadataStore, FOREIGN_INO, ROOT_INO, ingest
+    from content_hash import ContentHasher
+    from batcher import OperationBatcher
+    from journal import Journal
+    from transfer import copy_stream
+    from throttle import Bandwidth, ThrottledFile
+    from write_buffer import WriteBuffer
+    from governor import Governor
+    from engine import Engine
+    from hedging import HedgedClient
+    from scheduler import CLASSES, IOScheduler, priority
+    from profiler import ControlFile, SamplingProfiler, TracedClient, tracer
+    import logs
     from fuse import FUSE, FuseOSError, LoggingMixIn, Operations, fuse_get_context
 except ImportError, e:
   msg = "Error: Failed to load one of the required modules! (%s)\n"
   sys.stderr.write(msg % str(e))
   sys.exit(1)
 
-class DropboxAPI():
+# each subsystem logs through its own logger, see logs.py
+fs_log = logs.get_logger('fs')
+api_log = logs.get_logger('api')
+transfer_log = logs.get_logger('transfer')
+
+# the access mode bits of open() flags, os.O_ACCMODE is missing on Python 2
+ACCESS_MODES = os.O_RDONLY | os.O_WRONLY | os.O_RDWR
+
+# user.cloudfuse.<name>_limit attributes of the root -> Bandwidth limit
+BANDWIDTH_LIMITS = {'upload': 'upload', 'download': 'download', 'bandwidth': 'total'}
+
+class PendingListing():
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+class Download():
+
+    # progress of a file body streaming into its temp file
     def __init__(self):
-        self.client = self.dropbox_request()
-        self.tree_contents = {}
-        self.tree_contents_cache = {}
+        self.cond = Condition()
+        self.received = 0
+        self.done = False
+        self.cancelled = False
+        self.error = None
+
+    def advance(self, count):
+
+        with self.cond:
+            self.received += count
+            self.cond.notify_all()
+
+    def finish(self, error=None):
+
+        with self.cond:
+            self.done = True
+            self.error = error
+            self.cond.notify_all()
+
+    def cancel(self):
+
+        # stop the transfer and wait until nothing more gets written
+        with self.cond:
+            self.cancelled = True
+            while not self.done:
+                self.cond.wait()
+
+    def wait(self, end=None):
+
+        # block until the first end bytes have arrived, or all of them
+        with self.cond:
+            while not self.done and (end is None or self.received < end):
+                self.cond.wait()
+            if self.error is not None and (end is None or self.received < end):
+                raise FuseOSError(errno.EIO) # IO error
+
+class CacheMap():
+
+    # read-only mapping of a fully downloaded temp file, shared by all
+    # readers, so a read is a slice instead of a seek and a read on the
+    # file object and its shared position
+    def __init__(self):
+        self.lock = Lock()
+        self.map = None
+
+    def read(self, f, size, offset):
+
+        with self.lock:
+            if self.map is None:
+                # buffered writes must reach the file before it's mapped
+                f.flush()
+                length = os.fstat(f.fileno()).st_size
+                if length == 0:
+                    return ''
+                self.map = mmap.mmap(f.fileno(), length, access=mmap.ACCESS_READ)
+            return self.map[offset:offset + size]
+
+    def written(self, f, end):
+
+        # writes within the mapping show through it once flushed,
+        # a file extended past it gets mapped again on the next read
+        with self.lock:
+            if self.map is not None:
+                f.flush()
+                if end > len(self.map):
+                    self._unmap()
+
+    def truncate(self, f, length):
+
+        # reading a mapping past the end of its file would crash the
+        # whole process, no reader may map the file while it shrinks
+        with self.lock:
+            self._unmap()
+            f.truncate(length)
+
+    def reset(self):
+
+        # drop the mapping, the file is being closed
+        with self.lock:
+            self._unmap()
+
+    def _unmap(self):
+
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+class DropboxAPI(object):
+    def __init__(self, max_nodes=1000000, lookup_threshold=5000, max_stale=0,
+                 deadline=0, min_ttl=5, max_ttl=3600, batch_delay=1,
+                 api_rate=20, api_concurrency=8, hedge_budget=0.05,
+                 request_timeout=30, upload_limit=None, download_limit=None,
+                 bandwidth_limit=None, journal='.cloudfuse-journal'):
+        # only the token is read up front, the client is created and
+        # validated in the background once the filesystem is mounted
+        self.token = self.dropbox_request()
+        self._client = None
+        self.account = None
+        self.started = False
+        self.start_lock = Lock()
+        self.ready = Event()
+        # set once .f_perm.txt has been synchronised
+        self.perm_ready = Event()
+        # cached metadata of every file and folder seen so far, listings
+        # are kept between min_ttl and max_ttl seconds depending on how
+        # often each directory changes
+        self.store = MetadataStore(max_nodes, min_ttl, max_ttl)
+        # directories with at least this many entries aren't listed
+        # just to stat one of their children
+        self.lookup_threshold = lookup_threshold
+        # seconds an expired listing may still be served while it's
+        # refreshed in the background, 0 disables stale listings
+        self.max_stale = max_stale
+        # seconds an operation waits for a listing before falling back
+        # on cached data of any age, 0 waits for as long as it takes
+        self.deadline = deadline
+        # path -> PendingListing of listings being fetched
+        self.refreshing = {}
+        self.refresh_lock = Lock()
+        # metadata operations on their way to dropbox, journalled in
+        # the journal file until they get there
+        self.batcher = OperationBatcher(self, batch_delay, journal=Journal(journal))
+        # requests a second per endpoint class and requests in flight
+        # allowed by the governor all client calls go through
+        self.api_rate = api_rate
+        self.api_concurrency = api_concurrency
+        # read-only calls slower than usual are sent again, within this
+        # share of extra requests, and fail after request_timeout seconds
+        self.hedge_budget = hedge_budget
+        self.request_timeout = request_timeout
+        # orders requests by priority class, set once connected
+        self.scheduler = None
+        # worker pools running the requests themselves and the background
+        # work waiting on them, FUSE threads only wait for their results
+        self.engine = Engine(64)
+        self.tasks = Engine(16)
+        # bytes a second file bodies may be sent and received at, each way
+        # and in total, changed at runtime through xattrs of the root
+        self.bandwidth = Bandwidth(upload_limit, download_limit, bandwidth_limit)
 
     def dropbox_request(self):
 
@@ -41,7 +212,7 @@ class DropboxAPI():
         token_file.close()
 
         if token_secret != '':
-            client = dropbox.client.DropboxClient(str(token_secret))
+            access_token = str(token_secret)
         else:
             #log in and authenticate with dropbox
             flow = dropbox.client.DropboxOAuth2FlowNoRedirect(AppCredentials.app_key, \
@@ -61,14 +232,80 @@ class DropboxAPI():
                 return self.dropbox_request()
 
             print "Authorization Successful"
-            client = dropbox.client.DropboxClient(access_token)
             # write the access_token to file for reuse
             token_file = open(app_access_token,'w')
             token_file.write("%s" % (access_token))
             token_file.close()
 
+        return access_token
+
+    @property
+    def client(self):
+
+        # only callers which talk to dropbox wait for the warm-up
+        if not self.ready.is_set():
+            self.start()
+            self.ready.wait()
+
+        client = self._client
+        if client is None:
+            # warm-up failed, let the next caller try again
+            with self.start_lock:
+                if self.ready.is_set() and self._client is None:
+                    self.started = False
+                    self.ready.clear()
+            raise FuseOSError(errno.EIO) # IO error
         return client
 
+    def start(self):
+
+        # create the client and warm the caches up in the background
+        with self.start_lock:
+            if self.started:
+                return
+            self.started = True
+
+        thread = Thread(target=self.warm_up)
+        thread.daemon = True
+        thread.start()
+
+    def warm_up(self):
+
+        try:
+            client = Governor(dropbox.client.DropboxClient(self.token),
+                              self.api_rate, self.api_concurrency)
+            client = HedgedClient(client, self.hedge_budget, self.request_timeout,
+                                  engine=self.engine)
+            client = self.scheduler = IOScheduler(client, self.api_concurrency)
+            client = TracedClient(client, tracer)
+            # validate the token, the answer also primes the quota cache
+            self.account = client.account_info()
+            self._client = client
+        except ErrorResponse, e:
+            api_log.error("Error %s: %s", e.status, e.error_msg)
+        except Exception, e:
+            api_log.error("Cannot connect to Dropbox: %s", e)
+        finally:
+            self.ready.set()
+
+        if self._client is None:
+            return
+
+        try:
+            self.sync_f_perm(self.list_objects('/'))
+        except Exception, e:
+            api_log.error("Warm-up failed: %s", e)
+        finally:
+            self.perm_ready.set()
+
+    def wait_perm(self):
+
+        # block until .f_perm.txt is available locally,
+        # fails right away if dropbox can't be reached
+        if not self.perm_ready.is_set():
+            self.client
+            self.perm_ready.wait()
+
     def get_account_info(self):
 
         #returns the account information, such as user's display name, quota, email, etc
@@ -83,99 +320,256 @@ class DropboxAPI():
         res = self.client.put_file('/.f_perm.txt', f, overwrite=True)
         f.close()
 
-    def search(self, values, searchFor):
+    def sync_f_perm(self, root):
 
-        # search for specific path in metadata dict
-        for k in values['contents']:
-            if searchFor in k['path']:
-                return True
-        return False
+        #Check if permissions file exists locally & on dropbox
+        if '.f_perm.txt' not in root:
+            self.upload_f_perm()
+        elif not os.path.isfile('.f_perm.txt'):
+            perm_contents = ''
+            try:
+                perm = self.client.get_file('/.f_perm.txt')
+                perm_contents = perm.read()
+                perm.close()
+            except ErrorResponse, e:
+                api_log.warning("Error %s: %s", e.status, e.error_msg)
+            f = open('.f_perm.txt', 'a+')
+            lines = perm_contents.split('\n')
+            for i in range(len(lines)-1):
+                line = lines[i]
+                f.write("%s\n" % (line))
+            f.close()
 
     def list_objects(self, path, ttl=60):
 
+        with tracer.span('list_objects', 'cache', path=path):
+            return self._list_objects(path, ttl)
+
+    def _list_objects(self, path, ttl=60):
+
         # for efficiency, store the last snapshot of files in memory
         # this prevents from constantly calling metadata()
-        if path in self.tree_contents_cache:
-            if self.tree_contents_cache[path] >= time():
-                return self.tree_contents[path]
+        listing = self.store.listing(path)
+        if listing is not None:
+            return listing
+
+        if self.max_stale:
+            # serve a recently expired listing straight away
+            # and bring it up to date in the background
+            listing = self.store.listing(path, self.max_stale)
+            if listing is not None:
+                self.refresh(path, ttl, 'readahead')
+                return listing
+
+        if not self.deadline and not self.max_stale:
+            return self.fetch_listing(path, ttl)
+
+        pending = self.refresh(path, ttl)
+        if self.deadline and not pending.done.wait(self.deadline):
+            # too slow, any cached listing beats waiting any longer
+            listing = self.store.listing(path, float('inf'))
+            if listing is not None:
+                return listing
+        pending.done.wait()
+
+        if pending.error is not None:
+            # when the network is down, fall back on the last known listing
+            listing = self.store.listing(path, float('inf'))
+            if self.max_stale and listing is not None and \
+                    getattr(pending.error, 'errno', None) != errno.ENOENT:
+                return listing
+            raise pending.error
+        return pending.result
+
+    def refresh(self, path, ttl=60, cls='foreground'):
+
+        # fetch the listing of path in a background thread at priority
+        # cls, there's never more than one fetch per path in flight
+        with self.refresh_lock:
+            if path in self.refreshing:
+                return self.refreshing[path]
+            pending = self.refreshing[path] = PendingListing()
+
+        self.tasks.submit(self._refresh, path, ttl, pending, cls)
+        return pending
+
+    def _refresh(self, path, ttl, pending, cls):
 
-        # check if dropbox api host is accessible
         try:
-            host = socket.getaddrinfo('api.dropbox.com', 443)
-        except socket.gaierror, err:
-            print "Cannot resolve hostname: ", 'api.dropbox.com', err
-            sys.exit(1)
-
+            with tracer.span('refresh', 'cache', path=path), priority(cls):
+                pending.result = self.fetch_listing(path, ttl)
+        except Exception, e:
+            pending.error = e
+        finally:
+            with self.refresh_lock:
+                del self.refreshing[path]
+            pending.done.set()
+
+    def fetch_listing(self, path, ttl=60):
+
+        # dropbox has path as we see it once the moves and deletes
+        # queued on it and its parents are done
+        if not self.batcher.flush_path(path):
+            raise FuseOSError(errno.EIO) # IO error
         try:
             # obtain file/folder metadata from dropbox
             response = self.client.metadata(path)
         except ErrorResponse, e:
-            print "Error %s: %s" % (e.status, e.error_msg)
+            if e.status == 404:
+                raise FuseOSError(errno.ENOENT) # no such file or dir
+            api_log.error("Error %s: %s", e.status, e.error_msg)
+            raise FuseOSError(errno.EIO) # IO error
+        except (socket.error, urllib3.exceptions.HTTPError), e:
+            api_log.error("Cannot reach Dropbox: %s", e)
+            raise FuseOSError(errno.EIO) # IO error
 
         if 'contents' not in response:
             raise FuseOSError(errno.EIO) # IO error
 
-        # build tree
-        self.tree_contents[path] = {}
-        for child in response['contents']:
-            # utf8 encoding will handle special characters
-            name = str((os.path.basename(child['path'])).encode('utf8'))
-            d = child['modified']
-
-            # format date string
-            d = d[5:-6]
-            date_object = datetime.strptime(d, '%d %b %Y %H:%M:%S')
-            # convert datetime object to Unix timestamp
-            time_stamp = (date_object - datetime(1970,1,1)).total_seconds()
-
-            ctime = int(time_stamp)
-            if child['modified'] == '':
-                mtime = ctime
-            else:
-                mtime = int(time_stamp)
-            
-            if child['is_dir'] == True:
-                obj_type = 'dir'
-            else:
-                obj_type = 'file'
+        # build tree, with the metadata operations not submitted yet
+        entries = self.batcher.overlay(path, ingest(response['contents']))
 
-            self.tree_contents[path][name] = {'name': name, 'type': obj_type, \
-                    'size': child['bytes'], 'ctime': ctime, 'mtime': mtime}
+        # store listing and update expiration time
+        return self.store.set_listing(path, entries, ttl)
 
-        db_api = DropboxAPI()
-        #Check if permissions file exists locally & on dropbox
-        is_existent = db_api.search(response, '/.f_perm.txt')
-        
-        if not is_existent:
-            db_api.upload_f_perm() 
-        elif not os.path.isfile('.f_perm.txt'):
-            f = open('.f_perm.txt', 'a+')
+    def lookup(self, path, ttl=60):
+
+        with tracer.span('lookup', 'cache', path=path):
+            return self._lookup(path, ttl)
+
+    def _lookup(self, path, ttl=60):
+
+        # metadata of a single object, None if it doesn't exist
+        parent = os.path.dirname(path)
+        name = os.path.basename(path)
+
+        listing = self.store.listing(parent)
+        if listing is not None:
+            return listing.get(name)
+
+        node = self.store.entry(path)
+        if node is not None:
+            return node
+
+        if self.batcher.hides(path):
+            return None
+        entry = self.batcher.pending_entry(path)
+        if entry is not None:
+            return self.store.set_entry(path, *(tuple(entry) + (ttl,)))
+
+        # small or unknown directories are listed in full, that's a
+        # single round-trip which also answers lookups of the siblings
+        count = self.store.count(parent)
+        if count is None or count < self.lookup_threshold:
+            return self.list_objects(parent, ttl).get(name)
+
+        if not self.batcher.flush_path(path):
+            raise FuseOSError(errno.EIO) # IO error
+        try:
+            response = self.client.metadata(path, list=False)
+        except ErrorResponse, e:
+            if e.status == 404:
+                return None
+            api_log.error("Error %s: %s", e.status, e.error_msg)
+            raise FuseOSError(errno.EIO) # IO error
+        except (socket.error, urllib3.exceptions.HTTPError), e:
+            api_log.error("Cannot reach Dropbox: %s", e)
+            raise FuseOSError(errno.EIO) # IO error
+
+        if response.get('is_deleted'):
+            return None
+
+        name, is_dir, size, ctime, mtime = ingest([response])[0]
+        return self.store.set_entry(path, is_dir, size, ctime, mtime, ttl)
+
+class QuotaCache():
+
+    # account quota for statfs, refreshed in the background and adjusted
+    # locally as uploads and deletes happen in between
+    def __init__(self, dropbox_api, interval=300):
+        self.dropbox_api = dropbox_api
+        self.interval = interval
+        self.lock = Lock()
+        self.total = None
+        self.used = 0
+        self.thread = None
+
+    def refresh(self, acc_info=None):
+
+        try:
+            if acc_info is None:
+                acc_info = self.dropbox_api.get_account_info()
+        except ErrorResponse, e:
+            api_log.error("Error %s: %s", e.status, e.error_msg)
+            raise FuseOSError(errno.EIO) # IO error
+
+        quota_info = acc_info['quota_info']
+        with self.lock:
+            self.total = quota_info['quota']
+            self.used = quota_info['shared'] + quota_info['normal']
+
+    def _refresher(self):
+
+        while True:
+            sleep(self.interval)
             try:
-                perm = self.client.get_file('/.f_perm.txt')
-                perm_contents = perm.read()
-                perm.close()
-            except ErrorResponse, e:
-                print "Error %s: %s" % (e.status, e.error_msg)
-            lines = perm_contents.split('\n')
-            for i in range(len(lines)-1):
-                line = lines[i]
-                f.write("%s\n" % (line))
-            f.close()
+                with priority('sync'):
+                    self.refresh()
+            except Exception, e:
+                api_log.warning("Quota refresh failed: %s", e)
+
+    def get(self):
+
+        # only the very first call waits for account_info(), unless
+        # the answer from the token validation is already there
+        if self.total is None:
+            self.refresh(self.dropbox_api.account)
+            with self.lock:
+                if self.thread is None:
+                    self.thread = Thread(target=self._refresher)
+                    self.thread.daemon = True
+                    self.thread.start()
 
-        # update expiration time
-        self.tree_contents_cache[path] = time() + ttl
-        return self.tree_contents[path]
+        with self.lock:
+            return self.total, self.used
+
+    def adjust(self, delta):
+
+        with self.lock:
+            self.used += delta
 
 class DropboxFUSE(LoggingMixIn, Operations):
 
+    # every operation is traced while profiling is switched on
+    tracer = tracer
+
     # The main filesystem class. Most work will be done in here
-    def __init__(self, restr_dir):
-        self.dropbox_api = DropboxAPI()
+    def __init__(self, restr_dir, quota_interval=300, save_delay=2,
+                 trace_control=None, **options):
+        self.dropbox_api = DropboxAPI(**options)
+        self.quota = QuotaCache(self.dropbox_api, quota_interval)
         self.files = {}
         self.restr_dir = restr_dir
         self.restr_files = {}
         # restricted/excluded file extensions
-        self.extensions = ['.ascii','.class','.log','.o','.pyc']
+        self.extensions = ['.ascii','.class','.log','.o','.pyc','.swp']
+        # and names, libre office keeps its lock files for as long as a
+        # document is open, far longer than the save delay
+        self.prefixes = ['.~lock.']
+        # new files are uploaded this many seconds after they're closed,
+        # so a temp file renamed over its target right after being
+        # written is only uploaded once, under its final name
+        self.save_delay = save_delay
+        self.deferred = deque()
+        self.deferred_cond = Condition()
+        self.deferred_thread = None
+        # tracing and sampling run while this file exists
+        self.trace_control = trace_control
+        # per-operation messages are skipped entirely below debug level
+        self.log_ops = fs_log.isEnabledFor(logging.DEBUG)
+        # times of the root, fixed so its attributes are the same on
+        # every call and fuse.py can reuse the stat structure it filled
+        self.mount_time = time()
 
     # Helper functions
     # ================
@@ -200,33 +594,32 @@ class DropboxFUSE(LoggingMixIn, Operations):
     def file_get(self, path, download=True): 
 
         if path in self.files:
-            print "file_get: %s is in self.files" % path
+            if self.log_ops:
+                fs_log.debug("file_get: %s is in self.files", path)
             try:
                 return self.files[path]
             except:
-                print "KeyError: %s" % path
+                fs_log.error("KeyError: %s", path)
                 self.file_get(path)
 
         if path in self.restr_files:
-            print "file_get: %s is in self.restr_files" % path
+            if self.log_ops:
+                fs_log.debug("file_get: %s is in self.restr_files", path)
             return self.restr_files[path]
         
         # tempfile stores all files in /tmp
         # generate temp file
         f = tempfile.NamedTemporaryFile()
+        # 'hasher' keeps the content hash of the temp file, 'stale' means
+        # the remote contents haven't been fetched into it yet
+        fileObject = {'object': f, 'modified': False, 'hasher': ContentHasher(), \
+                      'remote_hash': None, 'local': False, 'node': None, \
+                      'stale': download == 'lazy', 'download': None, 'map': CacheMap(), \
+                      'buffer': WriteBuffer()}
 
         if download == True:
-            # get file from dropbox
-            try:
-                raw = self.dropbox_api.client.get_file(path)
-                # Read data off the underlying socket
-                # and write the bytes to temp file
-                f.write(raw.read())
-                raw.close() # Close the underlying socket
-            except ErrorResponse, e:
-                print "Error %s: %s" % (e.status, e.error_msg)
-                if e.status == 404:
-                    raise FuseOSError(errno.ENOENT) # no such file or dir
+            # get file from dropbox, the body keeps arriving in the background
+            self.file_download(path, fileObject, wait=False)
         elif download == None:
             # create or edit restricted file
             f_descr = os.open(path, os.O_RDWR|os.O_CREAT, 0664)
@@ -240,9 +633,101 @@ class DropboxFUSE(LoggingMixIn, Operations):
             f.write(raw)
 
         # populate dict with file object
-        self.files[path] = {'object': f, 'modified': False}
+        self.files[path] = fileObject
         return self.files[path]
 
+    def file_download(self, path, fileObject, wait=True):
+
+        # a file moved here may not be on dropbox yet
+        if not self.dropbox_api.batcher.flush_path(path):
+            raise FuseOSError(errno.EIO) # IO error
+        # start the transfer here, so a missing file fails right away
+        try:
+            raw = self.dropbox_api.client.get_file(path)
+        except ErrorResponse, e:
+            api_log.error("Error %s: %s", e.status, e.error_msg)
+            if e.status == 404:
+                raise FuseOSError(errno.ENOENT) # no such file or dir
+            fileObject['stale'] = False
+            return
+
+        download = fileObject['download'] = Download()
+        fileObject['stale'] = False
+        thread = Thread(target=self.file_stream, args=(path, fileObject, raw))
+        thread.daemon = True
+        thread.start()
+        if wait:
+            download.wait()
+
+    def file_stream(self, path, fileObject, raw):
+
+        # copy the body into the temp file through a handle of our own,
+        # readers keep using the shared file object meanwhile
+        download = fileObject['download']
+        hasher = fileObject['hasher']
+        f = open(fileObject['object'].name, 'r+b')
+        error = None
+
+        def received(offset, data):
+            hasher.update(offset, data)
+            download.advance(len(data))
+
+        try:
+            # Read data off the underlying socket and write the bytes to
+            # temp file, through a fixed size buffer whatever the file size
+            with tracer.span('download', 'transfer', path=path):
+                copy_stream(raw, f, callback=received,
+                            cancelled=lambda: download.cancelled,
+                            throttle=self.dropbox_api.bandwidth.download)
+
+            if not download.cancelled:
+                fileObject['remote_hash'] = hasher.hexdigest(f)
+                node = self.dropbox_api.store.lookup(path)
+                if node is not None:
+                    node.hash = fileObject['remote_hash']
+        except Exception, e:
+            transfer_log.error("Download of %s failed: %s", path, e)
+            error = e
+        finally:
+            raw.close() # Close the underlying socket
+            f.close()
+            download.finish(error)
+
+    def file_wait(self, fileObject, end=None):
+
+        # block until the first end bytes of the file, or all of it,
+        # have been downloaded
+        download = fileObject.get('download')
+        if download is not None:
+            download.wait(end)
+
+    def file_sync(self, fileObject):
+
+        # write the buffered writes out to the temp file, merged into
+        # as few contiguous writes as possible
+        buffer = fileObject['buffer']
+        with buffer.lock:
+            if not buffer.extents:
+                return
+            end = buffer.end()
+            f = fileObject['object']
+            for offset, data in buffer.drain():
+                f.seek(offset)
+                f.write(data)
+                fileObject['hasher'].update(offset, data)
+            f.flush()
+            fileObject['map'].written(f, end)
+
+    def file_contents(self, path):
+
+        # file object whose temp file holds the whole file contents,
+        # fetching them now if opening the file didn't
+        fileObject = self.file_get(path)
+        if fileObject.get('stale'):
+            self.file_download(path, fileObject)
+        self.file_wait(fileObject)
+        return fileObject
+
     def file_rename(self, oldFile, newFile):
         
         if oldFile in self.files:
@@ -253,23 +738,79 @@ class DropboxFUSE(LoggingMixIn, Operations):
             self.restr_files[newFile] = self.restr_files[oldFile]
             del self.restr_files[oldFile]
 
-    def file_close(self, path): # file gets uploaded before its closed
+    def file_close(self, path, deferred=False): # file gets uploaded before its closed
+
+        fileObject = self.local_file(path)
+        if fileObject is not None and self.save_delay and not deferred:
+            # give it a chance to be renamed or deleted first
+            self.defer_upload(fileObject)
+            return
 
         if path in self.files:
             if self.files[path]['modified'] == True: #if file is altered
-                self.file_upload(path)
+                if not self.file_upload(path):
+                    # kept until what's queued before it reaches dropbox
+                    self.defer_upload(self.files[path], self.dropbox_api.batcher.retry_delay)
+                    return
 
-            print "closing: " + path
+            if self.log_ops:
+                fs_log.debug("closing: %s", path)
             try:
+                download = self.files[path].get('download')
+                if download is not None:
+                    download.cancelled = True
+                self.files[path]['map'].reset()
                 self.files[path]['object'].close()
                 del self.files[path]
             except:
-                print "KeyErrorOnDelete: %s" % path
+                fs_log.error("KeyErrorOnDelete: %s", path)
                 pass
 
+    def defer_upload(self, fileObject, delay=None):
+
+        if delay is None:
+            delay = self.save_delay
+        fileObject['released'] = True
+        with self.deferred_cond:
+            self.deferred.append((time() + delay, fileObject))
+            if self.deferred_thread is None:
+                self.deferred_thread = Thread(target=self.deferred_uploader)
+                self.deferred_thread.daemon = True
+                self.deferred_thread.start()
+            self.deferred_cond.notify()
+
+    def deferred_uploader(self):
+
+        # uploads are due in the order they were deferred
+        while True:
+            with self.deferred_cond:
+                while not self.deferred:
+                    self.deferred_cond.wait()
+                due, fileObject = self.deferred[0]
+                if due > time():
+                    self.deferred_cond.wait(due - time())
+                    continue
+                self.deferred.popleft()
+            self.deferred_close(fileObject)
+
+    def deferred_close(self, fileObject):
+
+        # the file may have been renamed, deleted or opened again since
+        if not fileObject.get('released'):
+            return
+        for path, f in self.files.items():
+            if f is fileObject:
+                fileObject['released'] = False
+                try:
+                    self.file_close(path, deferred=True)
+                except Exception, e:
+                    transfer_log.error("Deferred upload of %s failed: %s", path, e)
+                return
+
     def file_upload(self, path):
 
-        print 'uploading %s' % path
+        # False if the upload has to wait for operations queued before it
+        transfer_log.info('uploading %s', path)
         
         if path not in self.files:
             raise FuseOSError(errno.EIO) # IO error
@@ -278,6 +819,8 @@ class DropboxFUSE(LoggingMixIn, Operations):
         fileObject = self.file_get(path)
         if fileObject['modified'] == False:
             return True
+        self.file_wait(fileObject)
+        self.file_sync(fileObject)
 
         f = fileObject['object']
         # go to beginning of the file
@@ -287,76 +830,138 @@ class DropboxFUSE(LoggingMixIn, Operations):
         # open for writing before it gets uploaded to remote storage
         ff = open(tfName, "rw+")
 
+        # size of the remote copy being replaced
+        node = self.dropbox_api.store.lookup(path)
+        old_size = node.size if node is not None and not node.is_dir else 0
+
+        # skip the upload if the bytes are the same as the remote ones
+        digest = fileObject['hasher'].hexdigest(f)
+        remote_hash = fileObject['remote_hash']
+        if remote_hash is None and node is not None and not node.is_dir:
+            remote_hash = node.hash
+        f.seek(0)
+        if digest == remote_hash and self.remote_unchanged(path, node):
+            transfer_log.info("%s is unchanged, not uploading", path)
+            ff.close()
+            fileObject['modified'] = False
+            return True
+
+        # a pending delete or move of path has to go first, the upload
+        # mustn't overtake it when dropbox can't be reached
+        if not self.dropbox_api.batcher.flush_path(path):
+            transfer_log.warning("%s waits for the operations queued before it", path)
+            ff.close()
+            return False
+
         response = {}
         # upload file object
         try:
-            response = self.dropbox_api.client.put_file(path, ff, overwrite=True)
+            body = ThrottledFile(ff, self.dropbox_api.bandwidth.upload)
+            response = self.dropbox_api.client.put_file(path, body, overwrite=True)
         except urllib3.exceptions.MaxRetryError:
-            print "Error. Cannot connect to the Internet"
+            transfer_log.error("Cannot connect to the Internet, %s not uploaded", path)
         except urllib3.exceptions.ReadTimeoutError:
-            print "Read timed out"
+            transfer_log.error("Read timed out uploading %s", path)
         except ErrorResponse, e:
-            print "Upload Error %s: %s" % (e.status, e.error_msg)
+            transfer_log.error("Upload Error %s: %s", e.status, e.error_msg)
 
         if response != {}:
-            # update tree_contents
-            name = os.path.basename(path)
-            if os.path.dirname(path) in self.dropbox_api.tree_contents:
-                self.dropbox_api.tree_contents[os.path.dirname(path)][name] = \
-                    {'name': name, 'type': 'file', 'size': response['bytes'], \
-                        'ctime': time(), 'mtime': time()}
-
-        print "FILE UPLOADED"
+            # update metadata store and quota, with dropbox's own mtime
+            # so the upload can be told apart from later remote changes
+            name, is_dir, size, ctime, mtime = ingest([response])[0]
+            node = self.dropbox_api.store.add(path, False, size, ctime, mtime)
+            if node is not None:
+                node.hash = digest
+            fileObject['remote_hash'] = digest
+            fileObject['local'] = False
+            self.quota.adjust(response['bytes'] - old_size)
+
+        transfer_log.info("uploaded %s", path)
         fileObject['modified'] = False
+        return True
             
-    def create_directory(self, path):
+    def remote_unchanged(self, path, node):
 
-        new_dir = {}
+        # whether the remote file still is the one node describes, its
+        # cached hash may be older than another client's change
+        if node is None or node.is_dir:
+            return False
         try:
-            new_dir = self.dropbox_api.client.file_create_folder(path)
-            # a dictionary containing the metadata of the newly created folder
-        except ErrorResponse, e:
-            print "Error %s: %s" % (e.status, e.error_msg)
+            response = self.dropbox_api.client.metadata(path, list=False)
+        except (ErrorResponse, socket.error, urllib3.exceptions.HTTPError), e:
+            # can't tell, uploading is the safe choice
+            api_log.warning("Cannot check %s on Dropbox: %s", path, e)
+            return False
+        if response.get('is_deleted') or response.get('is_dir'):
+            return False
+        name, is_dir, size, ctime, mtime = ingest([response])[0]
+        return size == node.size and mtime == node.mtime
 
-        # update tree_contents
-        name = os.path.basename(path)
-        if os.path.dirname(path) in self.dropbox_api.tree_contents:
-            self.dropbox_api.tree_contents[os.path.dirname(path)][name] = \
-                {'name': name, 'type': 'dir', 'size': 0, 'ctime': time(), 'mtime': time()}
+    def create_directory(self, path):
+
+        # update metadata store, dropbox follows in the background
+        # after the operations queued before
+        now = time()
+        self.dropbox_api.store.add(path, True, 0, now, now)
+        self.dropbox_api.batcher.mkdir(path, (True, 0, now, now))
 
         if path not in self.files:
-            self.files[path] = new_dir
+            self.files[path] = {}
 
     def object_delete(self, path):
 
         if path in self.files:
             del self.files[path] # delete object from dict
 
+    def local_file(self, path):
+
+        # file object of a file created locally and not uploaded yet
+        fileObject = self.files.get(path)
+        if fileObject is not None and fileObject.get('local'):
+            return fileObject
+        return None
+
+    def pending_bytes(self):
+
+        # bytes written locally but not uploaded yet
+        pending = 0
+        for path, fileObject in self.files.items():
+            if not fileObject.get('modified'):
+                continue
+            size = max(os.fstat(fileObject['object'].fileno()).st_size,
+                       fileObject['buffer'].end())
+            node = self.dropbox_api.store.lookup(path)
+            if node is not None and not node.is_dir:
+                size -= node.size
+            pending += size
+        return pending
+
     def restrictFile(self, path):
 
         # distinguish between dropbox file and local "restricted" file
         # stops a file being synchronised based on its extension
         fileName, fileExtension = os.path.splitext(path)
-        if fileExtension not in self.extensions:
-            return False
-        else:
+        if fileExtension in self.extensions:
             return True
+        name = os.path.basename(path)
+        return any(name.startswith(prefix) for prefix in self.prefixes)
 
     # Filesystem methods
     # ==================
     
     def statfs(self, path):
 
-        acc_info = self.dropbox_api.get_account_info()
-        total_quota = acc_info['quota_info']['quota']
-        used_quota = acc_info['quota_info']['shared'] + acc_info['quota_info']['normal']
-        available = total_quota - used_quota
+        # cached quota, counting writes which haven't been uploaded yet
+        total_quota, used_quota = self.quota.get()
+        used_quota += self.pending_bytes()
+        available = max(total_quota - used_quota, 0)
+        block_size = 4096
 
-        statfs_data = { "f_bsize": 1,       # file system block size
-                        "f_frsize": 1,      # fragment size
-                        "f_blocks": total_quota, # size of fs in f_frsize units
-                        "f_bfree": available,    # free blocks
-                        "f_bavail": available }  # free blocks for unprivileged users
+        statfs_data = { "f_bsize": block_size,   # file system block size
+                        "f_frsize": block_size,  # fragment size
+                        "f_blocks": total_quota // block_size, # size of fs in f_frsize units
+                        "f_bfree": available // block_size,    # free blocks
+                        "f_bavail": available // block_size }  # free blocks for unprivileged users
 
         return statfs_data
 
@@ -369,37 +974,58 @@ class DropboxFUSE(LoggingMixIn, Operations):
         """
         
         (uid, gid, pid) = fuse_get_context()
-        stat_result = { "st_mtime": time(), # modified time
-                        "st_ctime": time(), # changed time
-                        "st_atime": time(), # last access time
-                        "st_uid": uid,      # user id
+        stat_result = { "st_uid": uid,      # user id
                         "st_gid": gid }     # group id
 
         if path == '/':
             #stat_result["st_size"] = 1024 * 4 # default size should be 4K
+            stat_result['st_mtime'] = stat_result['st_ctime'] = \
+                stat_result['st_atime'] = self.mount_time
             stat_result['st_mode'] = (stat.S_IFDIR | 0755)
             stat_result['st_nlink'] = 2
+            stat_result['st_ino'] = ROOT_INO
 
         else:
-            name = str(os.path.basename(path))
             # if a restricted file at restr_path, retrieve its metadata
-            if name[name.rfind('.'):] in self.extensions:
+            if self.restrictFile(path):
 
                 restr_path = self.get_restr_path(path)
                 st = os.lstat(restr_path)
 
-                return dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime',
+                stat_result = dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime',
                      'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid'))
-
-            # get files and directories metadata from dropbox
-            objects = self.dropbox_api.list_objects(os.path.dirname(path))
-
-            if name not in objects:
+                # numbered apart from the dropbox objects
+                stat_result['st_ino'] = FOREIGN_INO | st.st_ino
+                return stat_result
+
+            # files which only exist locally so far
+            fileObject = self.local_file(path)
+            if fileObject is not None:
+                st = os.fstat(fileObject['object'].fileno())
+                stat_result['st_mode'] = (stat.S_IFREG | 0644)
+                stat_result['st_nlink'] = 1
+                stat_result['st_size'] = max(st.st_size, fileObject['buffer'].end())
+                stat_result['st_mtime'] = st.st_mtime
+                stat_result['st_ctime'] = st.st_ctime
+                stat_result['st_atime'] = st.st_atime
+                if fileObject['node'] is not None:
+                    stat_result['st_ino'] = fileObject['node'].ino
+                else:
+                    # not in the store, it needs a number all the same
+                    if 'ino' not in fileObject:
+                        fileObject['ino'] = self.dropbox_api.store.reserve_ino()
+                    stat_result['st_ino'] = fileObject['ino']
+                return stat_result
+
+            # get file or directory metadata from dropbox
+            node = self.dropbox_api.lookup(path)
+            if node is None:
                 raise FuseOSError(errno.ENOENT) # no such file or directory
 
-            elif objects[name]['type'] == 'file':
-                stat_result['st_size'] = objects[name]['size']
+            elif not node.is_dir:
+                stat_result['st_size'] = node.size
 
+                self.dropbox_api.wait_perm()
                 if path not in open('.f_perm.txt').read():
                     # file gets default permission
                     stat_result['st_mode'] = (stat.S_IFREG | 0644)
@@ -416,12 +1042,14 @@ class DropboxFUSE(LoggingMixIn, Operations):
             else:
                 # theres an issue with dropbox metadata api call
                 # it always returns 0 bytes for folder size
-                #stat_result["st_size"] = int(objects[name]['size'])
+                #stat_result["st_size"] = int(node.size)
                 stat_result['st_mode'] = (stat.S_IFDIR | 0755)
                 stat_result['st_nlink'] = 2
 
-            stat_result['st_ctime'] = stat_result['st_atime'] = objects[name]['ctime']
-            stat_result['st_mtime'] = objects[name]['mtime']
+            stat_result['st_ctime'] = stat_result['st_atime'] = node.ctime
+            stat_result['st_mtime'] = node.mtime
+            # stable inode number, reported to the kernel through use_ino
+            stat_result['st_ino'] = node.ino
 
         return stat_result
 
@@ -443,6 +1071,12 @@ class DropboxFUSE(LoggingMixIn, Operations):
         for f in objects:
             listing.append(f)
 
+        # files created locally which haven't been uploaded yet
+        for f in self.files.keys():
+            if self.local_file(f) is not None and os.path.dirname(f) == path and \
+                    os.path.basename(f) not in objects:
+                listing.append(os.path.basename(f))
+
         for f in restr_objects:
             listing.append(f)
 
@@ -450,7 +1084,8 @@ class DropboxFUSE(LoggingMixIn, Operations):
 
     def mkdir(self, path, mode):
 
-        print "creating new directory %s" % path
+        if self.log_ops:
+            fs_log.debug("creating new directory %s", path)
 
         if path in self.files:
             raise FuseOSError(errno.EEXIST) # file exists
@@ -459,19 +1094,16 @@ class DropboxFUSE(LoggingMixIn, Operations):
 
     def rmdir(self, path):
 
-        print "removing directory %s" % path
+        if self.log_ops:
+            fs_log.debug("removing directory %s", path)
 
-        self.object_delete(path)
-        try:
-            self.dropbox_api.client.file_delete(path)
-        except ErrorResponse, e:
-            print "Error %s: %s" % (e.status, e.error_msg)
+        if self.dropbox_api.lookup(path) is None:
             raise FuseOSError(errno.ENOENT) # no such dir
 
-        # update tree_contents
-        name = os.path.basename(path)
-        if os.path.dirname(path) in self.dropbox_api.tree_contents:
-            del self.dropbox_api.tree_contents[os.path.dirname(path)][name]
+        # update metadata store, dropbox follows in the background
+        self.object_delete(path)
+        self.dropbox_api.store.remove(path)
+        self.dropbox_api.batcher.delete(path)
 
     def unlink(self, path):
 
@@ -482,21 +1114,30 @@ class DropboxFUSE(LoggingMixIn, Operations):
         restricted = self.restrictFile(path)
         if not restricted:
 
-            print "removing dropbox file %s" % path
-            self.object_delete(path)
-            try:
-                self.dropbox_api.client.file_delete(path)
-            except ErrorResponse, e:
-                print "Error %s: %s" % (e.status, e.error_msg)
+            if self.log_ops:
+                fs_log.debug("removing dropbox file %s", path)
+            if self.local_file(path) is not None:
+                # never uploaded, there's nothing to delete remotely
+                fileObject = self.files.pop(path)
+                fileObject['map'].reset()
+                fileObject['object'].close()
+                self.dropbox_api.store.remove(path)
+                return
+
+            node = self.dropbox_api.lookup(path)
+            if node is None:
                 raise FuseOSError(errno.ENOENT) # no such file
 
-            # update tree_contents
-            name = os.path.basename(path)
-            del self.dropbox_api.tree_contents[os.path.dirname(path)][name]
+            # update metadata store and quota, dropbox follows in the background
+            self.object_delete(path)
+            self.dropbox_api.store.remove(path)
+            self.dropbox_api.batcher.delete(path)
+            self.quota.adjust(-node.size)
 
         else:
             restr_path = self.get_restr_path(path)
-            print "removing file %s" % restr_path
+            if self.log_ops:
+                fs_log.debug("removing file %s", restr_path)
             os.unlink(restr_path)
 
     def rename(self, oldFile, newFile):
@@ -505,35 +1146,32 @@ class DropboxFUSE(LoggingMixIn, Operations):
             raise FuseOSError(errno.EEXIST) # file exists
 
         restricted = self.restrictFile(oldFile)
-        response = {}
         if not restricted:
-            print "renaming: " + oldFile + " to " + newFile
+            if self.log_ops:
+                fs_log.debug("renaming: %s to %s", oldFile, newFile)
+            if self.local_file(oldFile) is not None:
+                # never uploaded, it will be uploaded under its new name
+                self.file_rename(oldFile, newFile)
+                self.dropbox_api.store.move(oldFile, newFile)
+                return
+
+            node = self.dropbox_api.lookup(oldFile)
+            if node is None:
+                raise FuseOSError(errno.ENOENT) # no such file or dir
+
+            # update metadata store, cached descendants move along,
+            # dropbox follows in the background
             self.file_rename(oldFile, newFile)
-            try:
-                response = self.dropbox_api.client.file_move(oldFile, newFile)
-            except ErrorResponse, e:
-                print "Error %s: %s" % (e.status, e.error_msg)
-                if e.status == 404:
-                    raise FuseOSError(errno.ENOENT) # no such file or dir
-
-            # update tree_contents
-            name = os.path.basename(oldFile)
-
-            ftype =self.dropbox_api.tree_contents[os.path.dirname(oldFile)][name]['type']
-            fsize =self.dropbox_api.tree_contents[os.path.dirname(oldFile)][name]['size']
-
-            del self.dropbox_api.tree_contents[os.path.dirname(oldFile)][name]
-
-            name = os.path.basename(newFile)
-            if os.path.dirname(newFile) in self.dropbox_api.tree_contents:
-                self.dropbox_api.tree_contents[os.path.dirname(newFile)][name] = \
-                {'name': name, 'type': ftype, 'size': fsize, 'ctime': time(), 'mtime': time()}
+            entry = (node.is_dir, node.size, node.ctime, time())
+            self.dropbox_api.store.move(oldFile, newFile)
+            self.dropbox_api.batcher.move(oldFile, newFile, entry)
 
         else:
             old_file = self.get_restr_path(oldFile)
             restr_dir = os.path.join(os.getcwd(), self.restr_dir)
             new_file = os.path.join(restr_dir, newFile[1:])
-            print "renaming: " + old_file + " to " + new_file
+            if self.log_ops:
+                fs_log.debug("renaming: %s to %s", old_file, new_file)
             self.file_rename(old_file, new_file)
             os.rename(old_file, new_file)
 
@@ -547,12 +1185,16 @@ class DropboxFUSE(LoggingMixIn, Operations):
             # get octal value for file current permission
             st_mode_oct = oct(st_mode & 0777)
 
-            try:
-                perm = self.dropbox_api.client.get_file('/.f_perm.txt')
-                perm_contents = perm.read()
-                perm.close()
-            except ErrorResponse, e:
-                print "Error %s: %s" % (e.status, e.error_msg)
+            # the local copy is kept up to date, dropbox's is only
+            # needed when there's none yet
+            perm_contents = ''
+            if not os.path.isfile('.f_perm.txt'):
+                try:
+                    perm = self.dropbox_api.client.get_file('/.f_perm.txt')
+                    perm_contents = perm.read()
+                    perm.close()
+                except ErrorResponse, e:
+                    api_log.warning("Error %s: %s", e.status, e.error_msg)
 
             if not os.path.isfile('.f_perm.txt') and perm_contents == '':
                 f_perm = open('.f_perm.txt', 'a+')
@@ -573,7 +1215,7 @@ class DropboxFUSE(LoggingMixIn, Operations):
                     if st_mode != 33188:
                         f_perm.write("%s    %s    %s\n" % (path, st_mode, st_mode_oct))
                         f_perm.close()
-                        self.dropbox_api.upload_f_perm()
+                        self.dropbox_api.batcher.upload_perms()
 
                 else:
                     # remove the entry & write fresh value
@@ -585,13 +1227,101 @@ class DropboxFUSE(LoggingMixIn, Operations):
                             if p != path:
                                 f.write(line)
                         f.write("%s    %s    %s\n" % (path, st_mode, st_mode_oct))
-                    self.dropbox_api.upload_f_perm()
+                    self.dropbox_api.batcher.upload_perms()
 
         else:
             # restricted file
             restr_path = self.get_restr_path(path)
             return os.chmod(restr_path, mode) 
 
+    def getxattr(self, path, name, position=0):
+
+        # the kernel asks for security.capability before every write,
+        # attributes of ours are told apart before anything else is done
+        if not name.startswith('user.cloudfuse.'):
+            raise FuseOSError(errno.ENODATA) # no such attribute
+        # expose the listing ttl learned for a directory, for debugging
+        if name == 'user.cloudfuse.ttl':
+            ttl = self.dropbox_api.store.ttl(path)
+            if ttl is not None:
+                return '%d' % ttl
+        # and the request queues of each priority class on the root
+        scheduler = self.dropbox_api.scheduler
+        if name == 'user.cloudfuse.io' and path == '/' and scheduler is not None:
+            metrics = scheduler.metrics()
+            return ''.join('%s queued=%d max_queued=%d running=%d requests=%d '
+                           'avg_wait=%.1fms max_wait=%.1fms\n' % (
+                               cls, m['queued'], m['max_queued'], m['running'],
+                               m['requests'], m['avg_wait'] * 1000, m['max_wait'] * 1000)
+                           for cls, m in ((cls, metrics[cls]) for cls in CLASSES))
+        # and the bandwidth limits in force
+        limit = self.bandwidth_limit(path, name)
+        if limit is not None:
+            return limit.spec
+        raise FuseOSError(errno.ENODATA) # no such attribute
+
+    def setxattr(self, path, name, value, options, position=0):
+
+        # bandwidth limits can be changed while mounted, e.g.
+        # setfattr -n user.cloudfuse.upload_limit -v 256K MNTDIR
+        limit = self.bandwidth_limit(path, name)
+        if limit is None:
+            raise FuseOSError(errno.ENOTSUP)
+        try:
+            limit.set(value.strip())
+        except ValueError:
+            raise FuseOSError(errno.EINVAL)
+        fs_log.info("%s set to %s", name, limit.spec)
+        return 0
+
+    def listxattr(self, path):
+
+        names = []
+        if self.dropbox_api.store.ttl(path) is not None:
+            names.append('user.cloudfuse.ttl')
+        if path == '/' and self.dropbox_api.scheduler is not None:
+            names.append('user.cloudfuse.io')
+        if path == '/':
+            names.extend('user.cloudfuse.%s_limit' % d for d in sorted(BANDWIDTH_LIMITS))
+        return names
+
+    def bandwidth_limit(self, path, name):
+
+        # Throttle behind a user.cloudfuse.*_limit attribute of the root
+        prefix, suffix = 'user.cloudfuse.', '_limit'
+        if path != '/' or not name.startswith(prefix) or not name.endswith(suffix):
+            return None
+        direction = BANDWIDTH_LIMITS.get(name[len(prefix):-len(suffix)])
+        if direction is None:
+            return None
+        return self.dropbox_api.bandwidth.limits[direction]
+
+    def init(self, path):
+
+        # the filesystem is mounted, connect to dropbox in the background
+        # and send what was left in the journal last time
+        self.dropbox_api.start()
+        self.dropbox_api.batcher.replay()
+        if self.trace_control:
+            ControlFile(self.trace_control, tracer, SamplingProfiler()).start()
+
+    def destroy(self, path):
+
+        # send the metadata operations still queued, those dropbox can't
+        # be reached for wait in the journal for the next mount
+        if not self.dropbox_api.batcher.flush():
+            fs_log.warning("Dropbox unreachable, queued operations are sent on the next mount")
+
+        # and upload new files still waiting for their deferred upload
+        with self.deferred_cond:
+            deferred = list(self.deferred)
+            self.deferred.clear()
+        for due, fileObject in deferred:
+            self.deferred_close(fileObject)
+        with self.deferred_cond:
+            if self.deferred:
+                fs_log.warning("Dropbox unreachable, %d files are not uploaded", len(self.deferred))
+
     """ Unsupported operations. The system doesn't fit within this model """
         
     def chown(self, path, uid, gid):
@@ -619,11 +1349,23 @@ class DropboxFUSE(LoggingMixIn, Operations):
         """
         restricted = self.restrictFile(path)
         if not restricted:
-            print "opening file %s" % path
-            self.file_get(path)
+            if self.log_ops:
+                fs_log.debug("opening file %s", path)
+            if flags & os.O_TRUNC:
+                # the old contents are discarded, don't fetch them
+                self.truncate(path, 0)
+            elif flags & ACCESS_MODES == os.O_WRONLY and not flags & os.O_APPEND:
+                # the contents can't be read through this handle, only
+                # fetch them if a write or truncate ends up needing them
+                self.file_get(path, download='lazy')
+            else:
+                self.file_get(path)
+            # opened again, the upload is up to the next release
+            self.files[path]['released'] = False
         else:
             restr_path = self.get_restr_path(path)
-            print "opening file %s" % restr_path
+            if self.log_ops:
+                fs_log.debug("opening file %s", restr_path)
             self.file_get(restr_path, download=None)
 
         return 0
@@ -632,39 +1374,69 @@ class DropboxFUSE(LoggingMixIn, Operations):
 
         restricted = self.restrictFile(path)
         if not restricted:
-            print "reading file %s" % path
-
-            f = self.file_get(path)['object']
+            if self.log_ops:
+                fs_log.debug("reading file %s", path)
+
+            # only wait for the part being read to arrive
+            fileObject = self.file_get(path)
+            if fileObject.get('stale'):
+                self.file_download(path, fileObject, wait=False)
+            if fileObject['buffer'].extents and fileObject['buffer'].overlaps(offset, size):
+                self.file_sync(fileObject)
+            download = fileObject.get('download')
+            f = fileObject['object']
+            if not f.closed and (download is None or download.done and download.error is None):
+                # fully cached, serve it from the shared mapping
+                return fileObject['map'].read(f, size, offset)
+            self.file_wait(fileObject, offset + size)
             if not f.closed:
                 f.seek(offset)
                 buf = f.read(size)
                 return buf
             else:
-                print "FILE WAS CLOSED"
+                fs_log.warning("%s was read after it was closed", path)
                 self.flush(path, None)
                 self.release(path, None)
 
         else:
             restr_path = self.get_restr_path(path)
-            print "reading file %s" % restr_path
+            if self.log_ops:
+                fs_log.debug("reading file %s", restr_path)
             fid = self.file_get(restr_path, download=None)['file_descriptor']
             os.lseek(fid, offset, os.SEEK_SET)
             return os.read(fid, size)
 
     def write(self, path, buf, offset, fh):
-        
+
+        # fast path, the file is open and all of it is here
+        fileObject = self.files.get(path)
+        if fileObject is not None and not fileObject['stale']:
+            download = fileObject['download']
+            if download is None or download.done and download.error is None:
+                buffer = fileObject['buffer']
+                with buffer.lock:
+                    full = buffer.write(offset, buf)
+                fileObject['modified'] = True
+                if full:
+                    self.file_sync(fileObject)
+                return len(buf)
+
         restricted = self.restrictFile(path)
         if not restricted:
-            print "writing to file %s" % path
-            fileObject = self.file_get(path) # get file object
-            f = fileObject['object']
-            f.seek(offset)  # set the file's current position
-            f.write(buf)    # write to the file
+            if self.log_ops:
+                fs_log.debug("writing to file %s", path)
+            fileObject = self.file_contents(path) # get file object
+            # buffered, it reaches the temp file along with its neighbours
+            with fileObject['buffer'].lock:
+                full = fileObject['buffer'].write(offset, buf)
             fileObject['modified'] = True
+            if full:
+                self.file_sync(fileObject)
             return len(buf) # return number of bytes written
         else:
             restr_path = self.get_restr_path(path)
-            print "writing to file %s" % restr_path
+            if self.log_ops:
+                fs_log.debug("writing to file %s", restr_path)
             fid = self.file_get(restr_path, download=None)['file_descriptor']
             os.lseek(fid, offset, os.SEEK_SET)
             return os.write(fid, buf)
@@ -674,12 +1446,31 @@ class DropboxFUSE(LoggingMixIn, Operations):
         # shrink or extend the size of a file to the specified size
         restricted = self.restrictFile(path)
         if not restricted:
-            print "truncate: " + path
-            f = self.file_get(path)['object']
-            f.truncate(length)
+            if self.log_ops:
+                fs_log.debug("truncate: %s", path)
+            unopened = path not in self.files
+            if length == 0:
+                # nothing of the old contents survives, don't fetch them
+                fileObject = self.file_get(path, download=False)
+                fileObject['stale'] = False
+                download = fileObject['download']
+                if download is not None and not download.done:
+                    # a download still running would write the old
+                    # contents past the new end
+                    download.cancel()
+            else:
+                fileObject = self.file_contents(path)
+            self.file_sync(fileObject)
+            fileObject['map'].truncate(fileObject['object'], length)
+            fileObject['hasher'].truncate(length)
+            fileObject['modified'] = True
+            if unopened:
+                # no release may follow, upload it unless it's opened
+                self.defer_upload(fileObject)
         else:
             restr_path = self.get_restr_path(path)
-            print "truncate: " + restr_path
+            if self.log_ops:
+                fs_log.debug("truncate: %s", restr_path)
             fid = self.file_get(restr_path, download=None)['file_descriptor']
             os.ftruncate(fid, length)
 
@@ -690,35 +1481,30 @@ class DropboxFUSE(LoggingMixIn, Operations):
 
         if restricted == False:
 
-            print "create: " + path
-            # discard 'libre office' temp file creation
-            if name[:2] == '.~':
-                return 0
-            # discard 'vim' 4913 and swap files, generated when existing file gets edited
-            if name == '4913' or name[-3:] == 'swp' or name[-1:] == '~':
-                return 0
-
-            # check if the directory is in the current directory tree
-            # if it is, add the new file with the proper name and path
-            if os.path.dirname(path) in self.dropbox_api.tree_contents:
-                self.dropbox_api.tree_contents[os.path.dirname(path)][name] = \
-                {'name': name, 'type': 'file', 'size': 0, 'ctime': time(), 'mtime': time()}
-            
+            if self.log_ops:
+                fs_log.debug("create: %s", path)
+            # the new file stays local until it's first flushed, so it
+            # costs a single upload with its actual contents
+            node = self.dropbox_api.store.add(path, False, 0, time(), time(), parents=True)
+
             fileObject = self.file_get(path, download=False) # get file object
             f = fileObject['object']
             f.seek(0) # set the file's current position
             fileObject['modified'] = True # file is modified
+            fileObject['local'] = True # not on dropbox yet
+            fileObject['node'] = node
 
-            self.file_upload(path)
-
-        elif name[0] != '.' and restricted == True:
+        elif restricted == True and (name[0] != '.' or
+                                     any(name.startswith(p) for p in self.prefixes)):
 
             # create dir where restricted file will be saved
             self.create_restr_dir()
-            print "creating restricted file %s" % path
+            if self.log_ops:
+                fs_log.debug("creating restricted file %s", path)
 
             restr_path = self.get_restr_path(path)
-            print "create: " + restr_path
+            if self.log_ops:
+                fs_log.debug("create: %s", restr_path)
             fileObject = self.file_get(restr_path, download=None)
 
         return 0
@@ -727,11 +1513,13 @@ class DropboxFUSE(LoggingMixIn, Operations):
 
         restricted = self.restrictFile(path)
         if not restricted:
-            print "release: " + path
+            if self.log_ops:
+                fs_log.debug("release: %s", path)
             self.file_close(path)
         else:
             restr_path = self.get_restr_path(path)
-            print "release: " + restr_path
+            if self.log_ops:
+                fs_log.debug("release: %s", restr_path)
             fid = self.file_get(restr_path, download=None)['file_descriptor']
             del self.restr_files[restr_path]
             os.close(fid)
@@ -741,13 +1529,18 @@ class DropboxFUSE(LoggingMixIn, Operations):
         # called on each close
         restricted = self.restrictFile(path)
         if not restricted:
-            print "flush: " + path
+            if self.log_ops:
+                fs_log.debug("flush: %s", path)
+            if self.local_file(path) is not None and self.save_delay:
+                # new files are uploaded after they're released
+                return
             if path in self.files:
                 if self.files[path]['modified'] == True:
                     self.file_upload(path)
         else:
             restr_path = self.get_restr_path(path)
-            print "flush: " + restr_path
+            if self.log_ops:
+                fs_log.debug("flush: %s", restr_path)
             fid = self.file_get(restr_path, download=None)['file_descriptor']
             os.fsync(fid)
 
@@ -756,13 +1549,15 @@ class DropboxFUSE(LoggingMixIn, Operations):
         # flush any dirty information about the file to disk
         restricted = self.restrictFile(path)
         if not restricted:
-            print "fsync: " + path
+            if self.log_ops:
+                fs_log.debug("fsync: %s", path)
             if path in self.files:
                 if self.files[path]['modified'] == True:
                     self.file_upload(path)
         else:
             restr_path = self.get_restr_path(path)
-            print "fsync: " + restr_path
+            if self.log_ops:
+                fs_log.debug("fsync: %s", restr_path)
             fid = self.file_get(restr_path, download=None)['file_descriptor']
             self.flush(restr_path, fid)
 
@@ -772,7 +1567,8 @@ def main():
         description='Fuse filesystem for Dropbox')
 
     parser.add_argument(
-        '-d','--debug', default=False, help="turn on fuse debug output",
+        '-d','--debug', default=False,
+        help="turn on fuse debug output and log every operation",
         action="store_true")
 
     parser.add_argument(
@@ -780,6 +1576,88 @@ def main():
         help="disallow multi-threaded operation / run on a single thread",
         action="store_true")
 
+    parser.add_argument(
+        '--max-nodes', type=int, default=1000000,
+        help="maximum number of files and folders to keep cached metadata for")
+
+    parser.add_argument(
+        '--lookup-threshold', type=int, default=5000,
+        help="stat single entries instead of listing directories this large")
+
+    parser.add_argument(
+        '--max-stale', type=float, default=0, metavar='SECONDS',
+        help="serve listings up to this long past their expiry while refreshing them")
+
+    parser.add_argument(
+        '--deadline', type=float, default=0, metavar='SECONDS',
+        help="return cached listings when a refresh takes longer than this")
+
+    parser.add_argument(
+        '--min-ttl', type=float, default=5, metavar='SECONDS',
+        help="shortest time a directory listing is cached for")
+
+    parser.add_argument(
+        '--max-ttl', type=float, default=3600, metavar='SECONDS',
+        help="longest time a directory listing is cached for")
+
+    parser.add_argument(
+        '--quota-interval', type=float, default=300, metavar='SECONDS',
+        help="how often the account quota reported by statfs is refreshed")
+
+    parser.add_argument(
+        '--save-delay', type=float, default=2, metavar='SECONDS',
+        help="wait this long after a new file is closed before uploading it")
+
+    parser.add_argument(
+        '--batch-delay', type=float, default=1, metavar='SECONDS',
+        help="collect metadata operations until none was issued for this long")
+
+    parser.add_argument(
+        '--api-rate', type=float, default=20, metavar='N',
+        help="send at most N requests a second for each kind of Dropbox call")
+
+    parser.add_argument(
+        '--api-concurrency', type=int, default=8, metavar='N',
+        help="keep at most N Dropbox requests in flight")
+
+    parser.add_argument(
+        '--hedge-budget', type=float, default=0.05, metavar='FRACTION',
+        help="resend slow listings and downloads, up to this share of extra requests")
+
+    parser.add_argument(
+        '--request-timeout', type=float, default=30, metavar='SECONDS',
+        help="fail listings and downloads which take longer than this to answer")
+
+    parser.add_argument(
+        '--upload-limit', metavar='RATE',
+        help="upload at most RATE bytes a second (K, M suffixes, "
+             "HH:MM-HH:MM=RATE for times of day, 0 for no limit)")
+
+    parser.add_argument(
+        '--download-limit', metavar='RATE',
+        help="download at most RATE bytes a second, as --upload-limit")
+
+    parser.add_argument(
+        '--bandwidth-limit', metavar='RATE',
+        help="upload and download at most RATE bytes a second together")
+
+    parser.add_argument(
+        '--journal', default='.cloudfuse-journal', metavar='FILE',
+        help="keep metadata operations not yet sent to Dropbox in FILE")
+
+    parser.add_argument(
+        '--trace-control', metavar='FILE',
+        help="trace operations and sample threads while FILE exists, "
+             "the trace is saved next to it once it's removed")
+
+    parser.add_argument(
+        '--log-level', default='warning', choices=sorted(logs.LEVELS),
+        help="log messages of this level and above, -d implies debug")
+
+    parser.add_argument(
+        '--log-file', metavar='FILE',
+        help="write the log to FILE instead of stderr")
+
     parser.add_argument(
         'mount_point', metavar='MNTDIR', help='directory to mount filesystem at')
 
@@ -792,9 +1670,25 @@ def main():
     mountpoint = args.__dict__.pop('mount_point')
     restr_dir = args.__dict__.pop('restr_dir')
 
+    # options consumed by the filesystem itself, the rest are passed to fuse
+    fs_args = dict((key, args.__dict__.pop(key)) for key in
+                   ('max_nodes', 'lookup_threshold', 'max_stale', 'deadline',
+                    'min_ttl', 'max_ttl', 'quota_interval', 'save_delay',
+                    'batch_delay', 'api_rate', 'api_concurrency', 'hedge_budget',
+                    'request_timeout', 'upload_limit', 'download_limit',
+                    'bandwidth_limit', 'journal', 'trace_control'))
+
+    log_level = args.__dict__.pop('log_level')
+    log_file = args.__dict__.pop('log_file')
+    if args.debug:
+        # log every operation and its result next to fuse's own output
+        DropboxFUSE.logfile = sys.stderr
+        log_level = 'debug'
+    logs.configure(logs.LEVELS[log_level], log_file)
+
     fuse_args = args.__dict__.copy()
-    fuse = FUSE(DropboxFUSE(restr_dir), \
-            mountpoint, noatime=True, foreground=True, **fuse_args)
+    fuse = FUSE(DropboxFUSE(restr_dir, **fs_args), \
+            mountpoint, noatime=True, foreground=True, use_ino=True, **fuse_args)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,78 @@
+"""
+Dropbox content hash of a local cache file: the file is split into 4 MB
+blocks, each block is hashed with SHA-256 and the hash of the concatenated
+block digests is the content hash. ContentHasher keeps the block hashes up
+to date as writes arrive, so most of the work is already done when a file
+is about to be uploaded.
+"""
+
+import hashlib
+
+BLOCK_SIZE = 4 * 1024 * 1024
+
+def content_hash(data):
+
+    # content hash of a whole string, mostly useful for checking
+    blocks = [hashlib.sha256(data[i:i + BLOCK_SIZE]).digest()
+              for i in range(0, len(data), BLOCK_SIZE)]
+    return hashlib.sha256(''.join(blocks)).hexdigest()
+
+class ContentHasher(object):
+
+    def __init__(self, size=0):
+        self.size = size
+        # block index -> [sha256 object, bytes hashed so far] of blocks
+        # written front to back, other blocks are rehashed on demand
+        self.blocks = {}
+
+    def update(self, offset, data):
+
+        # account for data written at offset
+        end = offset + len(data)
+        pos = offset
+        while pos < end:
+            index = pos // BLOCK_SIZE
+            block_start = index * BLOCK_SIZE
+            chunk_end = min(end, block_start + BLOCK_SIZE)
+
+            block = self.blocks.get(index)
+            if pos == block_start:
+                # written from its start, if the writes cover the
+                # whole block its hash needs no read back
+                block = self.blocks[index] = [hashlib.sha256(), 0]
+            if block is not None and block[1] == pos - block_start:
+                # contiguous with what has been hashed so far
+                block[0].update(data[pos - offset:chunk_end - offset])
+                block[1] += chunk_end - pos
+            else:
+                # overwrite or gap, rehash this block when it's needed
+                self.blocks.pop(index, None)
+            pos = chunk_end
+
+        self.size = max(self.size, end)
+
+    def truncate(self, length):
+
+        # blocks hashed past the new end are no longer valid, blocks
+        # extended with zeroes are caught by hexdigest()
+        for index in self.blocks.keys():
+            if index * BLOCK_SIZE + self.blocks[index][1] > length:
+                del self.blocks[index]
+        self.size = length
+
+    def hexdigest(self, f):
+
+        """
+        Content hash of the cache file f. Blocks which weren't written
+        front to back are read back from f and hashed again.
+        """
+        digests = []
+        for index in range((self.size + BLOCK_SIZE - 1) // BLOCK_SIZE):
+            block_start = index * BLOCK_SIZE
+            length = min(BLOCK_SIZE, self.size - block_start)
+            block = self.blocks.get(index)
+            if block is None or block[1] != length:
+                f.seek(block_start)
+                block = self.blocks[index] = [hashlib.sha256(f.read(length)), length]
+            digests.append(block[0].copy().digest())
+        return hashlib.sha256(''.join(digests)).hexdigest()
@@ -0,0 +1,120 @@
+"""
+Engine running Dropbox requests for the rest of the filesystem. Callers
+submit a call and get a Future back, which they wait on or attach a
+callback to. The calls run on a pool of worker threads shared by every
+caller and started on demand up to a fixed number, so a burst of
+background requests doesn't cost a new thread per request.
+"""
+
+from collections import deque
+from threading import Condition, Thread
+from time import time
+
+class Future(object):
+
+    # result of a submitted call, set once it has run
+    def __init__(self):
+        self.cond = Condition()
+        self.finished = False
+        self.value = None
+        self.error = None
+        self.callbacks = []
+
+    def _finish(self, value, error):
+
+        with self.cond:
+            self.value = value
+            self.error = error
+            self.finished = True
+            callbacks, self.callbacks = self.callbacks, []
+            self.cond.notify_all()
+        for callback in callbacks:
+            callback(self)
+
+    def set_result(self, value):
+
+        self._finish(value, None)
+
+    def set_exception(self, error):
+
+        self._finish(None, error)
+
+    def done(self):
+
+        return self.finished
+
+    def wait(self, timeout=None):
+
+        # True once the call has run, False if timeout ran out first
+        end = time() + timeout if timeout is not None else None
+        with self.cond:
+            while not self.finished:
+                if end is None:
+                    self.cond.wait()
+                else:
+                    remaining = end - time()
+                    if remaining <= 0:
+                        return False
+                    self.cond.wait(remaining)
+            return True
+
+    def result(self):
+
+        # the call's return value, or its exception raised again
+        self.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def add_done_callback(self, callback):
+
+        # callback(future) runs on the worker which finished the call,
+        # or right away if it has already run
+        with self.cond:
+            if not self.finished:
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+class Engine(object):
+
+    def __init__(self, max_workers=32):
+        # workers are kept once started, a timed wait would have them
+        # polling while idle
+        self.max_workers = max_workers
+        self.cond = Condition()
+        self.queue = deque()
+        self.workers = 0
+        self.idle = 0
+
+    def _worker(self):
+
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.idle += 1
+                    self.cond.wait()
+                    self.idle -= 1
+                future, func, args, kwargs = self.queue.popleft()
+
+            try:
+                value = func(*args, **kwargs)
+            except Exception, e:
+                future.set_exception(e)
+            else:
+                future.set_result(value)
+
+    def submit(self, func, *args, **kwargs):
+
+        # run func(*args, **kwargs) on a worker, returns its Future
+        future = Future()
+        with self.cond:
+            self.queue.append((future, func, args, kwargs))
+            if self.idle:
+                self.cond.notify()
+            if self.idle < len(self.queue) and self.workers < self.max_workers:
+                self.workers += 1
+                thread = Thread(target=self._worker)
+                thread.daemon = True
+                thread.start()
+        return future
@@ -278,6 +278,32 @@ def set_st_attrs(st, attrs):
             setattr(st, key, val)
 
 
+# c_stat structures already filled in for recently seen attributes, so
+# answering getattr again is a single memmove
+_stat_templates = {}
+_STAT_TEMPLATES_MAX = 10000
+
+def stat_template(attrs):
+    """Returns a c_stat holding attrs, shared between equal attributes.
+       It must not be modified."""
+    try:
+        key = tuple(attrs.iteritems())
+        template = _stat_templates.get(key)
+    except TypeError:   # unhashable values
+        key = template = None
+    if template is None:
+        template = c_stat()
+        set_st_attrs(template, attrs)
+        if key is not None:
+            if len(_stat_templates) >= _STAT_TEMPLATES_MAX:
+                _stat_templates.clear()
+            _stat_templates[key] = template
+    return template
+
+def fill_stat(buf, attrs):
+    memmove(buf, addressof(stat_template(attrs)), sizeof(c_stat))
+
+
 def fuse_get_context():
     """Returns a (uid, gid, pid) tuple"""
     ctxp = _libfuse.fuse_get_context()
@@ -316,17 +342,92 @@ class FUSE(object):
         args.append(mountpoint)
         argv = (c_char_p * len(args))(*args)
 
-        fuse_ops = fuse_operations()
-        for name, prototype in fuse_operations._fields_:
-            if prototype != c_voidp and getattr(operations, name, None):
-                op = partial(self._wrapper_, getattr(self, name))
-                setattr(fuse_ops, name, prototype(op))
+        fuse_ops = self._build_ops_()
         err = _libfuse.fuse_main_real(len(args), argv, pointer(fuse_ops),
             sizeof(fuse_ops), None)
         del self.operations     # Invoke the destructor
         if err:
             raise RuntimeError(err)
 
+    def _build_ops_(self, fast=True):
+        """Returns the fuse_operations table. Unless the operations need
+           to see every call by name, the busiest callbacks call their
+           bound methods directly."""
+        fast_ops = {}
+        if fast and self._direct_():
+            fast_ops = self._fast_ops_()
+        fuse_ops = fuse_operations()
+        for name, prototype in fuse_operations._fields_:
+            if prototype != c_voidp and getattr(self.operations, name, None):
+                op = fast_ops.get(name) or partial(self._wrapper_, getattr(self, name))
+                setattr(fuse_ops, name, prototype(op))
+        return fuse_ops
+
+    def _direct_(self):
+        """Whether an operation can be called without going through the
+           operations object's __call__"""
+        if self.raw_fi:
+            return False
+        call = getattr(type(self.operations), '__call__', None)
+        call = getattr(call, 'im_func', call)
+        if call is Operations.__call__.im_func:
+            return True
+        return call is LoggingMixIn.__call__.im_func and \
+            not getattr(self.operations, 'logfile', None)
+
+    def _fast_ops_(self):
+        """Callbacks for getattr, read and write bound straight to the
+           operation methods, errors are handled as in _wrapper_. While
+           the operations' tracer is active they take the generic path."""
+        getattr_op = self.operations.getattr
+        read_op = self.operations.read
+        write_op = self.operations.write
+        tracer = getattr(self.operations, 'tracer', None)
+        slow = dict((name, partial(self._wrapper_, getattr(self, name)))
+                    for name in ('getattr', 'read', 'write'))
+
+        def getattr_cb(path, buf):
+            if tracer is not None and tracer.active:
+                return slow['getattr'](path, buf)
+            try:
+                fill_stat(buf, getattr_op(path, None))
+                return 0
+            except OSError, e:
+                return -(e.errno or EFAULT)
+            except:
+                print_exc()
+                return -EFAULT
+
+        def read_cb(path, buf, size, offset, fip):
+            if tracer is not None and tracer.active:
+                return slow['read'](path, buf, size, offset, fip)
+            try:
+                ret = read_op(path, size, offset, fip.contents.fh)
+                if not ret:
+                    return 0
+                retsize = min(len(ret), size)
+                memmove(buf, ret, retsize)
+                return retsize
+            except OSError, e:
+                return -(e.errno or EFAULT)
+            except:
+                print_exc()
+                return -EFAULT
+
+        def write_cb(path, buf, size, offset, fip):
+            if tracer is not None and tracer.active:
+                return slow['write'](path, buf, size, offset, fip)
+            try:
+                return write_op(path, string_at(buf, size), offset,
+                                fip.contents.fh) or 0
+            except OSError, e:
+                return -(e.errno or EFAULT)
+            except:
+                print_exc()
+                return -EFAULT
+
+        return {'getattr': getattr_cb, 'read': read_cb, 'write': write_cb}
+
     def _wrapper_(self, func, *args, **kwargs):
         """Decorator for the methods that follow"""
         try:
@@ -394,9 +495,10 @@ class FUSE(object):
         ret = self.operations('read', path, size, offset, fh)
         if not ret:
             return 0
-        data = create_string_buffer(ret[:size], size)
-        memmove(buf, data, size)
-        return size
+        # copy straight from the returned string into the kernel's buffer
+        retsize = min(len(ret), size)
+        memmove(buf, ret, retsize)
+        return retsize
 
     def write(self, path, buf, size, offset, fip):
         data = string_at(buf, size)
@@ -463,8 +565,7 @@ class FUSE(object):
             else:
                 name, attrs, offset = item
                 if attrs:
-                    st = c_stat()
-                    set_st_attrs(st, attrs)
+                    st = stat_template(attrs)
                 else:
                     st = None
             if filler(buf, name, st, offset) != 0:
@@ -501,11 +602,9 @@ class FUSE(object):
         return self.operations('truncate', path, length, fh)
 
     def fgetattr(self, path, buf, fip):
-        memset(buf, 0, sizeof(c_stat))
-        st = buf.contents
         fh = fip and (fip.contents if self.raw_fi else fip.contents.fh)
         attrs = self.operations('getattr', path, fh)
-        set_st_attrs(st, attrs)
+        fill_stat(buf, attrs)
         return 0
 
     def lock(self, path, fip, cmd, lock):
@@ -670,10 +769,20 @@ class Operations(object):
 
 class LoggingMixIn:
     logfile = None
-    
+    # an object with an 'active' flag and a span(name, category, **args)
+    # context manager, each operation is traced while it's active
+    tracer = None
+
     def __call__(self, op, path, *args):
+        tracer = self.tracer
+        if tracer is not None and tracer.active:
+            with tracer.span(op, 'fuse', path=path):
+                return self._logged_call_(op, path, *args)
+        return self._logged_call_(op, path, *args)
+
+    def _logged_call_(self, op, path, *args):
         if self.logfile:
-            print '->', op, path, repr(args)
+            print >> self.logfile, '->', op, path, repr(args)
         ret = '[Unhandled Exception]'
         try:
             ret = getattr(self, op)(path, *args)
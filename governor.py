@@ -0,0 +1,130 @@
+"""
+Central governor for Dropbox API calls. Every call takes a token from the
+bucket of its endpoint class and a slot from a bounded pool of concurrent
+requests. Calls turned down for exceeding the rate limit are retried after
+the delay the server asks for, or with exponential backoff and jitter, so
+bulk work runs close to the allowed rate instead of collapsing into a
+storm of errors.
+"""
+
+import random
+from threading import BoundedSemaphore, Lock
+from time import time, sleep
+
+from logs import get_logger
+
+log = get_logger('api')
+
+# client method -> endpoint class sharing a rate limit
+ENDPOINT_CLASSES = {
+    'metadata': 'metadata', 'account_info': 'metadata', 'delta': 'metadata',
+    'search': 'metadata', 'revisions': 'metadata', 'media': 'metadata',
+    'get_file': 'content', 'get_file_and_metadata': 'content',
+    'thumbnail': 'content', 'put_file': 'content',
+    'file_delete': 'write', 'file_move': 'write', 'file_copy': 'write',
+    'file_create_folder': 'write', 'restore': 'write',
+}
+
+# statuses with which dropbox turns down a request for going too fast
+RATE_LIMITED = (429, 503)
+
+class TokenBucket(object):
+
+    # allows rate calls a second on average, and bursts of up to burst
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else rate)
+        self.tokens = self.burst
+        self.stamp = time()
+        self.lock = Lock()
+
+    def acquire(self, tokens=1):
+
+        # take tokens, sleeping until they're available
+        while True:
+            with self.lock:
+                now = time()
+                self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            sleep(wait)
+
+    def pause(self, seconds):
+
+        # the server asked for a break, hand out nothing for a while
+        with self.lock:
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+def retry_after(error):
+
+    # seconds asked for by a Retry-After header, None if there's none
+    headers = getattr(error, 'headers', None) or {}
+    if not hasattr(headers, 'items'):
+        headers = dict(headers)
+    for name, value in headers.items():
+        if name.lower() == 'retry-after':
+            try:
+                return max(0, float(value))
+            except ValueError:
+                return None
+    return None
+
+class Governor(object):
+
+    def __init__(self, client, rate=20, max_concurrent=8, max_retries=5,
+                 base_delay=0.5, max_delay=60):
+        self.client = client
+        # one bucket per endpoint class, each allowing bursts of 2 seconds
+        self.buckets = {}
+        for name in set(ENDPOINT_CLASSES.values()) | set(['other']):
+            self.buckets[name] = TokenBucket(rate, rate * 2)
+        self.slots = BoundedSemaphore(max_concurrent)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff(self, attempt, error):
+
+        # the server's Retry-After if given, otherwise exponential
+        # backoff with full jitter
+        delay = retry_after(error)
+        if delay is None:
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return min(delay, self.max_delay)
+
+    def call(self, name, method, *args, **kwargs):
+
+        bucket = self.buckets[ENDPOINT_CLASSES.get(name, 'other')]
+        # uploads are retried from where their file object stood
+        offsets = [(a, a.tell()) for a in args if hasattr(a, 'seek') and hasattr(a, 'tell')]
+        attempt = 0
+        while True:
+            bucket.acquire()
+            with self.slots:
+                try:
+                    return method(*args, **kwargs)
+                except Exception, e:
+                    if getattr(e, 'status', None) not in RATE_LIMITED or \
+                            attempt >= self.max_retries:
+                        raise
+            delay = self.backoff(attempt, e)
+            log.warning("%s rate limited, retrying in %.1fs", name, delay)
+            bucket.pause(delay)
+            sleep(delay)
+            for f, offset in offsets:
+                f.seek(offset)
+            attempt += 1
+
+    def __getattr__(self, name):
+
+        # wrap the client's methods, pass its other attributes through
+        attr = getattr(self.client, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            return self.call(name, attr, *args, **kwargs)
+        return call
@@ -0,0 +1,173 @@
+"""
+Deadlines and hedging for read-only Dropbox calls. The latency of every
+endpoint is tracked, and a listing, metadata or download request still
+running past the 95th percentile of its endpoint is sent a second time,
+the first answer to come back wins. Hedges are limited to a small share of
+all requests, so a slow server is never hit with twice the load. No call
+waits longer than its deadline.
+"""
+
+import socket
+from collections import deque
+from threading import Condition, Lock
+from time import time
+
+from engine import Engine
+from logs import get_logger
+
+log = get_logger('api')
+
+# calls which can safely be sent twice
+HEDGEABLE = ('metadata', 'account_info', 'get_file', 'get_file_and_metadata',
+             'thumbnail', 'media', 'search', 'revisions')
+
+class LatencyTracker(object):
+
+    # recent latencies of each endpoint
+    def __init__(self, window=200, min_samples=20):
+        self.window = window
+        self.min_samples = min_samples
+        self.samples = {}
+        self.lock = Lock()
+
+    def record(self, name, seconds):
+
+        with self.lock:
+            samples = self.samples.get(name)
+            if samples is None:
+                samples = self.samples[name] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def percentile(self, name, fraction=0.95):
+
+        # None until enough calls have been seen
+        with self.lock:
+            samples = self.samples.get(name)
+            if samples is None or len(samples) < self.min_samples:
+                return None
+            ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+class HedgedCall(object):
+
+    def __init__(self, name, tracker):
+        self.name = name
+        self.tracker = tracker
+        self.cond = Condition()
+        self.attempts = 0
+        self.failed = []
+        self.answered = False
+        self.result = None
+        self.abandoned = False
+
+    def finish(self, start, result, error):
+
+        # one of the copies of the call has returned
+        with self.cond:
+            if error is None:
+                self.tracker.record(self.name, time() - start)
+                if not self.answered and not self.abandoned:
+                    self.answered = True
+                    self.result = result
+                    self.cond.notify_all()
+                    return
+                # lost the race or gave up on, an open download
+                # response still holds its connection
+                close = getattr(result, 'close', None)
+                if close is not None:
+                    close()
+                return
+            self.failed.append(error)
+            self.cond.notify_all()
+
+    def wait(self, timeout):
+
+        # True once an answer is in or every attempt failed
+        end = time() + timeout if timeout is not None else None
+        with self.cond:
+            while not self.answered and len(self.failed) < self.attempts:
+                if end is not None:
+                    remaining = end - time()
+                    if remaining <= 0:
+                        return False
+                    self.cond.wait(remaining)
+                else:
+                    self.cond.wait()
+            return True
+
+class HedgedClient(object):
+
+    def __init__(self, client, budget=0.05, deadline=30, tracker=None, engine=None):
+        self.client = client
+        # runs the copies of each call, the caller only waits
+        self.engine = engine or Engine()
+        # hedges allowed, as a share of all read-only calls
+        self.budget = budget
+        # seconds a read-only call may take before it fails, 0 for none
+        self.deadline = deadline
+        self.tracker = tracker or LatencyTracker()
+        self.lock = Lock()
+        self.calls = 0
+        self.hedges = 0
+
+    def allow_hedge(self):
+
+        with self.lock:
+            if self.hedges + 1 > self.budget * self.calls:
+                return False
+            self.hedges += 1
+            return True
+
+    def attempt(self, call, method, args, kwargs):
+
+        with call.cond:
+            call.attempts += 1
+        start = time()
+        future = self.engine.submit(method, *args, **kwargs)
+        future.add_done_callback(lambda f: call.finish(start, f.value, f.error))
+
+    def call(self, name, method, *args, **kwargs):
+
+        with self.lock:
+            self.calls += 1
+            if self.calls > 100000:
+                # forget old history, keep the ratio
+                self.calls //= 2
+                self.hedges //= 2
+
+        delay = self.tracker.percentile(name) if self.budget else None
+        if delay is None and not self.deadline:
+            # nothing to hedge against or bound, call it in place
+            start = time()
+            result = method(*args, **kwargs)
+            self.tracker.record(name, time() - start)
+            return result
+
+        call = HedgedCall(name, self.tracker)
+        start = time()
+        self.attempt(call, method, args, kwargs)
+        if delay is not None and not call.wait(delay) and self.allow_hedge():
+            log.debug("%s %s slower than %.3fs, hedging", name, args[:1], delay)
+            self.attempt(call, method, args, kwargs)
+
+        remaining = None
+        if self.deadline:
+            remaining = max(0, self.deadline - (time() - start))
+        if not call.wait(remaining):
+            with call.cond:
+                call.abandoned = True
+                if not call.answered:
+                    raise socket.timeout('%s exceeded its %ss deadline' % (name, self.deadline))
+        if not call.answered:
+            raise call.failed[0]
+        return call.result
+
+    def __getattr__(self, name):
+
+        attr = getattr(self.client, name)
+        if not callable(attr) or name not in HEDGEABLE:
+            return attr
+
+        def call(*args, **kwargs):
+            return self.call(name, attr, *args, **kwargs)
+        return call
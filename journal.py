@@ -0,0 +1,117 @@
+"""
+Write-ahead journal of the metadata operations queued for Dropbox. Each
+operation is appended and synced to disk before it's acknowledged, and
+marked done once Dropbox has it, so the operations still pending when the
+process dies or the filesystem is unmounted are replayed, in order, on the
+next mount. The journal is one JSON record a line and starts over whenever
+nothing is pending.
+"""
+
+import json
+import os
+from threading import Lock
+
+from logs import get_logger
+
+log = get_logger('batch')
+
+def _str(value):
+
+    # json hands strings back as unicode, the rest of the code uses str
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+class Journal(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.seq = 0
+        self.f = None
+
+    def _open(self):
+
+        if self.f is None:
+            self.f = open(self.path, 'a+b')
+            # end a record cut short by a crash, so it's only one line lost
+            self.f.seek(0, os.SEEK_END)
+            if self.f.tell():
+                self.f.seek(-1, os.SEEK_END)
+                last = self.f.read(1)
+                self.f.seek(0, os.SEEK_END)
+                if last != '\n':
+                    self.f.write('\n')
+
+    def _write(self, record, sync):
+
+        self._open()
+        self.f.write(json.dumps(record) + '\n')
+        self.f.flush()
+        if sync:
+            os.fsync(self.f.fileno())
+
+    def load(self):
+
+        """
+        Operations recorded but never marked done, in the order they were
+        recorded, as (seq, kind, path, new, entry) tuples.
+        """
+        pending = {}
+        order = []
+        with self.lock:
+            try:
+                f = open(self.path, 'rb')
+            except IOError:
+                return []
+            with f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # the last line of a crash may be cut short
+                        log.warning("Skipping damaged journal record in %s", self.path)
+                        continue
+                    if 'done' in record:
+                        pending.pop(record['done'], None)
+                    else:
+                        pending[record['seq']] = record
+                        order.append(record['seq'])
+                    self.seq = max(self.seq, record.get('seq', record.get('done')))
+        ops = []
+        for seq in order:
+            record = pending.get(seq)
+            if record is not None:
+                entry = record.get('entry')
+                ops.append((seq, _str(record['kind']), _str(record['path']),
+                            _str(record.get('new')), tuple(entry) if entry else None))
+        return ops
+
+    def append(self, kind, path, new=None, entry=None):
+
+        # record an operation, on disk once this returns, returns its seq
+        with self.lock:
+            self.seq += 1
+            record = {'seq': self.seq, 'kind': kind, 'path': path}
+            if new is not None:
+                record['new'] = new
+            if entry is not None:
+                record['entry'] = list(entry)
+            self._write(record, True)
+            return self.seq
+
+    def done(self, seq):
+
+        # not synced, losing it only means sending the operation again
+        with self.lock:
+            self._write({'done': seq}, False)
+
+    def reset(self):
+
+        # nothing is pending, start an empty journal
+        with self.lock:
+            if self.f is not None:
+                self.f.close()
+                self.f = None
+            with open(self.path, 'wb') as f:
+                os.fsync(f.fileno())
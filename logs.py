@@ -0,0 +1,155 @@
+"""
+Logging for the filesystem. Every subsystem logs through its own logger
+below 'cloudfuse', records are written out by a background thread so a
+slow terminal or disk never holds up a FUSE operation, and bursts of the
+same warning or error are rate limited. Messages are formatted lazily,
+only once a record is actually written.
+"""
+
+import logging
+import sys
+import threading
+from collections import deque
+from time import time
+
+LEVELS = {'debug': logging.DEBUG, 'info': logging.INFO,
+          'warning': logging.WARNING, 'error': logging.ERROR}
+
+FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+# nothing is written until configure() is called
+logging.getLogger('cloudfuse').addHandler(logging.NullHandler())
+
+def get_logger(subsystem):
+
+    # 'fs', 'api', 'transfer', 'batch', ...
+    return logging.getLogger('cloudfuse.' + subsystem)
+
+class RateLimitFilter(logging.Filter):
+
+    """
+    Let through at most burst warnings or errors with the same message
+    per interval seconds. The next one let through says how many were
+    dropped in between. Lower levels are not limited.
+    """
+    def __init__(self, burst=10, interval=60):
+        logging.Filter.__init__(self)
+        self.burst = burst
+        self.interval = interval
+        self.lock = threading.Lock()
+        # (logger, message) -> [start of the window, records seen in it]
+        self.windows = {}
+
+    def filter(self, record):
+
+        if record.levelno < logging.WARNING:
+            return True
+        key = (record.name, record.msg)
+        now = time()
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                if len(self.windows) >= 10000:
+                    self.windows.clear()
+                self.windows[key] = [now, 1]
+                if window is not None and window[1] > self.burst:
+                    record.msg = '%s (%d similar messages suppressed)' % (
+                        record.msg, window[1] - self.burst)
+                return True
+            window[1] += 1
+            return window[1] <= self.burst
+
+class AsyncHandler(logging.Handler):
+
+    """
+    Queue records for target, a handler run by a background thread.
+    Records arriving while capacity records are queued are dropped and
+    counted instead of blocking the caller.
+    """
+    def __init__(self, target, capacity=10000):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.capacity = capacity
+        self.queue = deque()
+        self.cond = threading.Condition()
+        self.busy = False
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._writer)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def emit(self, record):
+
+        with self.cond:
+            if len(self.queue) >= self.capacity:
+                self.dropped += 1
+                return
+            self.queue.append(record)
+            if len(self.queue) == 1:
+                # the writer only sleeps on an empty queue
+                self.cond.notify_all()
+
+    def _writer(self):
+
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                records = list(self.queue)
+                self.queue.clear()
+                dropped, self.dropped = self.dropped, 0
+                self.busy = True
+            if dropped:
+                self.target.handle(logging.makeLogRecord({
+                    'name': 'cloudfuse', 'levelno': logging.WARNING,
+                    'levelname': 'WARNING',
+                    'msg': '%d log messages dropped' % dropped}))
+            for record in records:
+                self.target.handle(record)
+            self.target.flush()
+            with self.cond:
+                self.busy = False
+                self.cond.notify_all()
+
+    def flush(self):
+
+        # wait for everything queued so far to be written
+        with self.cond:
+            while self.queue or self.busy:
+                self.cond.wait()
+
+    def close(self):
+
+        self.flush()
+        self.target.close()
+        logging.Handler.close(self)
+
+def configure(level=logging.WARNING, filename=None, background=True):
+
+    """
+    Send the filesystem's log records at level and above to filename,
+    or to stderr, through a rate limit and, unless background is False,
+    a background writer thread.
+    """
+    if filename:
+        handler = logging.FileHandler(filename)
+    else:
+        handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter(FORMAT))
+    if background:
+        handler = AsyncHandler(handler)
+    handler.addFilter(RateLimitFilter())
+
+    # the format doesn't show where a message came from or which process
+    # sent it, don't walk the stack and look them up for every record
+    logging._srcfile = None
+    logging.logProcesses = 0
+    logging.logMultiprocessing = 0
+
+    root = logging.getLogger('cloudfuse')
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level)
+    root.propagate = False
+    return root
@@ -0,0 +1,452 @@
+"""
+Compact in-memory store for Dropbox file and folder metadata. Every object is
+kept as a Node with a stable inode number and a pointer to its parent, so a
+path is resolved by walking its components and renaming a directory only
+re-links a single node, whatever the size of the subtree below it.
+"""
+
+from calendar import timegm
+from collections import OrderedDict
+from threading import RLock
+from time import time
+
+ROOT_INO = 1
+
+# inode numbers from here up are left to files kept outside the store,
+# the store itself never counts that far
+FOREIGN_INO = 1 << 62
+
+MONTHS = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+          'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12}
+
+# parsed 'modified' strings, a listing usually holds few distinct ones
+_timestamps = {}
+_TIMESTAMPS_MAX = 100000
+
+def parse_timestamp(modified):
+
+    """
+    Convert a Dropbox RFC 2822 date such as 'Sat, 21 Aug 2010 22:31:20 +0000'
+    into a Unix timestamp. Results are memoized per distinct string.
+    """
+    try:
+        return _timestamps[modified]
+    except KeyError:
+        pass
+
+    if not modified:
+        return int(time())
+
+    # 'Sat,' '21' 'Aug' '2010' '22:31:20' '+0000'
+    parts = modified.split()
+    hh, mm, ss = parts[4].split(':')
+    stamp = timegm((int(parts[3]), MONTHS[parts[2]], int(parts[1]),
+                    int(hh), int(mm), int(ss), 0, 0, 0))
+    if len(parts) > 5 and parts[5] not in ('+0000', '-0000'):
+        tz = parts[5]
+        offset = int(tz[1:3]) * 3600 + int(tz[3:5]) * 60
+        stamp = stamp - offset if tz[0] == '+' else stamp + offset
+
+    if len(_timestamps) >= _TIMESTAMPS_MAX:
+        _timestamps.clear()
+    _timestamps[modified] = stamp
+    return stamp
+
+def ingest(contents):
+
+    """
+    Turn the 'contents' of a metadata() response into the
+    (name, is_dir, size, ctime, mtime) tuples taken by set_listing.
+    """
+    parse = parse_timestamp
+    entries = []
+    append = entries.append
+    for child in contents:
+        # utf8 encoding will handle special characters
+        name = child['path'].rsplit('/', 1)[-1].encode('utf8')
+        stamp = parse(child['modified'])
+        append((name, child['is_dir'], child['bytes'], stamp, stamp))
+    return entries
+
+class Node(object):
+
+    # __slots__ keeps a node to a handful of pointers instead of a full
+    # per-instance dict, which matters once millions of entries are cached
+    __slots__ = ('ino', 'name', 'parent', 'is_dir', 'size', 'ctime', 'mtime',
+                 'children', 'expires', 'hash')
+
+    def __init__(self, ino, name, parent, is_dir, size=0, ctime=0, mtime=0):
+        self.ino = ino
+        self.name = name
+        self.parent = parent
+        self.is_dir = is_dir
+        self.size = size
+        self.ctime = ctime
+        self.mtime = mtime
+        # child name -> Node, directories only
+        self.children = {} if is_dir else None
+        # time until which the children form a complete listing
+        self.expires = 0
+        # content hash of the remote file, if known
+        self.hash = None
+
+class MetadataStore(object):
+
+    def __init__(self, max_nodes=1000000, min_ttl=5, max_ttl=3600):
+        self.max_nodes = max_nodes
+        # bounds of the per-directory listing ttls
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.lock = RLock()
+        self.root = Node(ROOT_INO, '', None, True)
+        self.inodes = {ROOT_INO: self.root}
+        self.next_ino = ROOT_INO + 1
+        # listed directories, least recently used first
+        self.listed = OrderedDict()
+        # number of entries seen at the last listing of each directory,
+        # kept when the listing itself is evicted
+        self.counts = {}
+        # current listing ttl of each directory, learned from how often
+        # its refreshed listing actually differed
+        self.ttls = {}
+        # inode -> expiry of objects looked up on their own, whose parent
+        # listing is not necessarily cached, oldest first
+        self.singles = OrderedDict()
+        self.max_singles = 100000
+
+    # Helper functions
+    # ================
+
+    def _split(self, path):
+
+        # '/a/b/c' -> ['a', 'b', 'c'], '/' -> []
+        return [p for p in path.split('/') if p]
+
+    def _new_node(self, name, parent, is_dir, size, ctime, mtime):
+
+        # interned names are shared between all nodes with the same name
+        node = Node(self.next_ino, intern(name), parent, is_dir, size, ctime, mtime)
+        self.next_ino += 1
+        self.inodes[node.ino] = node
+        return node
+
+    def _forget(self, node):
+
+        # drop a node and everything below it from the inode table
+        stack = [node]
+        while stack:
+            n = stack.pop()
+            self.inodes.pop(n.ino, None)
+            self.singles.pop(n.ino, None)
+            if n.is_dir:
+                self.listed.pop(n.ino, None)
+                self.counts.pop(n.ino, None)
+                self.ttls.pop(n.ino, None)
+                stack.extend(n.children.itervalues())
+
+    def _forget_children(self, node):
+
+        for child in node.children.itervalues():
+            self._forget(child)
+        node.children = {}
+        node.expires = 0
+        self.listed.pop(node.ino, None)
+
+    def _touch(self, node):
+
+        # mark a listing as recently used, the root listing is never evicted
+        if node is not self.root:
+            self.listed.pop(node.ino, None)
+            self.listed[node.ino] = node
+
+    def _touch_parents(self, node):
+
+        # objects cached outside a complete listing are evicted along
+        # with the children of their parents, which are marked used from
+        # the top down so the closest parent is dropped first
+        parents = []
+        node = node.parent
+        while node is not None and node is not self.root:
+            parents.append(node)
+            node = node.parent
+        for parent in reversed(parents):
+            self._touch(parent)
+
+    def _drop_single(self):
+
+        # forget the oldest single entry, unless a listing holds it
+        ino, expires = self.singles.popitem(last=False)
+        node = self.inodes.get(ino)
+        if node is not None and node.parent is not None and not node.parent.expires:
+            del node.parent.children[node.name]
+            self._forget(node)
+
+    def _evict(self, keep=None):
+
+        # drop the oldest single entries, then the coldest listings, until
+        # the store fits its budget again. keep, the node just stored, and
+        # its parents are never dropped, without it the most recently used
+        # listing is kept
+        while len(self.inodes) > self.max_nodes and self.singles:
+            self._drop_single()
+        if len(self.inodes) <= self.max_nodes or not self.listed:
+            return
+        if keep is None:
+            keep = self.listed[next(reversed(self.listed))]
+        kept = set()
+        while keep is not None:
+            kept.add(keep.ino)
+            keep = keep.parent
+        skipped = []
+        while len(self.inodes) > self.max_nodes and self.listed:
+            ino, node = self.listed.popitem(last=False)
+            if ino in kept:
+                skipped.append(node)
+            else:
+                self._forget_children(node)
+        for node in skipped:
+            self.listed[node.ino] = node
+
+    def _adapt_ttl(self, ttl, changed):
+
+        # back off exponentially while a directory stays the same,
+        # tighten quickly once it starts changing
+        if changed:
+            return ttl / 4.0
+        return ttl * 2.0
+
+    def _ensure_dir(self, path):
+
+        # return the node for path, creating unknown intermediate
+        # directories along the way
+        node = self.root
+        for name in self._split(path):
+            child = node.children.get(name)
+            if child is None:
+                child = self._new_node(name, node, True, 0, 0, 0)
+                node.children[child.name] = child
+            elif not child.is_dir:
+                return None
+            node = child
+        return node
+
+    # Public interface
+    # ================
+
+    def lookup(self, path):
+
+        with self.lock:
+            node = self.root
+            for name in self._split(path):
+                if not node.is_dir:
+                    return None
+                node = node.children.get(name)
+                if node is None:
+                    return None
+            return node
+
+    def reserve_ino(self):
+
+        # inode number for an object the store doesn't hold
+        with self.lock:
+            self.next_ino += 1
+            return self.next_ino - 1
+
+    def get(self, ino):
+
+        return self.inodes.get(ino)
+
+    def path(self, node):
+
+        # rebuild the full path of a node from its parent pointers
+        names = []
+        while node.parent is not None:
+            names.append(node.name)
+            node = node.parent
+        return '/' + '/'.join(reversed(names))
+
+    def listing(self, path, max_stale=0):
+
+        # children of path if its listing is complete and expired
+        # no longer than max_stale seconds ago
+        with self.lock:
+            node = self.lookup(path)
+            if node is None or not node.is_dir or not node.expires:
+                return None
+            if node.expires + max_stale < time():
+                return None
+            self._touch(node)
+            return node.children
+
+    def set_listing(self, path, entries, ttl):
+
+        """
+        Replace the children of path with entries, a sequence of
+        (name, is_dir, size, ctime, mtime) tuples. Nodes which are still
+        present keep their inode numbers and their cached subtrees.
+        """
+        with self.lock:
+            node = self._ensure_dir(path)
+            if node is None:
+                return {}
+
+            # the old dict is left untouched, callers may still be
+            # iterating over a stale listing
+            old = node.children
+            complete = node.expires != 0
+            changed = False
+            children = {}
+            for name, is_dir, size, ctime, mtime in entries:
+                child = old.get(name)
+                if child is not None and child.is_dir != is_dir:
+                    self._forget(child)
+                    child = None
+                if child is None:
+                    child = self._new_node(name, node, is_dir, size, ctime, mtime)
+                    changed = True
+                elif child.size != size or child.mtime != mtime:
+                    child.size, child.ctime, child.mtime = size, ctime, mtime
+                    child.hash = None
+                    changed = True
+                children[child.name] = child
+
+            # whatever is left has disappeared remotely
+            for name, child in old.iteritems():
+                if children.get(name) is not child:
+                    self._forget(child)
+                    changed = True
+
+            # only a refresh of a complete listing tells whether it changed
+            ttl = self.ttls.get(node.ino, ttl)
+            if complete:
+                ttl = self._adapt_ttl(ttl, changed)
+            ttl = min(max(ttl, self.min_ttl), self.max_ttl)
+            self.ttls[node.ino] = ttl
+
+            node.children = children
+            node.expires = time() + ttl
+            self.counts[node.ino] = len(children)
+            self._touch(node)
+            self._evict(node)
+            return node.children
+
+    def count(self, path):
+
+        # number of entries in path when it was last listed, None if unknown
+        node = self.lookup(path)
+        if node is None or not node.is_dir:
+            return None
+        return self.counts.get(node.ino)
+
+    def ttl(self, path):
+
+        # listing ttl currently chosen for path, None if never listed
+        node = self.lookup(path)
+        if node is None or not node.is_dir:
+            return None
+        return self.ttls.get(node.ino)
+
+    def entry(self, path):
+
+        # an object looked up on its own, if its metadata is still fresh
+        with self.lock:
+            if not self.singles:
+                return None
+            node = self.lookup(path)
+            if node is None:
+                return None
+            expires = self.singles.get(node.ino)
+            if expires is None:
+                return None
+            if expires < time():
+                del self.singles[node.ino]
+                return None
+            return node
+
+    def set_entry(self, path, is_dir, size, ctime, mtime, ttl):
+
+        # cache a single object without listing its parent
+        with self.lock:
+            node = self.add(path, is_dir, size, ctime, mtime, parents=True)
+            if node is None:
+                return None
+            self.singles.pop(node.ino, None)
+            while len(self.singles) >= self.max_singles:
+                self._drop_single()
+            self.singles[node.ino] = time() + ttl
+            return node
+
+    def invalidate(self, path):
+
+        # force the next listing of path to be fetched again
+        with self.lock:
+            node = self.lookup(path)
+            if node is not None and node.is_dir:
+                node.expires = 0
+
+    def add(self, path, is_dir, size, ctime, mtime, parents=False):
+
+        # only record the object if its parent directory is already known,
+        # unless asked to create unknown parents
+        with self.lock:
+            if parents:
+                parent = self._ensure_dir(path.rsplit('/', 1)[0] or '/')
+            else:
+                parent = self.lookup(path.rsplit('/', 1)[0] or '/')
+            if parent is None or not parent.is_dir:
+                return None
+            name = path.rsplit('/', 1)[1]
+            child = parent.children.get(name)
+            if child is not None and child.is_dir == is_dir:
+                child.size, child.ctime, child.mtime = size, ctime, mtime
+                child.hash = None
+                if parents:
+                    self._touch_parents(child)
+                return child
+            if child is not None:
+                self._forget(child)
+            child = self._new_node(name, parent, is_dir, size, ctime, mtime)
+            parent.children[child.name] = child
+            if parents:
+                self._touch_parents(child)
+            self._evict(child)
+            return child
+
+    def remove(self, path):
+
+        with self.lock:
+            node = self.lookup(path)
+            if node is None or node is self.root:
+                return None
+            del node.parent.children[node.name]
+            self._forget(node)
+            return node
+
+    def move(self, old, new):
+
+        """
+        Move the object at old, including any cached subtree, to new.
+        The node keeps its inode number, so this is O(1) in the size of
+        the subtree unless the destination directory is not cached.
+        """
+        with self.lock:
+            node = self.lookup(old)
+            if node is None or node is self.root:
+                return None
+            del node.parent.children[node.name]
+
+            parent = self.lookup(new.rsplit('/', 1)[0] or '/')
+            if parent is None or not parent.is_dir:
+                # nowhere to attach it, it will be listed again on demand
+                self._forget(node)
+                return None
+
+            name = intern(new.rsplit('/', 1)[1])
+            target = parent.children.get(name)
+            if target is not None:
+                self._forget(target)
+            node.name = name
+            node.parent = parent
+            node.ctime = time()
+            parent.children[name] = node
+            return node
@@ -0,0 +1,268 @@
+"""
+Profiling hooks for a live mount. The tracer records a span for every
+FUSE operation along with the cache lookups and Dropbox API calls made
+while serving it, the sampling profiler records the stacks of all other
+threads at a fixed interval. Both are off until switched on, and can be
+exported as Chrome trace JSON (chrome://tracing, Perfetto) for offline
+analysis.
+"""
+
+import json
+import os
+import sys
+import threading
+from collections import deque
+from time import time, strftime, sleep
+
+from logs import get_logger
+
+log = get_logger('profiler')
+
+class NullSpan(object):
+
+    # returned while tracing is off, entering and leaving it costs nothing
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_SPAN = NullSpan()
+
+class Span(object):
+
+    __slots__ = ('tracer', 'name', 'cat', 'args', 'start', 'id', 'parent')
+
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.tracer._push(self)
+        self.start = time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time()
+        if exc_type is not None:
+            self.args['error'] = str(exc)
+        self.tracer._pop(self, end)
+        return False
+
+class Tracer(object):
+
+    def __init__(self, max_events=200000):
+        self.active = False
+        # finished spans, the oldest are dropped past max_events
+        self.events = deque(maxlen=max_events)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.next_id = 1
+
+    # Helper functions
+    # ================
+
+    def _push(self, span):
+
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        with self.lock:
+            span.id = self.next_id
+            self.next_id += 1
+        span.parent = stack[-1].id if stack else None
+        stack.append(span)
+
+    def _pop(self, span, end):
+
+        stack = self.local.stack
+        if stack and stack[-1] is span:
+            stack.pop()
+        args = span.args
+        args['id'] = span.id
+        if span.parent is not None:
+            args['parent'] = span.parent
+        self.events.append({'name': span.name, 'cat': span.cat, 'ph': 'X',
+                            'ts': span.start * 1e6, 'dur': (end - span.start) * 1e6,
+                            'pid': os.getpid(), 'tid': threading.current_thread().ident,
+                            'args': args})
+
+    # Public interface
+    # ================
+
+    def span(self, name, cat, **args):
+
+        # context manager timing a unit of work, nested spans on the same
+        # thread are linked to it as their parent
+        if not self.active:
+            return NULL_SPAN
+        return Span(self, name, cat, args)
+
+    def instant(self, name, cat, **args):
+
+        # a point event such as a cache hit, linked to the current span
+        if not self.active:
+            return
+        stack = getattr(self.local, 'stack', None)
+        if stack:
+            args['parent'] = stack[-1].id
+        self.events.append({'name': name, 'cat': cat, 'ph': 'i', 's': 't',
+                            'ts': time() * 1e6, 'pid': os.getpid(),
+                            'tid': threading.current_thread().ident, 'args': args})
+
+    def start(self):
+
+        self.events.clear()
+        self.active = True
+
+    def stop(self):
+
+        self.active = False
+
+class SamplingProfiler(object):
+
+    def __init__(self, interval=0.005, max_samples=200000):
+        self.interval = interval
+        self.active = False
+        self.thread = None
+        # (ts, tid, stack frame id) of every sample taken
+        self.samples = deque(maxlen=max_samples)
+        # (parent id, function) -> id, and the Chrome trace stackFrames
+        self.frame_ids = {}
+        self.frames = {}
+
+    def _frame_id(self, frame):
+
+        # intern a stack, outermost function first
+        calls = []
+        while frame is not None:
+            code = frame.f_code
+            calls.append((code.co_filename, code.co_firstlineno, code.co_name))
+            frame = frame.f_back
+        parent = None
+        for filename, line, name in reversed(calls):
+            key = (parent, filename, line, name)
+            frame_id = self.frame_ids.get(key)
+            if frame_id is None:
+                frame_id = self.frame_ids[key] = str(len(self.frame_ids) + 1)
+                entry = {'name': '%s %s:%d' % (name, os.path.basename(filename), line),
+                         'category': 'python'}
+                if parent is not None:
+                    entry['parent'] = parent
+                self.frames[frame_id] = entry
+            parent = frame_id
+        return parent
+
+    def _sampler(self):
+
+        me = threading.current_thread().ident
+        while self.active:
+            now = time() * 1e6
+            for tid, frame in sys._current_frames().items():
+                if tid != me:
+                    self.samples.append((now, tid, self._frame_id(frame)))
+            sleep(self.interval)
+        self.thread = None
+
+    def start(self):
+
+        if self.active:
+            return
+        self.samples.clear()
+        self.frame_ids.clear()
+        self.frames.clear()
+        self.active = True
+        self.thread = threading.Thread(target=self._sampler)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+
+        self.active = False
+        thread = self.thread
+        if thread is not None:
+            thread.join()
+
+class TracedClient(object):
+
+    # wraps a DropboxClient, recording each call as an 'api' span
+    def __init__(self, client, tracer):
+        self.client = client
+        self.tracer = tracer
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr):
+            return attr
+        tracer = self.tracer
+
+        def call(*args, **kwargs):
+            if not tracer.active:
+                return attr(*args, **kwargs)
+            with tracer.span(name, 'api', path=args[0] if args else None):
+                return attr(*args, **kwargs)
+        return call
+
+def export(path, tracer=None, profiler=None):
+
+    """
+    Write the spans of tracer and the samples of profiler to path as
+    Chrome trace JSON.
+    """
+    trace = {'traceEvents': list(tracer.events) if tracer else [],
+             'displayTimeUnit': 'ms'}
+    if profiler is not None:
+        trace['stackFrames'] = profiler.frames
+        trace['samples'] = [{'cpu': 0, 'tid': tid, 'ts': ts, 'name': 'sample',
+                             'sf': sf, 'weight': 1}
+                            for ts, tid, sf in profiler.samples if sf is not None]
+    f = open(path, 'w')
+    try:
+        json.dump(trace, f)
+    finally:
+        f.close()
+    return path
+
+class ControlFile(object):
+
+    """
+    Switch tracing and sampling on while the control file exists. Once
+    it is removed both stop, and what they recorded is written next to it
+    as <control file>-<pid>-<date>.json.
+    """
+    def __init__(self, path, tracer, profiler, poll=1):
+        self.path = os.path.abspath(path)
+        self.tracer = tracer
+        self.profiler = profiler
+        self.poll = poll
+        self.thread = threading.Thread(target=self._watch)
+        self.thread.daemon = True
+
+    def start(self):
+
+        self.thread.start()
+
+    def _watch(self):
+
+        running = False
+        while True:
+            exists = os.path.exists(self.path)
+            if exists and not running:
+                self.tracer.start()
+                self.profiler.start()
+                running = True
+            elif running and not exists:
+                self.tracer.stop()
+                self.profiler.stop()
+                running = False
+                out = '%s-%d-%s.json' % (self.path, os.getpid(), strftime('%Y%m%d-%H%M%S'))
+                try:
+                    log.warning("Trace written to %s", export(out, self.tracer, self.profiler))
+                except (IOError, OSError), e:
+                    log.error("Failed to write trace %s: %s", out, e)
+            sleep(self.poll)
+
+# shared by the filesystem, the api wrapper and the background workers
+tracer = Tracer()
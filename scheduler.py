@@ -0,0 +1,160 @@
+"""
+Priority scheduling of Dropbox API traffic. Every request belongs to a
+class, in order of priority: foreground (a FUSE operation is waiting for
+it), readahead, upload and sync. A request is only started once no
+request of a higher class is waiting, and each background class has its
+own concurrency limit, so an interactive ls or cat never queues behind a
+large upload or a tree prefetch. Queue depth and wait time are kept per
+class.
+"""
+
+import threading
+from collections import deque
+from time import time
+
+CLASSES = ('foreground', 'readahead', 'upload', 'sync')
+
+# class of the requests made by the current thread, foreground unless set
+_context = threading.local()
+
+class priority(object):
+
+    """
+    Context manager running the requests made inside it as cls:
+
+        with priority('sync'):
+            client.file_delete(path)
+    """
+    def __init__(self, cls):
+        assert cls in CLASSES, cls
+        self.cls = cls
+
+    def __enter__(self):
+        self.previous = getattr(_context, 'cls', None)
+        _context.cls = self.cls
+        return self
+
+    def __exit__(self, *exc):
+        _context.cls = self.previous
+        return False
+
+def current(name=None):
+
+    # uploads are uploads wherever they come from
+    cls = getattr(_context, 'cls', None)
+    if cls is not None:
+        return cls
+    if name == 'put_file':
+        return 'upload'
+    return 'foreground'
+
+class ClassStats(object):
+
+    __slots__ = ('queued', 'max_queued', 'running', 'requests', 'waited', 'max_wait')
+
+    def __init__(self):
+        self.queued = 0
+        self.max_queued = 0
+        self.running = 0
+        self.requests = 0
+        self.waited = 0.0
+        self.max_wait = 0.0
+
+class IOScheduler(object):
+
+    def __init__(self, client, concurrency=8, limits=None):
+        self.client = client
+        # requests in flight overall
+        self.concurrency = concurrency
+        # requests in flight per class, background classes never take
+        # every slot so foreground work finds one free
+        self.limits = {'foreground': concurrency,
+                       'readahead': max(1, concurrency // 2),
+                       'upload': max(1, concurrency // 4),
+                       'sync': max(1, concurrency // 4)}
+        if limits:
+            self.limits.update(limits)
+        self.cond = threading.Condition()
+        self.running = 0
+        # tickets of waiting requests, per class in arrival order
+        self.queues = dict((cls, deque()) for cls in CLASSES)
+        self.stats = dict((cls, ClassStats()) for cls in CLASSES)
+
+    # Helper functions
+    # ================
+
+    def _runnable(self, cls, ticket):
+
+        if self.queues[cls][0] is not ticket:
+            return False
+        if self.running >= self.concurrency or \
+                self.stats[cls].running >= self.limits[cls]:
+            return False
+        # queued requests of a lower class are passed over while a
+        # higher one is waiting for a slot it could take
+        for higher in CLASSES[:CLASSES.index(cls)]:
+            if self.queues[higher] and self.stats[higher].running < self.limits[higher]:
+                return False
+        return True
+
+    def _admit(self, cls):
+
+        ticket = object()
+        stats = self.stats[cls]
+        with self.cond:
+            queue = self.queues[cls]
+            queue.append(ticket)
+            stats.queued += 1
+            stats.max_queued = max(stats.max_queued, stats.queued)
+            start = time()
+            while not self._runnable(cls, ticket):
+                self.cond.wait()
+            queue.popleft()
+            waited = time() - start
+            stats.queued -= 1
+            stats.requests += 1
+            stats.waited += waited
+            stats.max_wait = max(stats.max_wait, waited)
+            stats.running += 1
+            self.running += 1
+            # the next one in this queue may be able to start too
+            self.cond.notify_all()
+
+    def _release(self, cls):
+
+        with self.cond:
+            self.stats[cls].running -= 1
+            self.running -= 1
+            self.cond.notify_all()
+
+    # Public interface
+    # ================
+
+    def call(self, name, method, *args, **kwargs):
+
+        cls = current(name)
+        self._admit(cls)
+        try:
+            return method(*args, **kwargs)
+        finally:
+            self._release(cls)
+
+    def metrics(self):
+
+        # per class: requests waiting, in flight, served, and wait times
+        with self.cond:
+            return dict((cls, {'queued': s.queued, 'max_queued': s.max_queued,
+                               'running': s.running, 'requests': s.requests,
+                               'avg_wait': s.waited / s.requests if s.requests else 0.0,
+                               'max_wait': s.max_wait})
+                        for cls, s in self.stats.items())
+
+    def __getattr__(self, name):
+
+        attr = getattr(self.client, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            return self.call(name, attr, *args, **kwargs)
+        return call
@@ -0,0 +1,218 @@
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from batcher import OperationBatcher
+from journal import Journal
+from metadata_store import MetadataStore
+
+"""
+Unit tests for the delete/move batcher, with a fake client recording the
+calls that would have gone to Dropbox.
+"""
+
+class FakeError(Exception):
+
+    def __init__(self, status):
+        Exception.__init__(self, status)
+        self.status = status
+
+class FakeClient(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def file_delete(self, path):
+        self.calls.append(('delete', path))
+
+    def file_move(self, old, new):
+        self.calls.append(('move', old, new))
+
+    def file_create_folder(self, path):
+        self.calls.append(('mkdir', path))
+
+class FakeAPI(object):
+
+    def __init__(self):
+        self.client = FakeClient()
+        self.store = MetadataStore()
+
+    def upload_f_perm(self):
+        self.client.calls.append(('perm',))
+
+class OperationBatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+
+        self.api = FakeAPI()
+        # a long delay, operations only go out when flushed
+        self.batcher = OperationBatcher(self.api, delay=60)
+
+    def test_collapse_subtree(self):
+
+        for i in range(100):
+            self.batcher.delete('/build/obj/f%d.o' % i)
+        self.batcher.delete('/build/obj')
+        self.batcher.delete('/build')
+        self.batcher.delete('/builder.txt')
+        self.assertEqual(len(self.batcher.queue), 2)
+        self.batcher.flush()
+        self.assertEqual(sorted(self.api.client.calls),
+                         [('delete', '/build'), ('delete', '/builder.txt')])
+        self.assertFalse(self.batcher.hides('/build'))
+
+    def test_moves_keep_order(self):
+
+        self.batcher.delete('/a/x')
+        self.batcher.move('/a/y', '/a/z', (False, 3, 0, 0))
+        # the move separates the delete from the folder delete
+        self.batcher.delete('/a')
+        self.batcher.flush()
+        self.assertEqual(self.api.client.calls,
+                         [('delete', '/a/x'), ('move', '/a/y', '/a/z'), ('delete', '/a')])
+
+    def test_overlay(self):
+
+        self.batcher.delete('/docs/old.txt')
+        self.batcher.delete('/gone')
+        self.batcher.move('/docs/a.txt', '/docs/b.txt', (False, 3, 1, 1))
+        entries = [('old.txt', False, 1, 1, 1), ('a.txt', False, 3, 1, 1),
+                   ('keep.txt', False, 2, 1, 1)]
+        self.assertEqual(sorted(self.batcher.overlay('/docs', entries)),
+                         [('b.txt', False, 3, 1, 1), ('keep.txt', False, 2, 1, 1)])
+        self.assertEqual(self.batcher.overlay('/gone/sub', entries), [])
+        self.assertTrue(self.batcher.hides('/gone/sub/x'))
+        self.assertEqual(self.batcher.pending_entry('/docs/b.txt'), (False, 3, 1, 1))
+        self.batcher.flush()
+        self.assertEqual(self.batcher.overlay('/docs', entries), entries)
+
+    def test_recreated(self):
+
+        # rm -rf build && mkdir build
+        self.batcher.delete('/build')
+        self.batcher.mkdir('/build', (True, 0, 2, 2))
+        entries = [('build', True, 0, 1, 1), ('other', False, 1, 1, 1)]
+        self.assertFalse(self.batcher.hides('/build'))
+        self.assertTrue(self.batcher.hides('/build/old.o'))
+        self.assertEqual(self.batcher.pending_entry('/build'), (True, 0, 2, 2))
+        self.assertEqual(sorted(self.batcher.overlay('/', entries)),
+                         [('build', True, 0, 2, 2), ('other', False, 1, 1, 1)])
+        self.assertEqual(self.batcher.overlay('/build', [('old.o', False, 1, 1, 1)]), [])
+
+        # and deleted again
+        self.batcher.delete('/build')
+        self.assertTrue(self.batcher.hides('/build'))
+        self.assertEqual(self.batcher.pending_entry('/build'), None)
+
+    def test_moved_back(self):
+
+        # mv x y && mv y x
+        self.batcher.move('/x', '/y', (True, 0, 1, 1))
+        self.batcher.move('/y', '/x', (True, 0, 1, 1))
+        entries = [('x', True, 0, 1, 1)]
+        self.assertFalse(self.batcher.hides('/x'))
+        self.assertFalse(self.batcher.hides('/x/child'))
+        self.assertTrue(self.batcher.hides('/y'))
+        self.assertEqual(self.batcher.overlay('/', entries), entries)
+        self.batcher.flush()
+        self.assertEqual(self.batcher.hidden, {})
+        self.assertEqual(self.batcher.added, {})
+
+    def test_conflict(self):
+
+        def fail(old, new):
+            raise FakeError(409)
+        self.api.client.file_move = fail
+        self.api.store.set_listing('/', [('x', False, 1, 1, 1)], 60)
+        self.batcher.move('/x', '/y', (False, 1, 1, 1))
+        self.assertTrue(self.batcher.flush())
+        # the parent is listed again to pick up what dropbox really has
+        self.assertTrue(self.api.store.listing('/') is None)
+        self.assertEqual(self.batcher.pending_entry('/y'), None)
+
+    def test_error(self):
+
+        # an error that isn't about the network isn't retried forever,
+        # holding up everything queued after it
+        def fail(path):
+            raise TypeError('bug')
+        self.api.client.file_delete = fail
+        self.batcher.retry_delay = 0.01
+        self.batcher.delete('/x')
+        self.batcher.mkdir('/y', (True, 0, 1, 1))
+        self.assertTrue(self.batcher.flush())
+        self.assertEqual(self.api.client.calls, [('mkdir', '/y')])
+        self.assertFalse(self.batcher.hides('/x'))
+
+    def test_retry(self):
+
+        # operations failing for want of a network are kept, in order
+        failures = []
+        delete = self.api.client.file_delete
+        def flaky(path):
+            if len(failures) < 2:
+                failures.append(path)
+                raise socket.error('network down')
+            delete(path)
+        self.api.client.file_delete = flaky
+        self.batcher.retry_delay = 0.01
+        self.batcher.delete('/x')
+        self.batcher.mkdir('/y', (True, 0, 1, 1))
+        self.assertFalse(self.batcher.flush())
+        self.assertTrue(self.batcher.hides('/x'))
+        while not self.batcher.flush():
+            pass
+        self.assertEqual(failures, ['/x', '/x'])
+        self.assertEqual(self.api.client.calls, [('delete', '/x'), ('mkdir', '/y')])
+        self.assertFalse(self.batcher.hides('/x'))
+
+    def test_mkdir_and_perms(self):
+
+        self.batcher.mkdir('/new', (True, 0, 1, 1))
+        self.batcher.upload_perms()
+        self.batcher.upload_perms()
+        self.assertEqual(self.batcher.overlay('/', []), [('new', True, 0, 1, 1)])
+        self.batcher.flush()
+        self.assertEqual(self.api.client.calls, [('mkdir', '/new'), ('perm',)])
+        self.assertEqual(self.batcher.overlay('/', []), [])
+
+class JournalReplayTestCase(unittest.TestCase):
+
+    def setUp(self):
+
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'journal')
+
+    def tearDown(self):
+
+        shutil.rmtree(self.dir)
+
+    def test_replay(self):
+
+        # a crash before the operations reach dropbox
+        api = FakeAPI()
+        batcher = OperationBatcher(api, delay=60, journal=Journal(self.path))
+        batcher.mkdir('/a', (True, 0, 1, 1))
+        batcher.move('/b', '/a/b', (False, 2, 1, 1))
+        batcher.delete('/c')
+
+        # the next mount sends them in the same order
+        api = FakeAPI()
+        batcher = OperationBatcher(api, delay=60, journal=Journal(self.path))
+        self.assertEqual(batcher.replay(), 3)
+        self.assertTrue(batcher.hides('/c'))
+        self.assertEqual(batcher.pending_entry('/a/b'), (False, 2, 1, 1))
+        batcher.flush()
+        self.assertEqual(api.client.calls,
+                         [('mkdir', '/a'), ('move', '/b', '/a/b'), ('delete', '/c')])
+
+        # and nothing is left for the one after
+        batcher = OperationBatcher(FakeAPI(), delay=60, journal=Journal(self.path))
+        self.assertEqual(batcher.replay(), 0)
+
+if __name__ == '__main__':
+    unittest.main()
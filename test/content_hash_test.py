@@ -0,0 +1,79 @@
+import os
+import random
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import content_hash
+from content_hash import ContentHasher, content_hash as full_hash
+
+"""
+Unit tests for the incremental content hash, checked against hashing the
+whole file contents in one go. A small block size keeps them fast.
+"""
+
+class ContentHasherTestCase(unittest.TestCase):
+
+    def setUp(self):
+
+        self.block_size = content_hash.BLOCK_SIZE
+        content_hash.BLOCK_SIZE = 16
+        self.f = tempfile.TemporaryFile()
+
+    def tearDown(self):
+
+        content_hash.BLOCK_SIZE = self.block_size
+        self.f.close()
+
+    def write(self, hasher, offset, data):
+
+        self.f.seek(offset)
+        self.f.write(data)
+        self.f.flush()
+        hasher.update(offset, data)
+
+    def contents(self):
+
+        self.f.seek(0)
+        return self.f.read()
+
+    def test_empty(self):
+
+        hasher = ContentHasher()
+        self.assertEqual(hasher.hexdigest(self.f), full_hash(''))
+
+    def test_sequential(self):
+
+        hasher = ContentHasher()
+        for i in range(10):
+            self.write(hasher, i * 7, 'abcdefg')
+        self.assertEqual(hasher.hexdigest(self.f), full_hash(self.contents()))
+        # every block was hashed while it was written
+        self.f.close()
+        self.f = tempfile.TemporaryFile()
+        self.assertEqual(hasher.hexdigest(self.f), full_hash('abcdefg' * 10))
+
+    def test_random_writes(self):
+
+        rand = random.Random(42)
+        hasher = ContentHasher()
+        for i in range(200):
+            offset = rand.randint(0, 100)
+            self.write(hasher, offset, os.urandom(rand.randint(1, 40)))
+            if i % 50 == 0:
+                length = rand.randint(0, 120)
+                self.f.truncate(length)
+                hasher.truncate(length)
+            self.assertEqual(hasher.hexdigest(self.f), full_hash(self.contents()))
+
+    def test_existing_file(self):
+
+        self.f.write('x' * 40)
+        hasher = ContentHasher(40)
+        self.assertEqual(hasher.hexdigest(self.f), full_hash('x' * 40))
+        self.write(hasher, 16, 'y' * 16)
+        self.assertEqual(hasher.hexdigest(self.f), full_hash(self.contents()))
+
+if __name__ == '__main__':
+    unittest.main()
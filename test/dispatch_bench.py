@@ -0,0 +1,73 @@
+import os
+import sys
+from ctypes import POINTER, byref, c_byte, cast, create_string_buffer, pointer
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from fuse import FUSE, LoggingMixIn, Operations, c_stat, fuse_file_info
+
+"""
+Microbenchmark of FUSE upcalls per second through the generic dispatch
+(partial, _wrapper_, __call__ by name) and through the direct callbacks
+used when logging is off. The callbacks are called through ctypes like
+libfuse would, without mounting anything.
+"""
+
+CALLS = 200000
+
+class BenchOperations(LoggingMixIn, Operations):
+
+    def __init__(self):
+        self.data = 'x' * 4096
+
+    def getattr(self, path, fh=None):
+        return {'st_mode': 0100644, 'st_nlink': 1, 'st_size': 4096,
+                'st_mtime': 1400000000.0, 'st_ctime': 1400000000.0,
+                'st_atime': 1400000000.0, 'st_uid': 1000, 'st_gid': 1000,
+                'st_ino': 42}
+
+    def read(self, path, size, offset, fh):
+        return self.data[offset:offset + size]
+
+    def write(self, path, data, offset, fh):
+        return len(data)
+
+def operations_table(fast):
+
+    # the table FUSE would hand to libfuse, built without mounting
+    fuse = FUSE.__new__(FUSE)
+    fuse.operations = BenchOperations()
+    fuse.raw_fi = False
+    return fuse._build_ops_(fast)
+
+def bench(table):
+
+    st = c_stat()
+    buf = cast(create_string_buffer(4096), POINTER(c_byte))
+    fip = pointer(fuse_file_info())
+    results = {}
+
+    start = time()
+    for i in xrange(CALLS):
+        table.getattr('/file', byref(st))
+    results['getattr'] = CALLS / (time() - start)
+
+    start = time()
+    for i in xrange(CALLS):
+        table.read('/file', buf, 4096, 0, fip)
+    results['read'] = CALLS / (time() - start)
+
+    start = time()
+    for i in xrange(CALLS):
+        table.write('/file', buf, 4096, 0, fip)
+    results['write'] = CALLS / (time() - start)
+
+    assert st.st_size == 4096
+    return results
+
+if __name__ == '__main__':
+    before = bench(operations_table(False))
+    after = bench(operations_table(True))
+    for op in ('getattr', 'read', 'write'):
+        print "%-8s %10.0f upcalls/s before, %10.0f after (%.1fx)" % (
+            op, before[op], after[op], after[op] / before[op])
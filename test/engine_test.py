@@ -0,0 +1,69 @@
+import os
+import sys
+import threading
+import unittest
+from time import sleep
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from engine import Engine, Future
+
+"""
+Unit tests for the request engine. These don't need the Dropbox API or
+a mounted filesystem.
+"""
+
+class EngineTestCase(unittest.TestCase):
+
+    def test_result(self):
+
+        engine = Engine(2)
+        self.assertEqual(engine.submit(lambda a, b=0: a + b, 1, b=2).result(), 3)
+
+    def test_exception(self):
+
+        def fail():
+            raise OSError(5, 'Input/output error')
+        future = Engine(2).submit(fail)
+        self.assertRaises(OSError, future.result)
+        self.assertTrue(future.done())
+
+    def test_callback(self):
+
+        future = Future()
+        seen = []
+        future.add_done_callback(lambda f: seen.append(f.value))
+        future.set_result('a')
+        # added after the fact, runs right away
+        future.add_done_callback(lambda f: seen.append(f.value))
+        self.assertEqual(seen, ['a', 'a'])
+
+    def test_wait_timeout(self):
+
+        gate = threading.Event()
+        future = Engine(1).submit(gate.wait)
+        self.assertFalse(future.wait(0.05))
+        gate.set()
+        self.assertTrue(future.wait(1))
+
+    def test_bounded_workers(self):
+
+        engine = Engine(4)
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def work():
+            with lock:
+                running[0] += 1
+                running[1] = max(running[1], running[0])
+            sleep(0.01)
+            with lock:
+                running[0] -= 1
+
+        futures = [engine.submit(work) for i in range(40)]
+        for future in futures:
+            future.result()
+        self.assertEqual(engine.workers, 4)
+        self.assertTrue(running[1] <= 4)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,507 @@
+import errno
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import types
+import unittest
+from threading import Event, Thread, active_count
+from time import sleep, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+"""
+Unit tests for the file operations of DropboxFUSE, driven against a fake
+Dropbox client. These don't need the Dropbox API or a mounted filesystem,
+modules only needed to talk to either are replaced by stand-ins when they
+aren't installed.
+"""
+
+def stand_in(name, **attrs):
+
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+class ErrorResponse(Exception):
+
+    def __init__(self, status, error_msg=''):
+        Exception.__init__(self, status, error_msg)
+        self.status = status
+        self.error_msg = error_msg
+
+try:
+    import dropbox
+    from dropbox.rest import ErrorResponse
+except ImportError:
+    dropbox = stand_in('dropbox')
+    dropbox.client = stand_in('dropbox.client')
+    dropbox.rest = stand_in('dropbox.rest', ErrorResponse=ErrorResponse)
+try:
+    import urllib3
+except ImportError:
+    urllib3 = stand_in('urllib3')
+    HTTPError = type('HTTPError', (Exception,), {})
+    urllib3.exceptions = stand_in('urllib3.exceptions', HTTPError=HTTPError,
+                                  MaxRetryError=type('MaxRetryError', (HTTPError,), {}),
+                                  ReadTimeoutError=type('ReadTimeoutError', (HTTPError,), {}))
+try:
+    import config
+except ImportError:
+    stand_in('config', AppCredentials=None)
+try:
+    import fuse
+except EnvironmentError:
+    # no libfuse, only the parts the operations themselves use
+    class FuseOSError(OSError):
+        def __init__(self, errno):
+            OSError.__init__(self, errno, os.strerror(errno))
+    stand_in('fuse', FUSE=None, FuseOSError=FuseOSError, Operations=object,
+             LoggingMixIn=type('LoggingMixIn', (), {}),
+             fuse_get_context=lambda: (os.getuid(), os.getgid(), os.getpid()))
+
+from cloud_fuse import DropboxFUSE
+from fuse import FuseOSError
+
+def wait_for(condition, timeout=2):
+
+    end = time() + timeout
+    while not condition() and time() < end:
+        sleep(0.001)
+    return condition()
+
+class FakeBody(object):
+
+    # response body of a download, held after its first chunk until go is set
+    def __init__(self, data, hold=False):
+        self.data = data
+        self.offset = 0
+        self.hold = hold
+        self.go = Event()
+        self.closed = False
+
+    def read(self, size):
+        if self.hold and self.offset:
+            self.go.wait()
+        chunk = self.data[self.offset:self.offset + min(size, 4096)]
+        self.offset += len(chunk)
+        return chunk
+
+    def close(self):
+        self.closed = True
+
+class FakeClient(object):
+
+    def __init__(self):
+        self.files = {}
+        self.folders = set()
+        self.downloads = []
+        self.uploads = []
+        self.modified = {}
+        self.hold = False
+        # remote changes in the order they were made
+        self.calls = []
+        # metadata operations failing for want of a network before
+        # the next one goes through
+        self.unreachable = 0
+
+    def reach(self):
+        if self.unreachable:
+            self.unreachable -= 1
+            raise socket.error(errno.ENETUNREACH, 'network is unreachable')
+
+    def get_file(self, path):
+        if path not in self.files:
+            raise ErrorResponse(404, 'not found')
+        self.downloads.append(path)
+        self.body = FakeBody(self.files[path], self.hold)
+        return self.body
+
+    def put_file(self, path, f, overwrite=False):
+        data = f.read()
+        self.uploads.append((path, data))
+        self.calls.append(('put', path))
+        self.files[path] = data
+        self.modified[path] = 'Thu, 01 Jan 1970 00:00:02 +0000'
+        return self.metadata(path)
+
+    def account_info(self):
+        self.calls.append(('account_info',))
+        return self.account
+
+    def file_delete(self, path):
+        self.reach()
+        self.calls.append(('delete', path))
+        if self.files.pop(path, None) is None:
+            raise ErrorResponse(404, 'not found')
+
+    def file_move(self, old, new):
+        self.reach()
+        self.calls.append(('move', old, new))
+        inside = lambda p: p == old or p.startswith(old + '/')
+        for path in filter(inside, self.files.keys()):
+            self.files[new + path[len(old):]] = self.files.pop(path)
+        self.folders = set(new + p[len(old):] if inside(p) else p for p in self.folders)
+
+    def file_create_folder(self, path):
+        self.reach()
+        self.calls.append(('mkdir', path))
+        self.folders.add(path)
+
+    def metadata(self, path, list=True):
+        modified = self.modified.get(path, 'Thu, 01 Jan 1970 00:00:01 +0000')
+        if path in self.files:
+            return {'path': unicode(path), 'is_dir': False, 'bytes': len(self.files[path]),
+                    'modified': modified}
+        if path != '/' and path not in self.folders:
+            raise ErrorResponse(404, 'not found')
+        response = {'path': unicode(path), 'is_dir': True, 'bytes': 0, 'modified': modified}
+        if list:
+            children = [p for p in sorted(self.files) + sorted(self.folders)
+                        if p != '/' and p.rsplit('/', 1)[0] == path.rstrip('/')]
+            response['contents'] = [self.metadata(p, False) for p in children]
+        return response
+
+class FakeDropboxTestCase(unittest.TestCase):
+
+    # seconds new files wait for a rename or delete before they're uploaded
+    save_delay = 0
+
+    def setUp(self):
+
+        self.threads = active_count()
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        with open('dropbox_auth.conf', 'w') as f:
+            f.write('token')
+        open('.f_perm.txt', 'w').close()
+
+        self.fs = DropboxFUSE('restricted', save_delay=self.save_delay,
+                              journal=os.path.join(self.dir, 'journal'))
+        self.client = FakeClient()
+        api = self.fs.dropbox_api
+        api._client = self.client
+        api.started = True
+        api.ready.set()
+        api.perm_ready.set()
+
+        api.batcher.delay = 0
+        api.batcher.retry_delay = 0.01
+
+        self.data = os.urandom(1300 * 1024)
+        self.client.files['/doc.bin'] = self.data
+        api.store.add('/doc.bin', False, len(self.data), 1, 1)
+
+    def tearDown(self):
+
+        # let downloads wind down before the temp files go, workers
+        # which run for good aren't waited for
+        workers = [self.fs.deferred_thread, self.fs.dropbox_api.batcher.thread,
+                   self.fs.quota.thread]
+        running = lambda: active_count() - len([t for t in workers if t is not None])
+        end = time() + 1
+        while running() > self.threads and time() < end:
+            sleep(0.001)
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+class FileOperationsTestCase(FakeDropboxTestCase):
+
+    def test_read(self):
+
+        self.fs.open('/doc.bin', os.O_RDONLY)
+        self.assertEqual(self.fs.read('/doc.bin', 100, 5000, None), self.data[5000:5100])
+        self.assertEqual(self.fs.read('/doc.bin', 10 ** 7, 0, None), self.data)
+        self.fs.release('/doc.bin', None)
+        self.assertEqual(self.client.uploads, [])
+
+    def test_missing(self):
+
+        try:
+            self.fs.open('/nothing', os.O_RDONLY)
+        except FuseOSError, e:
+            self.assertEqual(e.errno, errno.ENOENT)
+        else:
+            self.fail('opened a missing file')
+
+    def test_write(self):
+
+        self.fs.open('/doc.bin', os.O_RDWR)
+        self.fs.write('/doc.bin', 'new', 10, None)
+        self.assertEqual(self.fs.read('/doc.bin', 5, 8, None), self.data[8:10] + 'new')
+        self.fs.release('/doc.bin', None)
+        self.assertEqual(self.client.uploads,
+                         [('/doc.bin', self.data[:10] + 'new' + self.data[13:])])
+
+    def test_write_only(self):
+
+        # nothing is fetched until a write needs the old contents
+        self.fs.open('/doc.bin', os.O_WRONLY)
+        self.assertEqual(self.client.downloads, [])
+        self.fs.write('/doc.bin', 'new', 0, None)
+        self.fs.release('/doc.bin', None)
+        self.assertEqual(self.client.uploads, [('/doc.bin', 'new' + self.data[3:])])
+
+    def test_truncate(self):
+
+        self.fs.open('/doc.bin', os.O_RDWR)
+        self.fs.truncate('/doc.bin', 1000)
+        self.fs.release('/doc.bin', None)
+        self.assertEqual(self.client.uploads, [('/doc.bin', self.data[:1000])])
+
+    def test_truncate_unopened(self):
+
+        # truncate(1) without an open file, no release follows it
+        self.fs.truncate('/doc.bin', 1000)
+        self.assertTrue(wait_for(lambda: self.client.uploads))
+        self.assertEqual(self.client.uploads, [('/doc.bin', self.data[:1000])])
+        self.assertTrue(wait_for(lambda: '/doc.bin' not in self.fs.files))
+
+    def test_open_truncate(self):
+
+        # the old contents are never fetched
+        self.fs.open('/doc.bin', os.O_WRONLY | os.O_TRUNC)
+        self.fs.write('/doc.bin', 'new', 0, None)
+        self.fs.release('/doc.bin', None)
+        self.assertEqual(self.client.downloads, [])
+        self.assertEqual(self.client.uploads, [('/doc.bin', 'new')])
+
+    def test_truncate_during_download(self):
+
+        # an editor opening a file, truncating and rewriting it while the
+        # old contents are still arriving
+        self.client.hold = True
+        self.fs.open('/doc.bin', os.O_RDWR)
+        body = self.client.body
+        while not body.offset:
+            sleep(0.001)
+        go = Event()
+        def truncate():
+            self.fs.truncate('/doc.bin', 0)
+            go.set()
+        thread = Thread(target=truncate)
+        thread.start()
+        # the truncate waits for the chunk being read to be written
+        self.assertFalse(go.wait(0.2))
+        body.go.set()
+        thread.join()
+        self.fs.write('/doc.bin', 'new', 0, None)
+        self.fs.release('/doc.bin', None)
+        self.assertEqual(self.client.uploads, [('/doc.bin', 'new')])
+        self.assertTrue(body.closed)
+
+    def test_lock_file(self):
+
+        # libre office lock files stay local for as long as they exist
+        path = '/.~lock.doc.odt#'
+        self.fs.create(path, 0644)
+        self.fs.write(path, 'lock', 0, None)
+        self.fs.release(path, None)
+        self.assertEqual(self.fs.getattr(path)['st_size'], 4)
+        self.fs.unlink(path)
+        self.assertEqual(self.client.uploads, [])
+        self.assertEqual(os.listdir('restricted'), [])
+
+    def test_unchanged(self):
+
+        # writing back the same bytes costs no upload
+        self.fs.open('/doc.bin', os.O_RDWR)
+        self.fs.write('/doc.bin', self.data[:100], 0, None)
+        self.fs.release('/doc.bin', None)
+        self.assertEqual(self.client.uploads, [])
+
+    def test_unchanged_unreachable(self):
+
+        # with no telling whether the remote copy changed, it's uploaded
+        metadata = self.client.metadata
+        calls = []
+        def flaky(path, list=True):
+            calls.append(path)
+            if len(calls) == 1:
+                raise socket.timeout('timed out')
+            return metadata(path, list)
+        self.fs.open('/doc.bin', os.O_RDWR)
+        self.fs.read('/doc.bin', 10, 0, None)
+        self.client.metadata = flaky
+        self.fs.write('/doc.bin', self.data[:100], 0, None)
+        self.fs.release('/doc.bin', None)
+        self.assertEqual(self.client.uploads, [('/doc.bin', self.data)])
+
+    def test_changed_elsewhere(self):
+
+        # another client changed the file since it was downloaded, our
+        # copy has to replace it even though it's what we last saw
+        self.fs.open('/doc.bin', os.O_RDWR)
+        self.fs.read('/doc.bin', 10, 0, None)
+        self.client.files['/doc.bin'] = 'theirs'
+        self.client.modified['/doc.bin'] = 'Thu, 01 Jan 1970 00:01:00 +0000'
+        self.fs.write('/doc.bin', self.data[:100], 0, None)
+        self.fs.release('/doc.bin', None)
+        self.assertEqual(self.client.uploads, [('/doc.bin', self.data)])
+
+    def test_stable_attributes(self):
+
+        # attributes of unchanged objects are equal between calls, so
+        # the stat structures filled for them can be reused
+        self.fs.create('/new.txt', 0644)
+        for path in ('/', '/new.txt'):
+            first = self.fs.getattr(path)
+            sleep(0.01)
+            self.assertEqual(self.fs.getattr(path), first)
+
+    def test_xattrs(self):
+
+        # the attribute the kernel asks for on every write isn't there,
+        # the ones of the filesystem itself are
+        for path in ('/', '/doc.bin', '/nothing'):
+            try:
+                self.fs.getxattr(path, 'security.capability')
+            except FuseOSError, e:
+                self.assertEqual(e.errno, errno.ENODATA)
+            else:
+                self.fail('found security.capability on %s' % path)
+        self.assertEqual(self.fs.getxattr('/', 'user.cloudfuse.upload_limit'), '0')
+        self.assertEqual(self.client.calls, [])
+
+    def test_upload_after_delete(self):
+
+        # a file created where one was just deleted isn't uploaded before
+        # the delete, even though that has to wait for the network
+        self.client.unreachable = 1
+        self.fs.unlink('/doc.bin')
+        self.fs.create('/doc.bin', 0644)
+        self.fs.write('/doc.bin', 'new', 0, None)
+        self.fs.release('/doc.bin', None)
+        self.assertTrue(wait_for(lambda: self.client.uploads))
+        self.assertEqual(self.client.calls, [('delete', '/doc.bin'), ('put', '/doc.bin')])
+        self.assertEqual(self.client.files['/doc.bin'], 'new')
+
+    def test_read_after_move(self):
+
+        # a file only in its new place once a queued move is done is
+        # read, and written back, after the move
+        self.fs.dropbox_api.batcher.delay = 60
+        self.client.folders.add('/a')
+        self.client.files['/a/f'] = 'old'
+        self.fs.rename('/a', '/b')
+        self.fs.open('/b/f', os.O_RDWR)
+        self.assertEqual(self.fs.read('/b/f', 3, 0, None), 'old')
+        self.fs.write('/b/f', 'new', 0, None)
+        self.fs.release('/b/f', None)
+        self.assertEqual(self.client.calls, [('move', '/a', '/b'), ('put', '/b/f')])
+
+    def test_inode_numbers(self):
+
+        # files without a node in the store still have inode numbers of
+        # their own, or cp and diff take them for the same file
+        for path in ('/a.log', '/b.log', '/new.txt', '/other.txt'):
+            self.fs.create(path, 0644)
+        self.fs.files['/other.txt']['node'] = None
+        inodes = [self.fs.getattr(path).get('st_ino')
+                  for path in ('/', '/doc.bin', '/a.log', '/b.log', '/new.txt', '/other.txt')]
+        self.assertTrue(all(inodes), inodes)
+        self.assertEqual(len(set(inodes)), len(inodes))
+        self.assertEqual(self.fs.getattr('/other.txt')['st_ino'], inodes[-1])
+
+    def test_lookup_unreachable(self):
+
+        # a single-entry lookup timing out is an I/O error, not a crash
+        def timeout(path, list=True):
+            raise socket.timeout('timed out')
+        api = self.fs.dropbox_api
+        api.store.set_listing('/', [('doc.bin', False, len(self.data), 1, 1)], 60)
+        api.store.invalidate('/')
+        api.lookup_threshold = 1
+        self.client.metadata = timeout
+        try:
+            self.fs.getattr('/other.bin')
+        except FuseOSError, e:
+            self.assertEqual(e.errno, errno.EIO)
+        else:
+            self.fail('looked up an object without dropbox')
+
+class QuotaTestCase(FakeDropboxTestCase):
+
+    def setUp(self):
+
+        FakeDropboxTestCase.setUp(self)
+        self.quota = 10 * 1024 ** 3
+        self.used = 1000 * 4096
+        # the answer account_info() gave when the token was checked
+        self.client.account = self.fs.dropbox_api.account = \
+            {'quota_info': {'quota': self.quota, 'shared': 4096, 'normal': self.used - 4096}}
+
+    def test_statfs(self):
+
+        # sizes come in blocks, the first call reuses the account info
+        st = self.fs.statfs('/')
+        self.assertEqual(st['f_bsize'], 4096)
+        self.assertEqual(st['f_frsize'], 4096)
+        self.assertEqual(st['f_blocks'], self.quota // 4096)
+        self.assertEqual(st['f_bfree'], (self.quota - self.used) // 4096)
+        self.assertEqual(st['f_bavail'], st['f_bfree'])
+        self.assertEqual(self.client.calls, [])
+
+    def test_adjusted(self):
+
+        # writes count as soon as they're made, uploads and deletes
+        # without waiting for the next refresh
+        free = self.fs.statfs('/')['f_bfree']
+        self.fs.open('/doc.bin', os.O_RDWR)
+        self.fs.write('/doc.bin', 'new', len(self.data) + 8189, None)
+        self.assertEqual(self.fs.statfs('/')['f_bfree'], free - 2)
+        self.fs.release('/doc.bin', None)
+        self.assertEqual(len(self.client.uploads), 1)
+        self.assertEqual(self.fs.statfs('/')['f_bfree'], free - 2)
+        self.fs.unlink('/doc.bin')
+        self.assertEqual(self.fs.statfs('/')['f_bfree'], free + len(self.data) // 4096)
+        self.assertFalse(('account_info',) in self.client.calls)
+
+class SaveDelayTestCase(FakeDropboxTestCase):
+
+    save_delay = 0.1
+
+    def test_save_by_rename(self):
+
+        # an editor saving through a temp file renamed over the original,
+        # the new contents are uploaded once and only to the final path
+        self.fs.create('/doc.bin.tmp', 0644)
+        self.fs.write('/doc.bin.tmp', 'new', 0, None)
+        self.fs.release('/doc.bin.tmp', None)
+        self.fs.rename('/doc.bin.tmp', '/doc.bin')
+        self.assertTrue(wait_for(lambda: self.client.uploads))
+        sleep(self.save_delay * 2)
+        self.assertEqual(self.client.calls, [('put', '/doc.bin')])
+        self.assertEqual(self.client.files['/doc.bin'], 'new')
+        self.assertFalse('/doc.bin.tmp' in self.client.files)
+
+    def test_new_file(self):
+
+        # a new file shows up before it's uploaded, and costs one upload
+        self.fs.create('/new.txt', 0644)
+        self.fs.write('/new.txt', 'hello', 0, None)
+        self.fs.release('/new.txt', None)
+        self.assertEqual(self.fs.getattr('/new.txt')['st_size'], 5)
+        self.assertEqual(sorted(self.fs.readdir('/')), ['.', '..', 'doc.bin', 'new.txt'])
+        self.assertEqual(self.client.calls, [])
+        self.assertTrue(wait_for(lambda: self.client.uploads))
+        sleep(self.save_delay * 2)
+        self.assertEqual(self.client.calls, [('put', '/new.txt')])
+        self.assertEqual(self.client.files['/new.txt'], 'hello')
+
+    def test_temp_file_deleted(self):
+
+        # a file deleted within the delay never reaches dropbox
+        self.fs.create('/scratch.txt', 0644)
+        self.fs.write('/scratch.txt', 'scratch', 0, None)
+        self.fs.release('/scratch.txt', None)
+        self.fs.unlink('/scratch.txt')
+        sleep(self.save_delay * 3)
+        self.assertEqual(self.client.calls, [])
+        self.assertFalse('/scratch.txt' in self.fs.files)
+
+if __name__ == '__main__':
+    unittest.main()
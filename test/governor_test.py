@@ -0,0 +1,103 @@
+import os
+import sys
+import threading
+import unittest
+from StringIO import StringIO
+from time import time, sleep
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from governor import Governor, TokenBucket, retry_after
+
+"""
+Unit tests for the API request governor. These don't need the Dropbox
+API or a mounted filesystem.
+"""
+
+class FakeError(Exception):
+
+    def __init__(self, status, headers=None):
+        Exception.__init__(self, status)
+        self.status = status
+        self.headers = headers or {}
+
+class FakeClient(object):
+
+    def __init__(self, failures=0, status=503, headers=None):
+        self.failures = failures
+        self.status = status
+        self.headers = headers
+        self.calls = 0
+        self.running = 0
+        self.most_running = 0
+        self.lock = threading.Lock()
+
+    def put_file(self, path, f, overwrite=False):
+        self.calls += 1
+        data = f.read()
+        if self.calls <= self.failures:
+            raise FakeError(self.status, self.headers)
+        return {'path': path, 'bytes': len(data)}
+
+    def metadata(self, path, list=True):
+        with self.lock:
+            self.running += 1
+            self.most_running = max(self.most_running, self.running)
+        sleep(0.01)
+        with self.lock:
+            self.running -= 1
+        return {'path': path}
+
+class GovernorTestCase(unittest.TestCase):
+
+    def test_token_bucket(self):
+
+        bucket = TokenBucket(100, 10)
+        start = time()
+        for i in range(30):
+            bucket.acquire()
+        # a burst of 10 goes at once, the other 20 at 100 a second
+        self.assertTrue(0.15 < time() - start < 0.5)
+
+    def test_retry_after(self):
+
+        self.assertEqual(retry_after(FakeError(503, {'Retry-After': '2'})), 2)
+        self.assertEqual(retry_after(FakeError(503, [('retry-after', '1.5')])), 1.5)
+        self.assertTrue(retry_after(FakeError(503)) is None)
+
+    def test_retries_rate_limited(self):
+
+        client = FakeClient(failures=2, headers={'Retry-After': '0'})
+        governor = Governor(client, rate=1000)
+        # the upload starts over from the same position each time
+        f = StringIO('hello')
+        self.assertEqual(governor.put_file('/a', f), {'path': '/a', 'bytes': 5})
+        self.assertEqual(client.calls, 3)
+
+    def test_other_errors_raised(self):
+
+        client = FakeClient(failures=1, status=404)
+        governor = Governor(client, rate=1000)
+        self.assertRaises(FakeError, governor.put_file, '/a', StringIO('x'))
+        self.assertEqual(client.calls, 1)
+
+    def test_gives_up(self):
+
+        client = FakeClient(failures=10, headers={'Retry-After': '0'})
+        governor = Governor(client, rate=1000, max_retries=3)
+        self.assertRaises(FakeError, governor.put_file, '/a', StringIO('x'))
+        self.assertEqual(client.calls, 4)
+
+    def test_concurrency(self):
+
+        client = FakeClient()
+        governor = Governor(client, rate=1000, max_concurrent=3)
+        threads = [threading.Thread(target=governor.metadata, args=('/%d' % i,))
+                   for i in range(12)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(client.most_running <= 3)
+
+if __name__ == '__main__':
+    unittest.main()
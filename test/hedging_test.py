@@ -0,0 +1,101 @@
+import os
+import socket
+import sys
+import threading
+import unittest
+from time import time, sleep
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from hedging import HedgedClient, LatencyTracker
+
+"""
+Unit tests for hedged and deadline-bounded requests. These don't need
+the Dropbox API or a mounted filesystem.
+"""
+
+class Response(object):
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+class FakeClient(object):
+
+    def __init__(self, delays):
+        # seconds taken by each successive call
+        self.delays = list(delays)
+        self.responses = []
+        self.lock = threading.Lock()
+
+    def get_file(self, path):
+        with self.lock:
+            delay = self.delays.pop(0) if self.delays else 0
+            response = Response(delay)
+            self.responses.append(response)
+        sleep(delay)
+        return response
+
+    def metadata(self, path, list=True):
+        raise socket.error('unreachable')
+
+    def put_file(self, path, f, overwrite=False):
+        return 'not hedged'
+
+def warmed_up(client, budget=0.5, deadline=5):
+
+    # a hedged client which has seen 20 calls of 10ms
+    tracker = LatencyTracker()
+    for i in range(20):
+        tracker.record('get_file', 0.01)
+    hedged = HedgedClient(client, budget, deadline, tracker)
+    hedged.calls = 20
+    return hedged
+
+class HedgingTestCase(unittest.TestCase):
+
+    def test_percentile(self):
+
+        tracker = LatencyTracker(min_samples=10)
+        self.assertTrue(tracker.percentile('metadata') is None)
+        for i in range(100):
+            tracker.record('metadata', i / 100.0)
+        self.assertEqual(tracker.percentile('metadata'), 0.95)
+
+    def test_hedge_wins(self):
+
+        client = FakeClient([1, 0])
+        hedged = warmed_up(client)
+        start = time()
+        response = hedged.get_file('/a')
+        self.assertTrue(time() - start < 0.5)
+        self.assertTrue(response is client.responses[1])
+        self.assertEqual(hedged.hedges, 1)
+        # the slow copy's response is closed once it arrives
+        sleep(1.1)
+        self.assertTrue(client.responses[0].closed)
+
+    def test_budget(self):
+
+        client = FakeClient([0.1, 0.1])
+        hedged = warmed_up(client, budget=0.01)
+        hedged.get_file('/a')
+        # 21 calls leave no room for a hedge at 1%
+        self.assertEqual(len(client.responses), 1)
+
+    def test_deadline(self):
+
+        client = FakeClient([1])
+        hedged = HedgedClient(client, budget=0, deadline=0.1)
+        self.assertRaises(socket.timeout, hedged.get_file, '/a')
+
+    def test_errors(self):
+
+        hedged = HedgedClient(FakeClient([]))
+        self.assertRaises(socket.error, hedged.metadata, '/a')
+        self.assertEqual(hedged.put_file('/a', None), 'not hedged')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import os
+import sys
+import timeit
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from metadata_store import MetadataStore, ingest
+
+"""
+Microbenchmark of listing ingestion: the former per-entry strptime loop
+against metadata_store.ingest() plus storing the result, on a synthetic
+50k entry listing.
+Run with: python ingest_bench.py
+"""
+
+N = 50000
+
+def make_contents(n):
+
+    # a few hundred distinct timestamps, as in a real folder
+    contents = []
+    for i in range(n):
+        contents.append({'path': u'/bench/f\xe9ile-%d.txt' % i,
+                         'modified': 'Sat, %02d Aug 2014 %02d:%02d:%02d +0000' %
+                                     (1 + i % 28, i % 24, i % 60, (i / 7) % 60),
+                         'is_dir': False, 'bytes': i})
+    return contents
+
+def old_loop(contents):
+
+    tree = {}
+    for child in contents:
+        name = str((os.path.basename(child['path'])).encode('utf8'))
+        d = child['modified']
+        d = d[5:-6]
+        date_object = datetime.strptime(d, '%d %b %Y %H:%M:%S')
+        time_stamp = (date_object - datetime(1970,1,1)).total_seconds()
+        ctime = int(time_stamp)
+        mtime = int(time_stamp)
+        tree[name] = {'name': name, 'type': 'file', 'size': child['bytes'],
+                      'ctime': ctime, 'mtime': mtime}
+    return tree
+
+def main():
+
+    contents = make_contents(N)
+    old = min(timeit.repeat(lambda: old_loop(contents), number=1, repeat=3))
+    store = MetadataStore()
+    new = min(timeit.repeat(lambda: store.set_listing('/bench', ingest(contents), 60),
+                            number=1, repeat=3))
+    print "old loop:  %.3fs for %d entries" % (old, N)
+    print "ingest():  %.3fs for %d entries" % (new, N)
+    print "speed-up:  %.1fx" % (old / new)
+
+if __name__ == '__main__':
+    main()
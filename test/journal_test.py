@@ -0,0 +1,76 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from journal import Journal
+
+"""
+Unit tests for the journal of metadata operations. These don't need the
+Dropbox API or a mounted filesystem.
+"""
+
+class JournalTestCase(unittest.TestCase):
+
+    def setUp(self):
+
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'journal')
+
+    def tearDown(self):
+
+        shutil.rmtree(self.dir)
+
+    def test_empty(self):
+
+        self.assertEqual(Journal(self.path).load(), [])
+
+    def test_pending(self):
+
+        journal = Journal(self.path)
+        a = journal.append('delete', '/a')
+        b = journal.append('move', '/b', '/c', (False, 3, 1, 2))
+        journal.append('mkdir', '/d', '/d', (True, 0, 1, 1))
+        journal.done(a)
+
+        ops = Journal(self.path).load()
+        self.assertEqual(ops, [(b, 'move', '/b', '/c', (False, 3, 1, 2)),
+                               (b + 1, 'mkdir', '/d', '/d', (True, 0, 1, 1))])
+        self.assertTrue(all(type(op[2]) is str for op in ops))
+
+    def test_numbers_continue(self):
+
+        journal = Journal(self.path)
+        journal.append('delete', '/a')
+        journal.append('delete', '/b')
+        journal = Journal(self.path)
+        journal.load()
+        self.assertEqual(journal.append('delete', '/c'), 3)
+
+    def test_torn_record(self):
+
+        # a crash halfway through writing the last record
+        journal = Journal(self.path)
+        journal.append('delete', '/a')
+        with open(self.path, 'ab') as f:
+            f.write('{"seq": 2, "kind": "del')
+        self.assertEqual(Journal(self.path).load(), [(1, 'delete', '/a', None, None)])
+        # and records written after it are still read
+        journal = Journal(self.path)
+        journal.load()
+        journal.append('delete', '/b')
+        self.assertEqual([op[2] for op in Journal(self.path).load()], ['/a', '/b'])
+
+    def test_reset(self):
+
+        journal = Journal(self.path)
+        journal.append('delete', '/a')
+        journal.reset()
+        self.assertEqual(os.path.getsize(self.path), 0)
+        journal.append('delete', '/b')
+        self.assertEqual([op[2] for op in Journal(self.path).load()], ['/b'])
+
+if __name__ == '__main__':
+    unittest.main()
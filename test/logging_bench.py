@@ -0,0 +1,65 @@
+import logging
+import os
+import sys
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import logs
+
+"""
+Benchmark of the cost of a per-operation log message, such as the
+"reading file %s" logged by every read, at each log level. Output goes
+to /dev/null so only the logging overhead is measured.
+"""
+
+CALLS = 200000
+
+def timed(func):
+
+    start = time()
+    func()
+    return (time() - start) / CALLS * 1e6
+
+def bench_print():
+
+    out = open(os.devnull, 'w')
+    stdout, sys.stdout = sys.stdout, out
+    try:
+        def run():
+            for i in xrange(CALLS):
+                print "reading file %s" % '/some/file'
+        return timed(run)
+    finally:
+        sys.stdout = stdout
+
+def bench_level(name):
+
+    log = logs.get_logger('fs')
+    root = logs.configure(logs.LEVELS[name], os.devnull)
+    log_ops = log.isEnabledFor(logging.DEBUG)
+
+    def run():
+        for i in xrange(CALLS):
+            if log_ops:
+                log.debug("reading file %s", '/some/file')
+    cost = timed(run)
+    for handler in root.handlers:
+        handler.flush()
+    return cost
+
+def bench_unguarded():
+
+    # a debug message without the log_ops check, filtered by the logger
+    log = logs.get_logger('fs')
+    logs.configure(logging.WARNING, os.devnull)
+
+    def run():
+        for i in xrange(CALLS):
+            log.debug("reading file %s", '/some/file')
+    return timed(run)
+
+if __name__ == '__main__':
+    print "%-28s %6.2f us/op" % ("print to stdout", bench_print())
+    for name in ('error', 'warning', 'info', 'debug'):
+        print "%-28s %6.2f us/op" % ("level %s" % name, bench_level(name))
+    print "%-28s %6.2f us/op" % ("debug call at warning level", bench_unguarded())
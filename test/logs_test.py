@@ -0,0 +1,80 @@
+import logging
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from logs import AsyncHandler, RateLimitFilter
+
+"""
+Unit tests for the logging helpers. These don't need the Dropbox API or
+a mounted filesystem.
+"""
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+class Expensive(object):
+
+    # counts how often it's turned into a string
+    formatted = 0
+
+    def __str__(self):
+        Expensive.formatted += 1
+        return 'expensive'
+
+class LogsTestCase(unittest.TestCase):
+
+    def logger(self, name, handler, level=logging.DEBUG):
+
+        log = logging.getLogger('cloudfuse.test.' + name)
+        log.handlers = [handler]
+        log.setLevel(level)
+        log.propagate = False
+        return log
+
+    def test_rate_limit(self):
+
+        target = ListHandler()
+        rate_limit = RateLimitFilter(burst=3, interval=60)
+        target.addFilter(rate_limit)
+        log = self.logger('rate', target)
+        for i in range(10):
+            log.error("Error %s: %s", 503, 'busy')
+        log.debug("not limited")
+        log.debug("not limited")
+        self.assertEqual(len(target.messages), 5)
+
+        # once the window is over, the dropped messages are counted
+        for window in rate_limit.windows.values():
+            window[0] -= 60
+        log.error("Error %s: %s", 503, 'busy')
+        self.assertEqual(target.messages[-1], 'Error 503: busy (7 similar messages suppressed)')
+
+    def test_async_handler(self):
+
+        target = ListHandler()
+        handler = AsyncHandler(target)
+        log = self.logger('async', handler)
+        for i in range(1000):
+            log.info("message %d", i)
+        handler.flush()
+        self.assertEqual(target.messages, ['message %d' % i for i in range(1000)])
+
+    def test_lazy_formatting(self):
+
+        target = ListHandler()
+        log = self.logger('lazy', target, logging.WARNING)
+        log.debug("value %s", Expensive())
+        self.assertEqual(Expensive.formatted, 0)
+        log.warning("value %s", Expensive())
+        self.assertEqual(Expensive.formatted, 1)
+
+if __name__ == '__main__':
+    unittest.main()
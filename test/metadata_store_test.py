@@ -0,0 +1,173 @@
+import os
+import sys
+import unittest
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from metadata_store import MetadataStore, ROOT_INO, ingest, parse_timestamp
+
+"""
+Unit tests for the in-memory metadata store. These don't need the
+Dropbox API or a mounted filesystem.
+"""
+
+class MetadataStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+
+        self.store = MetadataStore()
+        self.store.set_listing('/', [('docs', True, 0, 1, 1),
+                                     ('a.txt', False, 10, 1, 1)], 60)
+        self.store.set_listing('/docs', [('b.txt', False, 20, 2, 2)], 60)
+
+    def test_lookup(self):
+
+        self.assertEqual(self.store.lookup('/').ino, ROOT_INO)
+        self.assertEqual(self.store.lookup('/docs/b.txt').size, 20)
+        self.assertTrue(self.store.lookup('/docs/missing') is None)
+        self.assertTrue(self.store.lookup('/a.txt/b') is None)
+
+    def test_stable_inodes(self):
+
+        # re-listing a directory keeps the inode numbers of known objects
+        ino = self.store.lookup('/docs/b.txt').ino
+        self.store.set_listing('/docs', [('b.txt', False, 30, 3, 3),
+                                         ('c.txt', False, 0, 3, 3)], 60)
+        node = self.store.lookup('/docs/b.txt')
+        self.assertEqual(node.ino, ino)
+        self.assertEqual(node.size, 30)
+        self.assertTrue(self.store.get(ino) is node)
+
+    def test_listing_expiry(self):
+
+        self.assertTrue('docs' in self.store.listing('/'))
+        self.store.invalidate('/')
+        self.assertTrue(self.store.listing('/') is None)
+
+    def test_stale_listing(self):
+
+        # expired ten seconds ago
+        self.store.lookup('/docs').expires = time() - 10
+        self.assertTrue(self.store.listing('/docs') is None)
+        self.assertTrue(self.store.listing('/docs', 5) is None)
+        self.assertTrue('b.txt' in self.store.listing('/docs', 60))
+        # invalidated listings are never served, however stale
+        self.store.invalidate('/docs')
+        self.assertTrue(self.store.listing('/docs', float('inf')) is None)
+
+    def test_adaptive_ttl(self):
+
+        store = MetadataStore(min_ttl=10, max_ttl=100)
+        entries = [('a', False, 1, 1, 1)]
+        store.set_listing('/', entries, 40)
+        self.assertEqual(store.ttl('/'), 40)
+        # unchanged listings back off up to max_ttl
+        store.set_listing('/', entries, 40)
+        self.assertEqual(store.ttl('/'), 80)
+        store.set_listing('/', entries, 40)
+        self.assertEqual(store.ttl('/'), 100)
+        # a change tightens it again
+        store.set_listing('/', [('a', False, 2, 2, 2)], 40)
+        self.assertEqual(store.ttl('/'), 25)
+        store.set_listing('/', [], 40)
+        self.assertEqual(store.ttl('/'), 10)
+
+    def test_move_subtree(self):
+
+        ino = self.store.lookup('/docs/b.txt').ino
+        self.store.move('/docs', '/papers')
+        self.assertTrue(self.store.lookup('/docs') is None)
+        node = self.store.lookup('/papers/b.txt')
+        self.assertEqual(node.ino, ino)
+        self.assertEqual(self.store.path(node), '/papers/b.txt')
+        # the moved listing is still complete
+        self.assertTrue('b.txt' in self.store.listing('/papers'))
+
+    def test_add_remove(self):
+
+        self.store.add('/docs/new', False, 0, 5, 5)
+        self.assertTrue(self.store.lookup('/docs/new') is not None)
+        # objects in unknown directories are not recorded
+        self.assertTrue(self.store.add('/nowhere/x', False, 0, 5, 5) is None)
+        ino = self.store.lookup('/docs/b.txt').ino
+        self.store.remove('/docs')
+        self.assertTrue(self.store.lookup('/docs/new') is None)
+        self.assertTrue(self.store.get(ino) is None)
+
+    def test_eviction(self):
+
+        store = MetadataStore(max_nodes=8)
+        store.set_listing('/', [('d%d' % i, True, 0, 0, 0) for i in range(3)], 60)
+        store.set_listing('/d0', [('f%d' % i, False, 0, 0, 0) for i in range(3)], 60)
+        store.set_listing('/d1', [('f%d' % i, False, 0, 0, 0) for i in range(3)], 60)
+        # the coldest listing was dropped to stay within budget
+        self.assertTrue(len(store.inodes) <= 8)
+        self.assertTrue(store.listing('/d0') is None)
+        self.assertTrue('f0' in store.listing('/d1'))
+        self.assertTrue('d0' in store.listing('/'))
+
+    def test_single_entries(self):
+
+        self.assertEqual(self.store.count('/docs'), 1)
+        self.assertTrue(self.store.count('/unknown') is None)
+        # an entry cached on its own doesn't make the listing complete
+        node = self.store.set_entry('/big/x.txt', False, 7, 1, 1, 60)
+        self.assertTrue(self.store.entry('/big/x.txt') is node)
+        self.assertTrue(self.store.listing('/big') is None)
+        self.store.move('/big/x.txt', '/big/y.txt')
+        self.assertTrue(self.store.entry('/big/x.txt') is None)
+        self.assertTrue(self.store.entry('/big/y.txt') is node)
+        self.store.set_entry('/big/z.txt', False, 7, 1, 1, -1)
+        self.assertTrue(self.store.entry('/big/z.txt') is None)
+
+    def test_single_entries_bounded(self):
+
+        # stats of many files of a directory too large to list
+        store = MetadataStore(max_nodes=50)
+        store.set_listing('/', [('big', True, 0, 0, 0)], 60)
+        for i in range(1000):
+            node = store.set_entry('/big/sub/f%d' % i, False, 1, 1, 1, 60)
+            self.assertTrue(store.entry('/big/sub/f%d' % i) is node)
+        self.assertTrue(len(store.inodes) <= 50, len(store.inodes))
+        self.assertTrue(len(store.singles) <= 50)
+        self.assertTrue(store.lookup('/big/sub/f0') is None)
+        self.assertTrue(store.listing('/') is not None)
+
+        # and so is the table of their expiry times
+        store = MetadataStore()
+        store.max_singles = 10
+        for i in range(100):
+            store.set_entry('/huge/f%d' % i, False, 1, 1, 1, 60)
+        self.assertEqual(len(store.singles), 10)
+        self.assertEqual(len(store.lookup('/huge').children), 10)
+        self.assertTrue(store.entry('/huge/f99') is not None)
+
+    def test_eviction_keeps_parents(self):
+
+        # listing a subdirectory at the limit doesn't evict its parent,
+        # which would take the new listing along
+        store = MetadataStore(max_nodes=20)
+        store.set_listing('/', [('a', True, 0, 0, 0)], 60)
+        store.set_listing('/a', [('b', True, 0, 0, 0)] +
+                          [('f%d' % i, False, 1, 1, 1) for i in range(10)], 60)
+        store.set_listing('/a/b', [('g%d' % i, False, 1, 1, 1) for i in range(15)], 60)
+        self.assertEqual(len(store.listing('/a/b')), 15)
+        self.assertTrue(store.lookup('/a/b/g0') is not None)
+
+class IngestTestCase(unittest.TestCase):
+
+    def test_parse_timestamp(self):
+
+        self.assertEqual(parse_timestamp('Sat, 21 Aug 2010 22:31:20 +0000'), 1282429880)
+        self.assertEqual(parse_timestamp('Sat, 21 Aug 2010 23:31:20 +0100'), 1282429880)
+        # memoized value is returned on repeated calls
+        self.assertEqual(parse_timestamp('Sat, 21 Aug 2010 22:31:20 +0000'), 1282429880)
+
+    def test_ingest(self):
+
+        contents = [{'path': u'/docs/caf\xe9.txt', 'modified': 'Thu, 01 Jan 1970 00:01:00 +0000',
+                     'is_dir': False, 'bytes': 5}]
+        self.assertEqual(ingest(contents), [('caf\xc3\xa9.txt', False, 5, 60, 60)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+from time import sleep
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from profiler import SamplingProfiler, TracedClient, Tracer, export
+
+"""
+Unit tests for the tracing and sampling hooks. These don't need the
+Dropbox API or a mounted filesystem.
+"""
+
+class FakeClient(object):
+
+    def metadata(self, path, list=True):
+        return {'path': path}
+
+class ProfilerTestCase(unittest.TestCase):
+
+    def test_inactive(self):
+
+        tracer = Tracer()
+        with tracer.span('read', 'fuse', path='/a'):
+            tracer.instant('hit', 'cache')
+        self.assertEqual(len(tracer.events), 0)
+
+    def test_nested_spans(self):
+
+        tracer = Tracer()
+        tracer.start()
+        client = TracedClient(FakeClient(), tracer)
+        with tracer.span('getattr', 'fuse', path='/a'):
+            with tracer.span('lookup', 'cache', path='/a'):
+                self.assertEqual(client.metadata('/a', list=False), {'path': '/a'})
+        tracer.stop()
+
+        api, lookup, op = tracer.events
+        self.assertEqual((api['name'], api['cat']), ('metadata', 'api'))
+        # each call is linked to the span which triggered it
+        self.assertEqual(api['args']['parent'], lookup['args']['id'])
+        self.assertEqual(lookup['args']['parent'], op['args']['id'])
+        self.assertTrue('parent' not in op['args'])
+        self.assertTrue(op['dur'] >= lookup['dur'])
+
+    def test_errors_recorded(self):
+
+        tracer = Tracer()
+        tracer.start()
+        try:
+            with tracer.span('open', 'fuse', path='/a'):
+                raise OSError(2, 'No such file')
+        except OSError:
+            pass
+        self.assertTrue('No such file' in tracer.events[0]['args']['error'])
+
+    def test_export(self):
+
+        tracer = Tracer()
+        profiler = SamplingProfiler(interval=0.001)
+        tracer.start()
+        profiler.start()
+        with tracer.span('read', 'fuse', path='/a'):
+            sleep(0.05)
+        profiler.stop()
+        tracer.stop()
+
+        path = tempfile.mktemp(suffix='.json')
+        try:
+            export(path, tracer, profiler)
+            trace = json.load(open(path))
+        finally:
+            os.remove(path)
+        self.assertEqual(trace['traceEvents'][0]['name'], 'read')
+        self.assertTrue(trace['samples'])
+        # every sample points at a known stack frame
+        for sample in trace['samples']:
+            self.assertTrue(sample['sf'] in trace['stackFrames'])
+
+if __name__ == '__main__':
+    unittest.main()
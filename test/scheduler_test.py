@@ -0,0 +1,89 @@
+import os
+import sys
+import threading
+import unittest
+from time import sleep
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from scheduler import IOScheduler, current, priority
+
+"""
+Unit tests for the priority scheduler of API requests. These don't need
+the Dropbox API or a mounted filesystem.
+"""
+
+class FakeClient(object):
+
+    def __init__(self):
+        self.order = []
+        self.running = {}
+        self.most_running = {}
+        self.lock = threading.Lock()
+        self.gate = threading.Event()
+
+    def metadata(self, path, list=True):
+        cls = current()
+        with self.lock:
+            self.running[cls] = self.running.get(cls, 0) + 1
+            self.most_running[cls] = max(self.most_running.get(cls, 0), self.running[cls])
+        self.gate.wait()
+        with self.lock:
+            self.order.append(path)
+            self.running[cls] -= 1
+        return path
+
+def request(scheduler, cls, path):
+
+    with priority(cls):
+        scheduler.metadata(path)
+
+def start(scheduler, cls, path):
+
+    thread = threading.Thread(target=request, args=(scheduler, cls, path))
+    thread.start()
+    sleep(0.02)
+    return thread
+
+class SchedulerTestCase(unittest.TestCase):
+
+    def test_current(self):
+
+        self.assertEqual(current('metadata'), 'foreground')
+        self.assertEqual(current('put_file'), 'upload')
+        with priority('sync'):
+            self.assertEqual(current('put_file'), 'sync')
+        self.assertEqual(current(), 'foreground')
+
+    def test_foreground_first(self):
+
+        client = FakeClient()
+        scheduler = IOScheduler(client, concurrency=1)
+        threads = [start(scheduler, 'sync', '/busy')]
+        threads += [start(scheduler, 'sync', '/sync%d' % i) for i in range(3)]
+        threads.append(start(scheduler, 'foreground', '/ls'))
+        client.gate.set()
+        for thread in threads:
+            thread.join()
+        # the foreground request overtook the queued background ones
+        self.assertEqual(client.order[:2], ['/busy', '/ls'])
+        metrics = scheduler.metrics()
+        self.assertEqual(metrics['sync']['requests'], 4)
+        self.assertEqual(metrics['sync']['max_queued'], 3)
+        self.assertTrue(metrics['sync']['max_wait'] > metrics['foreground']['max_wait'])
+
+    def test_class_limits(self):
+
+        client = FakeClient()
+        scheduler = IOScheduler(client, concurrency=8)
+        threads = [start(scheduler, 'upload', '/up%d' % i) for i in range(5)]
+        threads += [start(scheduler, 'foreground', '/fg%d' % i) for i in range(4)]
+        # uploads keep to their share, foreground requests get the rest
+        self.assertEqual(client.most_running['upload'], 2)
+        self.assertEqual(client.most_running['foreground'], 4)
+        client.gate.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(scheduler.metrics()['upload']['running'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
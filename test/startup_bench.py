@@ -0,0 +1,66 @@
+import os
+import sys
+import shutil
+import tempfile
+import time
+import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import cloud_fuse
+
+"""
+Benchmark of mount startup. DropboxClient is replaced by a fake which
+answers every call after LATENCY seconds, so this measures how much of
+the startup has to wait for the network.
+Run with: python startup_bench.py
+"""
+
+LATENCY = 0.25
+
+class SlowClient(object):
+
+    def __init__(self, token):
+        pass
+
+    def account_info(self):
+        time.sleep(LATENCY)
+        return {'quota_info': {'quota': 2 ** 31, 'shared': 0, 'normal': 0}}
+
+    def metadata(self, path, list=True):
+        time.sleep(LATENCY)
+        return {'contents': [{'path': '/.f_perm.txt', 'is_dir': False, 'bytes': 0,
+                              'modified': 'Mon, 19 May 2014 10:00:00 +0000'}]}
+
+    def get_file(self, path):
+        time.sleep(LATENCY)
+        return tempfile.TemporaryFile()
+
+def main():
+
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir)
+    try:
+        with open('dropbox_auth.conf', 'w') as f:
+            f.write('fakeOauthToken')
+
+        with mock.patch('dropbox.client.DropboxClient', SlowClient):
+            start = time.time()
+            fs = cloud_fuse.DropboxFUSE('restr')
+            fs.init('/')
+            mounted = time.time()
+            fs.dropbox_api.ready.wait()
+            ready = time.time()
+            fs.dropbox_api.perm_ready.wait()
+            warm = time.time()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+    print "simulated round-trip:  %.3fs" % LATENCY
+    print "mounted after:         %.3fs" % (mounted - start)
+    print "client ready after:    %.3fs" % (ready - start)
+    print "warm-up done after:    %.3fs" % (warm - start)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+import os
+import sys
+import unittest
+from StringIO import StringIO
+from time import time, mktime, localtime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from throttle import Bandwidth, Throttle, ThrottledFile, parse_rate, parse_schedule
+
+"""
+Unit tests for the bandwidth limits. These don't need the Dropbox API or
+a mounted filesystem.
+"""
+
+def at(hour, minute):
+
+    # a timestamp of today at hour:minute, local time
+    t = localtime()
+    return mktime((t.tm_year, t.tm_mon, t.tm_mday, hour, minute, 0, 0, 0, -1))
+
+class ParseTestCase(unittest.TestCase):
+
+    def test_rate(self):
+
+        self.assertEqual(parse_rate('0'), 0)
+        self.assertEqual(parse_rate('1500'), 1500)
+        self.assertEqual(parse_rate('512K'), 512 * 1024)
+        self.assertEqual(parse_rate('1.5m'), 1.5 * 1024 ** 2)
+        self.assertEqual(parse_rate('2MB'), 2 * 1024 ** 2)
+        self.assertRaises(ValueError, parse_rate, 'fast')
+        self.assertRaises(ValueError, parse_rate, '-1K')
+
+    def test_schedule(self):
+
+        self.assertEqual(parse_schedule(None), (0, []))
+        self.assertEqual(parse_schedule('1M,08:00-18:30=256K'),
+                         (1024 ** 2, [(480, 1110, 256 * 1024)]))
+        self.assertRaises(ValueError, parse_schedule, '08:00=1K')
+        self.assertRaises(ValueError, parse_schedule, '25:00-26:00=1K')
+
+class ThrottleTestCase(unittest.TestCase):
+
+    def test_unlimited(self):
+
+        throttle = Throttle()
+        self.assertEqual(throttle.reserve(10 ** 9), 0)
+
+    def test_rate(self):
+
+        # a second worth of bytes at most, then the debt has to be waited off
+        throttle = Throttle('1000')
+        throttle.tokens = 1000
+        self.assertEqual(throttle.reserve(600), 0)
+        wait = throttle.reserve(900)
+        self.assertTrue(0.49 < wait <= 0.5, wait)
+        wait = throttle.reserve(1000)
+        self.assertTrue(1.49 < wait <= 1.5, wait)
+
+    def test_schedule(self):
+
+        throttle = Throttle('0,08:00-18:00=100K,22:00-06:00=1M')
+        self.assertEqual(throttle.rate(at(7, 59)), 0)
+        self.assertEqual(throttle.rate(at(8, 0)), 100 * 1024)
+        self.assertEqual(throttle.rate(at(17, 59)), 100 * 1024)
+        self.assertEqual(throttle.rate(at(18, 0)), 0)
+        self.assertEqual(throttle.rate(at(23, 0)), 1024 ** 2)
+        self.assertEqual(throttle.rate(at(2, 0)), 1024 ** 2)
+
+    def test_set(self):
+
+        throttle = Throttle('1K')
+        throttle.set('0')
+        self.assertEqual(throttle.reserve(10 ** 6), 0)
+        self.assertEqual(throttle.spec, '0')
+        self.assertRaises(ValueError, throttle.set, 'lots')
+        self.assertEqual(throttle.spec, '0')
+
+class BandwidthTestCase(unittest.TestCase):
+
+    def test_total(self):
+
+        # the total limit holds both directions together
+        bandwidth = Bandwidth(total='100K')
+        start = time()
+        for i in range(3):
+            bandwidth.upload(25 * 1024)
+            bandwidth.download(25 * 1024)
+        self.assertTrue(time() - start >= 0.45, time() - start)
+
+    def test_directions(self):
+
+        # an upload limit doesn't hold back downloads
+        bandwidth = Bandwidth(upload='10K')
+        start = time()
+        bandwidth.download(10 ** 6)
+        self.assertTrue(time() - start < 0.1)
+
+    def test_throttled_file(self):
+
+        counts = []
+        f = ThrottledFile(StringIO('x' * 10000), counts.append)
+        self.assertEqual(len(f.read(4096)), 4096)
+        self.assertEqual(len(f.read()), 5904)
+        self.assertEqual(f.read(), '')
+        self.assertEqual(counts, [4096, 5904])
+        # the rest is the file's own, so uploads can be rewound and sized
+        f.seek(0)
+        self.assertEqual(f.tell(), 0)
+
+if __name__ == '__main__':
+    unittest.main()
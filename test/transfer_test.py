@@ -0,0 +1,69 @@
+import io
+import os
+import resource
+import sys
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from transfer import copy_stream
+
+"""
+Unit tests for streaming file bodies, including a check that copying a
+body much larger than the copy buffer doesn't grow the process.
+"""
+
+class FakeBody(object):
+
+    # a response body of size bytes, produced without holding it in memory
+    def __init__(self, size):
+        self.left = size
+
+    def readinto(self, buf):
+        count = min(len(buf), self.left)
+        buf[:count] = 'x' * count
+        self.left -= count
+        return count
+
+class CopyStreamTestCase(unittest.TestCase):
+
+    def test_copy(self):
+
+        data = os.urandom(200000)
+        dst = StringIO()
+        chunks = []
+        copied = copy_stream(StringIO(data), dst, chunk_size=4096,
+                             callback=lambda offset, chunk: chunks.append(offset))
+        self.assertEqual(copied, len(data))
+        self.assertEqual(dst.getvalue(), data)
+        self.assertEqual(chunks, range(0, len(data), 4096))
+
+    def test_cancel(self):
+
+        dst = io.BytesIO()
+        copied = copy_stream(FakeBody(10 ** 6), dst, chunk_size=1000,
+                             cancelled=lambda: dst.tell() >= 5000)
+        self.assertEqual(copied, 5000)
+
+    def test_throttle(self):
+
+        counts = []
+        copied = copy_stream(FakeBody(10000), io.BytesIO(), chunk_size=4096,
+                             throttle=counts.append)
+        self.assertEqual(copied, 10000)
+        self.assertEqual(counts, [4096, 4096, 1808])
+
+    def test_bounded_memory(self):
+
+        # 2 GB through a 64 KB buffer must not raise the peak RSS by more
+        # than a few MB (ru_maxrss is in KB on Linux, bytes on OS X)
+        scale = 1 if sys.platform.startswith('linux') else 1024
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        with open(os.devnull, 'wb') as dst:
+            copied = copy_stream(FakeBody(2 * 1024 ** 3), dst)
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.assertEqual(copied, 2 * 1024 ** 3)
+        self.assertTrue((after - before) / scale < 16 * 1024, (before, after))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from write_buffer import WriteBuffer
+
+"""
+Unit tests for the per-file write buffer. These don't need the Dropbox
+API or a mounted filesystem.
+"""
+
+def apply(contents, extents):
+
+    # what a file holding contents looks like once extents are written
+    data = bytearray(contents)
+    for offset, chunk in extents:
+        if offset + len(chunk) > len(data):
+            data.extend('\0' * (offset + len(chunk) - len(data)))
+        data[offset:offset + len(chunk)] = chunk
+    return str(data)
+
+class WriteBufferTestCase(unittest.TestCase):
+
+    def test_sequential_writes(self):
+
+        buf = WriteBuffer()
+        for i in range(100):
+            buf.write(i * 4, 'abcd')
+        self.assertEqual(buf.drain(), [(0, 'abcd' * 100)])
+        self.assertEqual(buf.end(), 0)
+
+    def test_overlapping_writes(self):
+
+        buf = WriteBuffer()
+        buf.write(10, 'aaaa')
+        buf.write(0, 'bbbb')
+        buf.write(12, 'cccccc')
+        buf.write(4, 'dddddd')
+        # the hole between 4 and 10 was filled, later writes win
+        self.assertEqual(buf.drain(), [(0, 'bbbbdddddd' 'aacccccc')])
+
+    def test_separate_extents(self):
+
+        buf = WriteBuffer()
+        buf.write(100, 'x')
+        buf.write(0, 'y')
+        self.assertTrue(buf.overlaps(50, 51))
+        self.assertFalse(buf.overlaps(1, 99))
+        self.assertEqual(buf.end(), 101)
+        self.assertEqual(buf.drain(), [(0, 'y'), (100, 'x')])
+
+    def test_matches_direct_writes(self):
+
+        # random writes give the same file as writing them one by one
+        import random
+        rand = random.Random(4)
+        writes = []
+        buf = WriteBuffer(limit=1 << 30)
+        for i in range(500):
+            offset = rand.randint(0, 5000)
+            data = chr(rand.randint(97, 122)) * rand.randint(1, 300)
+            writes.append((offset, data))
+            buf.write(offset, data)
+        self.assertEqual(apply('', buf.drain()), apply('', writes))
+
+    def test_limit(self):
+
+        buf = WriteBuffer(limit=10)
+        self.assertFalse(buf.write(0, 'x' * 6))
+        self.assertFalse(buf.write(0, 'y' * 6))
+        self.assertTrue(buf.write(6, 'z' * 4))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+"""
+Bandwidth limits for uploads and downloads. Each limit is a token bucket
+refilled at its current rate, the rate can follow a time-of-day schedule
+and be changed while the filesystem is mounted. A limit is written as a
+rate in bytes a second, with an optional K, M or G suffix, optionally
+followed by rates for times of day, e.g. '0,08:00-18:00=256K' for no limit
+except 256 KB/s during office hours. 0 means unlimited.
+"""
+
+from threading import Lock
+from time import time, sleep, localtime
+
+UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+def parse_rate(text):
+
+    # '512K' -> 524288
+    text = text.strip().upper().rstrip('B')
+    unit = 1
+    if text and text[-1] in UNITS:
+        unit = UNITS[text[-1]]
+        text = text[:-1]
+    rate = float(text) * unit
+    if rate < 0:
+        raise ValueError('negative rate')
+    return rate
+
+def parse_minute(text):
+
+    # '08:30' -> 510
+    hours, minutes = text.strip().split(':')
+    minute = int(hours) * 60 + int(minutes)
+    if not 0 <= minute <= 24 * 60:
+        raise ValueError('no such time of day: %s' % text)
+    return minute
+
+def parse_schedule(spec):
+
+    """
+    Turn a limit such as '1M,22:00-06:00=0' into its default rate and a
+    list of (first minute, last minute, rate) windows of the day.
+    """
+    default = 0
+    windows = []
+    for part in (spec or '0').split(','):
+        if '=' in part:
+            span, rate = part.split('=', 1)
+            start, end = span.split('-')
+            windows.append((parse_minute(start), parse_minute(end), parse_rate(rate)))
+        elif part.strip():
+            default = parse_rate(part)
+    return default, windows
+
+class Throttle(object):
+
+    def __init__(self, spec=None):
+        self.lock = Lock()
+        self.tokens = 0.0
+        self.stamp = time()
+        self.set(spec)
+
+    def set(self, spec):
+
+        # change the limit, raises ValueError if spec can't be parsed
+        default, windows = parse_schedule(spec)
+        with self.lock:
+            self.spec = spec or '0'
+            self.default = default
+            self.windows = windows
+
+    def rate(self, now=None):
+
+        # bytes a second allowed right now, 0 for no limit
+        if not self.windows:
+            return self.default
+        t = localtime(now)
+        minute = t.tm_hour * 60 + t.tm_min
+        for start, end, rate in self.windows:
+            if start <= minute < end or (start > end and (minute >= start or minute < end)):
+                return rate
+        return self.default
+
+    def reserve(self, count):
+
+        """
+        Take count bytes worth of tokens, going into debt if needed.
+        Returns the seconds to wait before sending them.
+        """
+        with self.lock:
+            rate = self.rate()
+            now = time()
+            if not rate:
+                self.tokens = 0.0
+                self.stamp = now
+                return 0
+            # up to a second worth of bytes can go out at once
+            self.tokens = min(rate, self.tokens + (now - self.stamp) * rate)
+            self.stamp = now
+            self.tokens -= count
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / rate
+
+class Bandwidth(object):
+
+    # the upload, download and total limits of the filesystem
+    def __init__(self, upload=None, download=None, total=None):
+        self.limits = {'upload': Throttle(upload), 'download': Throttle(download),
+                       'total': Throttle(total)}
+
+    def consume(self, direction, count):
+
+        # block until count bytes may be sent in direction
+        wait = max(self.limits[direction].reserve(count),
+                   self.limits['total'].reserve(count))
+        if wait > 0:
+            sleep(wait)
+
+    def upload(self, count):
+
+        self.consume('upload', count)
+
+    def download(self, count):
+
+        self.consume('download', count)
+
+class ThrottledFile(object):
+
+    # file object whose reads, by an upload, are held to a limit
+    def __init__(self, f, consume):
+        self.f = f
+        self.consume = consume
+
+    def read(self, size=-1):
+
+        data = self.f.read(size)
+        if data:
+            self.consume(len(data))
+        return data
+
+    def __getattr__(self, name):
+
+        return getattr(self.f, name)
@@ -0,0 +1,42 @@
+"""
+Helpers for moving file bodies between Dropbox and the local cache files.
+"""
+
+CHUNK_SIZE = 64 * 1024
+
+def copy_stream(src, dst, chunk_size=CHUNK_SIZE, callback=None, cancelled=None,
+                throttle=None):
+
+    """
+    Copy src into dst in chunk_size pieces through a single reused buffer,
+    so memory use doesn't depend on the size of the body. dst is flushed
+    after every chunk, then callback(offset, data) is called with a view of
+    the chunk, which is only valid until the callback returns. Stops early
+    once cancelled() is true. throttle(count), if given, is called with the
+    size of every chunk read and may block to hold the copy to a bandwidth
+    limit. Returns the number of bytes copied.
+    """
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    # sockets and most file objects can fill our buffer in place
+    readinto = getattr(src, 'readinto', None)
+    offset = 0
+    while cancelled is None or not cancelled():
+        if readinto is not None:
+            count = readinto(buf)
+            if not count:
+                break
+            data = view[:count]
+        else:
+            data = src.read(chunk_size)
+            if not data:
+                break
+            count = len(data)
+        if throttle is not None:
+            throttle(count)
+        dst.write(data)
+        dst.flush()
+        if callback is not None:
+            callback(offset, data)
+        offset += count
+    return offset
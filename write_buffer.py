@@ -0,0 +1,89 @@
+"""
+In-memory buffer of the writes made to an open file. Adjacent and
+overlapping writes are merged into extents, so thousands of small writes
+reach the temp file as a few large contiguous ones.
+"""
+
+from threading import Lock
+
+FLUSH_SIZE = 1024 * 1024
+
+class WriteBuffer(object):
+
+    def __init__(self, limit=FLUSH_SIZE):
+        # bytes buffered before the owner should flush
+        self.limit = limit
+        # held by the owner around writes and flushes, this class
+        # doesn't lock by itself
+        self.lock = Lock()
+        # [offset, bytearray] extents sorted by offset, none of them
+        # overlapping or touching another
+        self.extents = []
+        self.size = 0
+
+    def write(self, offset, data):
+
+        """
+        Buffer data written at offset. Returns True once the buffer
+        holds limit bytes or more and should be flushed.
+        """
+        extents = self.extents
+        if extents:
+            last = extents[-1]
+            if offset == last[0] + len(last[1]):
+                # appending to the last extent, by far the usual case
+                last[1] += data
+                self.size += len(data)
+                return self.size >= self.limit
+
+        end = offset + len(data)
+        # extents overlapping or touching [offset, end) are merged
+        first = 0
+        while first < len(extents) and extents[first][0] + len(extents[first][1]) < offset:
+            first += 1
+        last = first
+        while last < len(extents) and extents[last][0] <= end:
+            last += 1
+
+        if first == last:
+            extents.insert(first, [offset, bytearray(data)])
+            self.size += len(data)
+            return self.size >= self.limit
+
+        start = min(offset, extents[first][0])
+        stop = max(end, extents[last - 1][0] + len(extents[last - 1][1]))
+        merged = bytearray(stop - start)
+        for ext_offset, ext_data in extents[first:last]:
+            merged[ext_offset - start:ext_offset - start + len(ext_data)] = ext_data
+            self.size -= len(ext_data)
+        merged[offset - start:end - start] = data
+        extents[first:last] = [[start, merged]]
+        self.size += len(merged)
+        return self.size >= self.limit
+
+    def overlaps(self, offset, size):
+
+        # whether any buffered byte falls within [offset, offset + size)
+        end = offset + size
+        for ext_offset, ext_data in self.extents:
+            if ext_offset >= end:
+                return False
+            if ext_offset + len(ext_data) > offset:
+                return True
+        return False
+
+    def end(self):
+
+        # end of the last buffered byte, 0 if nothing is buffered
+        if not self.extents:
+            return 0
+        offset, data = self.extents[-1]
+        return offset + len(data)
+
+    def drain(self):
+
+        # hand over the buffered extents as (offset, data), in file order
+        extents = self.extents
+        self.extents = []
+        self.size = 0
+        return [(offset, str(data)) for offset, data in extents]